@@ -37,6 +37,8 @@ setuptools.setup(
             'shotgun2 = shotgun.cli2:main'],
         'shotgun': [
             'snapshot = shotgun.cli2:SnapshotCommand',
-            'report = shotgun.cli2:ReportCommand'
+            'report = shotgun.cli2:ReportCommand',
+            'restore = shotgun.cli2:RestoreCommand',
+            'plan = shotgun.cli2:PlanCommand',
         ]
     })
@@ -0,0 +1,360 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import deque
+import fnmatch
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import subprocess
+import tarfile
+import uuid
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompressionError(Exception):
+    pass
+
+
+class ProcessWriter(object):
+    """File-like object which pipes written data through a command"""
+
+    def __init__(self, args, fileobj):
+        self.args = args
+        self.process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait():
+            raise CompressionError(
+                "Compression command {0} failed with code {1}".format(
+                    " ".join(self.args), self.process.returncode))
+
+
+def _gzip_block(data, level):
+    # zlib releases GIL while compressing, so blocks are compressed
+    # in parallel even by threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipWriter(object):
+    """File-like object which gzips written data using several threads
+
+    Data is split into blocks and every block is compressed into its own
+    gzip member. Concatenated members form a valid gzip file.
+    """
+
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, fileobj, level, threads):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        block = "".join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        self.pending.append(
+            self.pool.apply_async(_gzip_block, (block, self.level)))
+        # keep memory bounded, but let every thread have some work
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.buffer:
+            self._submit()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+
+
+class Codec(object):
+    """Compression backend of the snapshot archive"""
+
+    # extension of compressed tarball
+    extension = None
+
+    def __init__(self, level, threads=1):
+        # level is accepted both as number and as -N option
+        self.level = int(str(level).lstrip("-"))
+        self.threads = threads or multiprocessing.cpu_count()
+
+    def writer(self, fileobj):
+        """Returns file-like object compressing everything into fileobj"""
+        raise NotImplementedError
+
+    def tar_command(self, path, directory, name):
+        """Returns tar command which creates compressed archive by itself
+
+        :returns: tuple (command, environment variables) or None if tar
+                  can't use the codec and data should go through writer()
+        """
+        return None
+
+
+class XzCodec(Codec):
+    """xz, threads compress separate blocks of the stream"""
+
+    extension = "xz"
+
+    def xz_options(self):
+        if self.threads == 1:
+            return "-{0}".format(self.level)
+        return "-{0} -T{1}".format(self.level, self.threads)
+
+    def writer(self, fileobj):
+        return ProcessWriter(["xz", "-c"] + self.xz_options().split(),
+                             fileobj)
+
+    def tar_command(self, path, directory, name):
+        return ("tar cJvf {0} -C {1} {2}".format(path, directory, name),
+                {"XZ_OPT": self.xz_options()})
+
+
+class ZstdCodec(Codec):
+
+    extension = "zst"
+
+    def zstd_args(self):
+        return ["zstd", "-q", "-c", "-{0}".format(self.level),
+                "-T{0}".format(self.threads)]
+
+    def writer(self, fileobj):
+        return ProcessWriter(self.zstd_args(), fileobj)
+
+    def tar_command(self, path, directory, name):
+        return ("tar -I '{0}' -cvf {1} -C {2} {3}".format(
+            " ".join(self.zstd_args()), path, directory, name), {})
+
+
+class GzipCodec(Codec):
+    """gzip implemented with zlib from the standard library"""
+
+    extension = "gz"
+
+    def writer(self, fileobj):
+        return GzipWriter(fileobj, self.level, self.threads)
+
+
+CODECS = {
+    "xz": XzCodec,
+    "zstd": ZstdCodec,
+    "gzip": GzipCodec,
+}
+
+
+def get_codec(name, level, threads=1):
+    """Returns compression backend by its name"""
+    try:
+        return CODECS[name](level, threads)
+    except KeyError:
+        raise ValueError("Unknown compression: {0}, supported are: {1}"
+                         "".format(name, ", ".join(sorted(CODECS))))
+
+
+def segments_dir(target):
+    """Returns directory where archive segments of the target are kept"""
+    return "{0}.parts".format(target)
+
+
+class Segment(object):
+    """Independently compressed part of the snapshot tarball
+
+    Tar members are compressed as soon as they are added, so nothing is
+    staged on the local disk. Segments are written without tar
+    end-of-archive marker, which allows them to be concatenated with the
+    compressed snapshot directory into a single valid tarball, see
+    prepend_segments().
+    """
+
+    def __init__(self, target, level, codec="xz", threads=1):
+        compressor = get_codec(codec, level, threads)
+        directory = segments_dir(target)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another worker in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        self.path = os.path.join(directory, "{0}.tar.{1}".format(
+            uuid.uuid4().hex, compressor.extension))
+        self.file = open(self.path, "wb")
+        self.writer = compressor.writer(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except CompressionError:
+            self.discard()
+            raise
+        if exc_type is not None:
+            # partially written member would break the whole tarball
+            self.discard()
+
+    def discard(self):
+        logger.error("Discarding incomplete archive segment %s", self.path)
+        os.remove(self.path)
+
+    def add(self, tarinfo, fileobj=None):
+        """Writes tar member with data read from fileobj"""
+        out = self.writer
+        out.write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+        if fileobj is not None and tarinfo.size:
+            tarfile.copyfileobj(fileobj, out, tarinfo.size)
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+            if remainder:
+                out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add_stream(self, fileobj, prefix, base="", exclude=()):
+        """Copies members of a tar stream into the segment
+
+        :param fileobj: file-like object with uncompressed tar stream
+        :param prefix: path which member names are prepended with
+        :param base: path inside the stream which exclude patterns are
+                     relative to
+        :param exclude: list of shell patterns of paths to skip
+        :returns: number of copied members
+        """
+        count = 0
+        stream = tarfile.open(fileobj=fileobj, mode="r|")
+        for member in stream:
+            if excluded(member.name, base, exclude):
+                logger.debug("Skipping excluded member: %s", member.name)
+                continue
+            data = stream.extractfile(member) if member.isreg() else None
+            member.name = os.path.join(prefix, member.name)
+            if member.islnk():
+                member.linkname = os.path.join(prefix, member.linkname)
+            self.add(member, data)
+            count += 1
+        return count
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
+
+
+def excluded(name, base, exclude):
+    relative = os.path.relpath(name, base.strip("/") or ".")
+    if relative == "." or relative.startswith(".."):
+        return False
+    # excluding a directory excludes everything inside it as well
+    parts = relative.split("/")
+    paths = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    return any(_match(path, pattern.lstrip("/"))
+               for pattern in exclude for path in paths)
+
+
+def _match(path, pattern):
+    """Matches the path as shell does, wildcards don't match '/'"""
+    names = path.split("/")
+    patterns = pattern.split("/")
+    return len(names) == len(patterns) and all(
+        fnmatch.fnmatch(name, part) for name, part in zip(names, patterns))
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root.rstrip("/") + "/")
+
+
+def extract_stream(fileobj, path):
+    """Extracts tar stream into the directory
+
+    Members which would be put outside of the directory are skipped, as
+    well as links pointing outside of it: the stream comes from other
+    hosts, so a symlink followed by a member inside it must not write
+    anywhere else.
+
+    :param fileobj: file-like object with uncompressed tar stream
+    :param path: directory to extract into
+    :returns: number of extracted members
+    """
+    count = 0
+    root = os.path.realpath(path)
+    stream = tarfile.open(fileobj=fileobj, mode="r|")
+    for member in stream:
+        name = os.path.normpath(member.name)
+        if os.path.isabs(name) or name.startswith(".."):
+            logger.warning("Skipping unsafe member: %s", member.name)
+            continue
+        # directories of the member may be symlinks extracted before
+        destination = os.path.realpath(os.path.join(root, name))
+        if member.issym():
+            link = os.path.join(os.path.dirname(destination),
+                                member.linkname)
+        elif member.islnk():
+            link = os.path.join(root, member.linkname)
+        else:
+            link = destination
+        if not (_inside(destination, root) and
+                _inside(os.path.realpath(link), root)):
+            logger.warning("Skipping member pointing outside of %s: %s",
+                           path, member.name)
+            continue
+        stream.extract(member, path)
+        count += 1
+    return count
+
+
+def prepend_segments(path, target):
+    """Puts segments of the target in front of the compressed archive
+
+    Concatenated compressed streams are decompressed as a single one, so
+    the result is a valid tarball as long as the end-of-archive marker
+    comes last.
+
+    :param path: path to the compressed snapshot directory
+    :param target: snapshot directory
+    """
+    directory = segments_dir(target)
+    if not os.path.isdir(directory):
+        return
+    logger.debug("Joining archive segments from %s", directory)
+    tail = "{0}.tail".format(path)
+    os.rename(path, tail)
+    with open(path, "wb") as out:
+        for name in sorted(os.listdir(directory)):
+            segment = os.path.join(directory, name)
+            with open(segment, "rb") as f:
+                shutil.copyfileobj(f, out)
+            os.remove(segment)
+        with open(tail, "rb") as f:
+            shutil.copyfileobj(f, out)
+    os.remove(tail)
+    os.rmdir(directory)
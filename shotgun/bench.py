@@ -0,0 +1,300 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmark of the snapshot pipeline
+
+Generates synthetic log trees for N hosts with M objects each and
+measures startup, snapshot, compression and report using local
+stand-in hosts: drivers keep host names, so objects are grouped, named
+and reported as for real hosts, but all commands and copies are run
+locally.
+
+Results are written as JSON, results of two runs (e.g. of two
+releases) can be compared with --compare:
+
+    python -m shotgun.bench --hosts 8 --objects 4 --output new.json \\
+        --compare old.json
+"""
+
+import argparse
+from collections import OrderedDict
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import shotgun
+from shotgun.config import Config
+from shotgun import driver
+from shotgun.manager import Manager
+from shotgun import settings
+
+
+# modules a command imports before it reads its config
+STARTUP_IMPORTS = "import shotgun.config, shotgun.manager"
+
+WORDS = ("error warning info debug request response connection timeout "
+         "node controller compute rabbitmq keystone nova neutron "
+         "started stopped failed retry").split()
+
+
+def make_log(path, size, rng):
+    """Writes log-like file of about the given size"""
+    written = 0
+    with open(path, "w") as f:
+        while written < size:
+            line = "2016-01-01 00:{0:02d}:{1:02d} {2}[{3}]: {4}\n".format(
+                rng.randint(0, 59), rng.randint(0, 59), rng.choice(WORDS),
+                rng.randint(1, 32768),
+                " ".join(rng.choice(WORDS) for _ in range(8)))
+            f.write(line)
+            written += len(line)
+
+
+def host_name(i):
+    return "bench-{0}".format(i)
+
+
+def make_trees(workdir, hosts, objects, files, file_size, seed=0):
+    """Creates log directories of all objects of all hosts
+
+    :returns: dict {host: [directory of every object]}
+    """
+    rng = random.Random(seed)
+    trees = OrderedDict()
+    for i in range(hosts):
+        host = host_name(i)
+        trees[host] = []
+        for j in range(objects):
+            directory = os.path.join(workdir, "hosts", host,
+                                     "log-{0}".format(j))
+            os.makedirs(directory)
+            for k in range(files):
+                make_log(os.path.join(directory, "file-{0}.log".format(k)),
+                         file_size, rng)
+            trees[host].append(directory)
+    return trees
+
+
+def make_config(workdir, trees, concurrency, compression):
+    """Returns snapshot config of the hosts
+
+    Every object directory is collected as a dir object and its first
+    file is also counted by a command object.
+    """
+    dump = OrderedDict()
+    for host, directories in trees.items():
+        objects = []
+        for directory in directories:
+            objects.append({"type": "dir", "path": directory})
+            objects.append({
+                "type": "command",
+                "command": "wc -l {0}".format(
+                    os.path.join(directory, "file-0.log")),
+                "to_file": "wc.txt",
+            })
+        dump[host] = {"hosts": [{"hostname": host}], "objects": objects}
+    return {
+        "target": os.path.join(workdir, "snapshots", "snapshot"),
+        "timestamp": False,
+        "lastdump": os.path.join(workdir, "lastdump"),
+        "manifest": os.path.join(workdir, "manifest.json"),
+        "compression": compression,
+        "concurrency": concurrency,
+        # stand-in hosts don't exist
+        "probe_timeout": 0,
+        "dump": dump,
+    }
+
+
+@contextlib.contextmanager
+def local_hosts():
+    """Makes drivers run everything locally keeping host names"""
+    get_driver = driver.Driver.__dict__["getDriver"]
+
+    def local_driver(cls, data, conf):
+        instance = get_driver.__func__(cls, data, conf)
+        instance.dest_host = None
+        return instance
+
+    driver.Driver.getDriver = classmethod(local_driver)
+    try:
+        yield
+    finally:
+        driver.Driver.getDriver = get_driver
+
+
+def summarize_drivers(records):
+    """Aggregates metrics records by object type"""
+    drivers = OrderedDict()
+    for record in sorted(records, key=lambda r: r["type"]):
+        stats = drivers.setdefault(record["type"], OrderedDict([
+            ("objects", 0), ("seconds", 0.0), ("bytes_written", 0)]))
+        stats["objects"] += 1
+        stats["seconds"] += record["seconds"]
+        stats["bytes_written"] += record.get("bytes_written", 0)
+    for stats in drivers.values():
+        stats["seconds"] = round(stats["seconds"], 3)
+        stats["seconds_per_object"] = round(
+            stats["seconds"] / stats["objects"], 4)
+    return drivers
+
+
+def timings(seconds):
+    seconds = sorted(seconds)
+    return OrderedDict([
+        ("runs", [round(s, 3) for s in seconds]),
+        ("best", round(seconds[0], 3)),
+        ("median", round(seconds[len(seconds) // 2], 3)),
+    ])
+
+
+def bench_startup(repeat):
+    """Measures start of a new process which imports shotgun"""
+    seconds = []
+    for _ in range(repeat):
+        started = time.time()
+        subprocess.check_call([sys.executable, "-c", STARTUP_IMPORTS])
+        seconds.append(time.time() - started)
+    return timings(seconds)
+
+
+def bench_snapshot(data, repeat):
+    seconds = []
+    for _ in range(repeat):
+        manager = Manager(Config(data))
+        started = time.time()
+        path = manager.snapshot()
+        seconds.append(time.time() - started)
+    result = timings(seconds)
+    # metrics of the last run
+    result["archive_bytes"] = os.path.getsize(path)
+    result["compression"] = manager.profile.compression
+    result["drivers"] = summarize_drivers(manager.profile.objects)
+    return result
+
+
+def bench_report(data, repeat):
+    data = dict(data, dump=OrderedDict(
+        (host, dict(role, objects=[o for o in role["objects"]
+                                   if o["type"] == "command"]))
+        for host, role in data["dump"].items()))
+    seconds = []
+    for _ in range(repeat):
+        started = time.time()
+        rows = list(Manager(Config(data)).report())
+        seconds.append(time.time() - started)
+    result = timings(seconds)
+    result["rows"] = len(rows)
+    return result
+
+
+def run(workdir, hosts=4, objects=4, files=10, file_size=64 * 1024,
+        concurrency=(1, 4), repeat=3, compression=settings.COMPRESSION):
+    """Runs all benchmarks and returns their results"""
+    params = OrderedDict([
+        ("hosts", hosts),
+        ("objects", objects),
+        ("files", files),
+        ("file_size", file_size),
+        ("concurrency", list(concurrency)),
+        ("repeat", repeat),
+        ("compression", compression),
+    ])
+    trees = make_trees(workdir, hosts, objects, files, file_size)
+    results = OrderedDict()
+    results["startup"] = bench_startup(repeat)
+    with local_hosts():
+        for value in concurrency:
+            data = make_config(workdir, trees, value, compression)
+            results["snapshot concurrency={0}".format(value)] = (
+                bench_snapshot(data, repeat))
+            results["report concurrency={0}".format(value)] = (
+                bench_report(data, repeat))
+    return OrderedDict([
+        ("version", shotgun.__version__),
+        ("python", platform.python_version()),
+        ("params", params),
+        ("results", results),
+    ])
+
+
+def compare(old, new):
+    """Returns lines comparing best times of benchmarks of two runs"""
+    lines = []
+    if old["params"] != new["params"]:
+        lines.append("Warning: benchmarks were run with different "
+                     "parameters")
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        before = old["results"][name]["best"]
+        after = result["best"]
+        change = (after - before) / before * 100 if before else 0.0
+        lines.append("{0}: {1:.3f}s -> {2:.3f}s ({3:+.1f}%)".format(
+            name, before, after, change))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the snapshot pipeline")
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--objects", type=int, default=4,
+                        help="Number of log directories of every host")
+    parser.add_argument("--files", type=int, default=10,
+                        help="Number of files in every log directory")
+    parser.add_argument("--file-size", type=int, default=64 * 1024,
+                        help="Size of every log file in bytes")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 4])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--compression", default=settings.COMPRESSION)
+    parser.add_argument("--workdir",
+                        help="Directory for generated data, "
+                             "a temporary one by default")
+    parser.add_argument("--output", help="Path to write results to")
+    parser.add_argument("--compare",
+                        help="Path to results of a previous run")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="shotgun-bench-")
+    try:
+        results = run(workdir, args.hosts, args.objects, args.files,
+                      args.file_size, args.concurrency, args.repeat,
+                      args.compression)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        sys.stdout.write("\n".join(compare(old, results)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import OrderedDict
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class CommandCache(object):
+    """Results of commands which were already run during the snapshot
+
+    The same diagnostic commands are often listed for several objects
+    of a host, the cache lets them run only once. Results are keyed by
+    (host, command) and take no more than max_size bytes of output in
+    total, the least recently used ones are dropped first. max_size 0
+    disables the cache.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        # (host, command) -> CommandOut, least recently used first
+        self.results = OrderedDict()
+
+    @staticmethod
+    def _size(out):
+        return len(out.stdout or '') + len(out.stderr or '')
+
+    def get(self, host, command):
+        """Returns cached result of the command or None"""
+        out = self.results.pop((host, command), None)
+        if out is not None:
+            logger.debug("Using cached result of command: host: %s "
+                         "command: %s", host, command)
+            self.results[(host, command)] = out
+        return out
+
+    def put(self, host, command, out):
+        size = self._size(out)
+        if not self.max_size or size > self.max_size:
+            return
+        self.discard(host, command)
+        while self.results and self.size + size > self.max_size:
+            _, dropped = self.results.popitem(last=False)
+            self.size -= self._size(dropped)
+        self.results[(host, command)] = out
+        self.size += size
+
+    def discard(self, host, command):
+        out = self.results.pop((host, command), None)
+        if out is not None:
+            self.size -= self._size(out)
+
+
+# cache of the current run, disabled until configure() is called
+cache = CommandCache()
+
+
+def configure(conf):
+    """Starts an empty cache of the size given by the config"""
+    global cache
+    cache = CommandCache(conf.command_cache_size)
@@ -22,8 +22,8 @@ import warnings
 from shotgun.logger import configure_logger
 configure_logger()
 
-from shotgun.config import Config
 from shotgun.manager import Manager
+from shotgun import plan
 
 
 logger = logging.getLogger(__name__)
@@ -44,24 +44,12 @@ def parse_args():
     return parser.parse_args()
 
 
-def read_config(config_path):
-    """Reads config
-
-    :param config_path: path to configuration file
-    :returns: dict with configuration data
-    """
-    with open(config_path, "r") as fo:
-        config = json.loads(fo.read())
-
-    return config
-
-
 def make_snapshot(args):
     """Generates snapshot
 
     :param args: argparse object
     """
-    config_object = Config(read_config(args.config))
+    config_object = plan.load(args.config, json.loads).config()
     manager = Manager(config_object)
     snapshot_path = manager.snapshot()
     logger.info(u'Snapshot path: {0}'.format(snapshot_path))
@@ -15,7 +15,6 @@
 #    under the License.
 
 import logging
-import yaml
 
 from cliff.app import App
 from cliff.command import Command
@@ -23,9 +22,13 @@ from cliff.commandmanager import CommandManager
 from cliff.lister import Lister
 
 import shotgun
-from shotgun.config import Config
+from shotgun import incremental
+from shotgun import lazy
 from shotgun.logger import configure_logger
 from shotgun.manager import Manager
+from shotgun import plan
+
+yaml = lazy.LazyModule("yaml")
 
 
 logger = logging.getLogger(__name__)
@@ -33,8 +36,7 @@ logger = logging.getLogger(__name__)
 
 class Base(object):
     def initialize_cmd(self, parsed_args):
-        with open(parsed_args.config, "r") as f:
-            self.config = Config(yaml.safe_load(f))
+        self.config = plan.load(parsed_args.config, yaml.safe_load).config()
         self.manager = Manager(self.config)
 
 
@@ -46,6 +48,10 @@ class SnapshotCommand(Command, Base):
             '--config',
             required=True,
             help='Path to snapshot config file')
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            help='Show the slowest objects and hosts of the snapshot')
         return parser
 
     def take_action(self, parsed_args):
@@ -56,6 +62,8 @@ class SnapshotCommand(Command, Base):
         self.initialize_cmd(parsed_args)
         snapshot_path = self.manager.snapshot()
         logger.info(u'Snapshot path: {0}'.format(snapshot_path))
+        if parsed_args.profile:
+            self.app.stdout.write(self.manager.profile.summary() + "\n")
 
 
 class ReportCommand(Lister, Base):
@@ -68,14 +76,65 @@ class ReportCommand(Lister, Base):
             '--config',
             default='/etc/shotgun/report.yaml',
             help='Path to report config file')
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            help='Seconds the whole report may take')
         return parser
 
     def take_action(self, parsed_args):
         self.initialize_cmd(parsed_args)
-        data = [line for line in self.manager.report()]
+        # rows are handed to the formatter as soon as they are gathered
+        data = self.manager.report(timeout=parsed_args.timeout)
         return (self.columns, data)
 
 
+class PlanCommand(Lister):
+    """Shows objects of the config or changes of them against another one"""
+
+    def get_parser(self, prog_name):
+        parser = super(PlanCommand, self).get_parser(prog_name)
+        parser.add_argument(
+            '--config',
+            required=True,
+            help='Path to snapshot config file')
+        parser.add_argument(
+            '--diff',
+            metavar='OLD_CONFIG',
+            help='Show objects removed or added since this config')
+        return parser
+
+    def take_action(self, parsed_args):
+        new = plan.load(parsed_args.config, yaml.safe_load)
+        if not parsed_args.diff:
+            return (['Host', 'Type', 'Object'], new.objects())
+        old = plan.load(parsed_args.diff, yaml.safe_load)
+        return (['Change', 'Host', 'Type', 'Object'], plan.diff(old, new))
+
+
+class RestoreCommand(Command):
+
+    def get_parser(self, prog_name):
+        parser = super(RestoreCommand, self).get_parser(prog_name)
+        parser.add_argument(
+            'archives',
+            nargs='+',
+            help='Snapshot archives, the oldest first')
+        parser.add_argument(
+            '--output',
+            required=True,
+            help='Directory to restore files of hosts into')
+        return parser
+
+    def take_action(self, parsed_args):
+        """Rebuilds full view of incremental snapshots
+
+        :param parsed_args: argparse object
+        """
+        incremental.restore(parsed_args.archives, parsed_args.output)
+        logger.info(u'Restored into: {0}'.format(parsed_args.output))
+
+
 def main(argv=None):
     configure_logger()
     return App(
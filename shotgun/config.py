@@ -13,32 +13,223 @@
 #    under the License.
 
 from collections import deque
-import copy
+import itertools
 import logging
 import time
 
 import six
 
+from shotgun import retry
+from shotgun import scheduler
 from shotgun import settings
 
 
 logger = logging.getLogger(__name__)
 
 
+class Binding(object):
+    """Object template bound to a host"""
+
+    __slots__ = ("template", "host")
+
+    def __init__(self, template, host):
+        self.template = template
+        self.host = host
+
+    def to_dict(self):
+        obj = dict(self.template)
+        obj["host"] = self.host
+        return obj
+
+
+class ObjectQueue(object):
+    """Queue of objects to process which expands host bindings lazily
+
+    Objects of a role are kept as templates shared by all its hosts, a
+    dict of the object is made only when it is taken from the queue, so
+    the size of the queue doesn't depend on the number of hosts. Objects
+    put into the queue, e.g. the ones to retry, are kept as dicts and are
+    taken before the templates.
+
+    :param objs: dicts of objects
+    :param templates: list of (template, hosts), every template is bound
+                      to all its hosts in order
+    """
+
+    def __init__(self, objs=(), templates=()):
+        self.objs = deque(objs)
+        self.templates = deque(templates)
+        # number of hosts of the first template which are already taken
+        self.position = 0
+        # unreachable hosts whose bindings are skipped, see set_offline()
+        self.offline = set()
+        # unreachable hosts which keep a binding processed as offline
+        self.offline_left = set()
+
+    def bindings(self):
+        """Generator of bindings which are left in the queue"""
+        offline_left = set(self.offline_left)
+        for index, (template, hosts) in enumerate(self.templates):
+            start = self.position if index == 0 else 0
+            for host in itertools.islice(hosts, start, None):
+                binding = self._bind(template, host, offline_left)
+                if binding is not None:
+                    yield binding
+
+    def _skipped(self, host, offline_left):
+        if not self.offline:
+            return False
+        address = Config.get_network_address({"host": host})
+        return address in self.offline and address not in offline_left
+
+    def _bind(self, template, host, offline_left):
+        """Returns binding of the template or None if it's skipped"""
+        if self._skipped(host, offline_left):
+            return None
+        if offline_left:
+            address = Config.get_network_address({"host": host})
+            if address in offline_left:
+                offline_left.discard(address)
+                template = dict(template, type='offline')
+        return Binding(template, host)
+
+    def _advance(self):
+        template, hosts = self.templates[0]
+        host = hosts[self.position]
+        self.position += 1
+        if self.position >= len(hosts):
+            self.templates.popleft()
+            self.position = 0
+        return template, host
+
+    def _next_binding(self):
+        while self.templates:
+            template, host = self._advance()
+            binding = self._bind(template, host, self.offline_left)
+            if binding is not None:
+                return binding
+        return None
+
+    def hosts(self):
+        """Generator of hosts of objects left in the queue"""
+        for obj in self.objs:
+            yield obj["host"]
+        for binding in self.bindings():
+            yield binding.host
+
+    def set_offline(self, hosts):
+        """Keeps only one object of the hosts and makes it offline one."""
+        objs = deque()
+        seen = set()
+        for obj in self.objs:
+            host = Config.get_network_address(obj)
+            if host not in hosts:
+                objs.append(obj)
+            elif host not in seen:
+                obj["type"] = 'offline'
+                seen.add(host)
+                objs.append(obj)
+        self.objs = objs
+        self.offline.update(hosts)
+        self.offline_left.update(set(hosts) - seen)
+
+    def popleft(self):
+        if self.objs:
+            return self.objs.popleft()
+        binding = self._next_binding()
+        if binding is None:
+            raise IndexError("pop from an empty queue")
+        return binding.to_dict()
+
+    def append(self, obj):
+        """Puts the object after all objects of the queue"""
+        binding = self._next_binding()
+        while binding is not None:
+            self.objs.append(binding.to_dict())
+            binding = self._next_binding()
+        self.objs.append(obj)
+
+    def appendleft(self, obj):
+        self.objs.appendleft(obj)
+
+    def clear(self):
+        self.objs.clear()
+        self.templates.clear()
+        self.position = 0
+
+    def __iter__(self):
+        for obj in self.objs:
+            yield obj
+        for binding in self.bindings():
+            yield binding.to_dict()
+
+    def __len__(self):
+        return len(self.objs) + sum(1 for _ in self.bindings())
+
+    def __nonzero__(self):
+        # skipped bindings are dropped, so the first one left is taken
+        while self.templates:
+            _, hosts = self.templates[0]
+            if not self._skipped(hosts[self.position], self.offline_left):
+                break
+            self._advance()
+        return bool(self.objs or self.templates)
+
+
+def compile_templates(data):
+    """Returns object templates of the config data for ObjectQueue"""
+    # default limits of file objects, see shotgun.driver.File
+    limits = data.get('limits', {})
+    templates = []
+    for properties in six.itervalues(data.get('dump', {})):
+        hosts = properties.get('hosts') or [{}]
+        for obj in properties.get('objects', []):
+            template = dict(obj)
+            if template.get('type') in ('file', 'dir'):
+                for key, value in six.iteritems(limits):
+                    template.setdefault(key, value)
+            templates.append((template, hosts))
+    # the most important objects are collected first, see deadline
+    templates.sort(key=lambda t: scheduler.sort_key(t[0]))
+    return templates
+
+
 class Config(object):
-    def __init__(self, data=None):
+    """Config of a snapshot or report
+
+    :param data: dict of the config
+    :param templates: object templates compiled from data before, see
+                      compile_templates() and shotgun.plan
+    """
+
+    def __init__(self, data=None, templates=None):
         self.data = data or {}
         self.time = time.localtime()
+        # hosts which failed and whose objects weren't retried yet
         self.offline_hosts = set()
-        self.objs = deque()
+        self.retries = retry.HostRetries(
+            self.attempts, self.retry_backoff, self.retry_backoff_max)
         self.try_again = deque()
-        for properties in six.itervalues(self.data.get('dump', {})):
-            hosts = properties.get('hosts') or [{}]
-            for obj in properties.get('objects', []):
-                for h in hosts:
-                    obj_new = copy.deepcopy(obj)
-                    obj_new['host'] = h
-                    self.objs.append(obj_new)
+        if templates is None:
+            templates = compile_templates(self.data)
+        self.objs = ObjectQueue(templates=templates)
+
+    @property
+    def objs(self):
+        """Objects left to process, see ObjectQueue"""
+        return self._objs
+
+    @objs.setter
+    def objs(self, objs):
+        if not isinstance(objs, ObjectQueue):
+            objs = ObjectQueue(objs)
+        self._objs = objs
+
+    @property
+    def hosts(self):
+        """Network addresses of hosts of objects left to process"""
+        return set(filter(None, (self.get_network_address({"host": host})
+                                 for host in self.objs.hosts())))
 
     def _timestamp(self, name):
         return "{0}-{1}".format(
@@ -53,6 +244,11 @@ class Config(object):
             target = self._timestamp(target)
         return target
 
+    @property
+    def compression(self):
+        """Name of compression backend, see shotgun.archive.CODECS."""
+        return self.data.get("compression", settings.COMPRESSION)
+
     @property
     def compression_level(self):
         level = self.data.get("compression_level")
@@ -61,52 +257,204 @@ class Config(object):
                 'Compression level is not specified,'
                 ' Default %s will be used', settings.COMPRESSION_LEVEL)
 
-        level = settings.COMPRESSION_LEVEL
+            level = settings.COMPRESSION_LEVEL
 
         return '-{level}'.format(level=level)
 
+    @property
+    def compression_threads(self):
+        """Number of compression threads, 0 means number of CPUs."""
+        return self.data.get("compression_threads",
+                             settings.COMPRESSION_THREADS)
+
+    @property
+    def dedup(self):
+        """Whether identical files are stored in the archive once."""
+        return self.data.get("dedup", settings.DEDUP)
+
+    @property
+    def keep_target(self):
+        """Whether the snapshot directory is kept after compression."""
+        return self.data.get("keep_target", False)
+
     @property
     def lastdump(self):
         return self.data.get("lastdump", settings.LASTDUMP)
 
+    @property
+    def manifest(self):
+        """Manifest of incremental objects of the last snapshot."""
+        return self.data.get("manifest", settings.MANIFEST)
+
     @staticmethod
     def get_network_address(obj):
         """Returns network address of object."""
         return obj['host'].get('address') or obj['host'].get('hostname')
 
     def on_network_error(self, obj):
-        """Lets the object to have another attempt for being proccessed."""
+        """Lets the object to have another attempt for being proccessed.
+
+        Objects of the host are retried after a delay, see
+        shotgun.retry. When the host fails too many times, the object is
+        processed as offline one and the rest of objects of the host are
+        skipped.
+        """
         host = self.get_network_address(obj)
+        if self.retries.is_open(host):
+            logger.debug("Skipping offline object processing: %s", obj)
+            return
         logger.debug("Remote host %s is unreachable. "
                      "Processing of its objects postponed.", host)
-        self.try_again.append(obj)
-        self.offline_hosts.add(host)
+        if host in self.offline_hosts:
+            # failure of this attempt of the host is already counted
+            self.try_again.append(obj)
+        elif self.retries.failed(host):
+            obj["type"] = 'offline'
+            self.objs.appendleft(obj)
+        else:
+            self.offline_hosts.add(host)
+            self.try_again.append(obj)
+
+    def set_offline(self, hosts):
+        """Makes objects of the hosts be processed as offline ones.
+
+        Only one object per host is kept, as objects() does for hosts
+        which were unreachable on every attempt.
+        """
+        for host in hosts:
+            logger.debug("Remote host %s is unreachable, it is "
+                         "processed as offline one.", host)
+        self.objs.set_offline(hosts)
 
     @property
     def objects(self):
         """Stateful generator for processing objects.
 
         It should be used in conjunction with on_network_error() to give
-        another try for objects which threw NetworkError.
+        another try for objects which threw NetworkError. Objects of a
+        host which failed are postponed until its retry time, objects of
+        other hosts are processed meanwhile.
         """
-        for _ in range(settings.ATTEMPTS):
-            while self.objs:
-                obj = self.objs.popleft()
-                if self.get_network_address(obj) not in self.offline_hosts:
-                    yield obj
-                else:
-                    self.try_again.append(obj)
-            self.offline_hosts.clear()
-            self.objs, self.try_again = self.try_again, deque()
+        return self.iter_objects()
 
-        for obj in self.objs:
-            obj["type"] = 'offline'
+    def iter_objects(self, wait=True):
+        """Generator of objects() which may leave postponed objects
+
+        :param wait: whether to wait until postponed objects may be
+                     retried; otherwise the generator stops when only
+                     objects which can't be retried yet are left, see
+                     retry_delay and wait_retry()
+        """
+        while self.objs or self.try_again:
+            if not self.objs:
+                if not wait and self.retry_delay:
+                    return
+                self._next_pass()
+                continue
+            obj = self.objs.popleft()
             host = self.get_network_address(obj)
-            if host not in self.offline_hosts:
-                self.offline_hosts.add(host)
+            if obj.get("type") == 'offline':
                 yield obj
-            else:
+            elif self.retries.is_open(host):
                 logger.debug("Skipping offline object processing: %s", obj)
+            elif self.retries.delay(host):
+                self.try_again.append(obj)
+            else:
+                self.offline_hosts.discard(host)
+                yield obj
+
+    def _postponed_hosts(self):
+        return set(self.get_network_address(obj) for obj in self.try_again)
+
+    @property
+    def retry_delay(self):
+        """Seconds until any of postponed objects may be retried."""
+        return min([self.retries.delay(host)
+                    for host in self._postponed_hosts()] or [0])
+
+    def wait_retry(self):
+        """Waits until any of postponed objects may be retried."""
+        self.retries.wait(self._postponed_hosts())
+
+    def _next_pass(self):
+        """Moves postponed objects which may be retried now to objs."""
+        self.wait_retry()
+        objs, self.try_again = self.try_again, deque()
+        for obj in objs:
+            if self.retries.delay(self.get_network_address(obj)):
+                self.try_again.append(obj)
+            else:
+                self.objs.append(obj)
+
+    @property
+    def pass_completed(self):
+        """Whether objects() has yielded the last object of a pass.
+
+        Consumers which process objects asynchronously should start
+        processing of the pass then. Objects which are reported via
+        on_network_error() after objects() is exhausted are retried when
+        it is iterated again.
+        """
+        return not self.objs
+
+    @property
+    def attempts(self):
+        """Number of network errors after which host is offline."""
+        return self.data.get("attempts", settings.ATTEMPTS)
+
+    @property
+    def retry_backoff(self):
+        """Seconds before the first retry of objects of a host."""
+        return self.data.get("retry_backoff", settings.RETRY_BACKOFF)
+
+    @property
+    def retry_backoff_max(self):
+        """Maximum seconds before retrying objects of a host."""
+        return self.data.get("retry_backoff_max",
+                             settings.RETRY_BACKOFF_MAX)
+
+    @property
+    def deadline(self):
+        """Seconds for collecting all objects, None means unlimited."""
+        return self.data.get("deadline", settings.DEADLINE)
+
+    @property
+    def max_snapshot_bytes(self):
+        """Bytes of files of all objects, None means unlimited."""
+        return self.data.get("max_snapshot_bytes",
+                             settings.MAX_SNAPSHOT_BYTES)
+
+    @property
+    def concurrency(self):
+        """Number of hosts which are processed simultaneously."""
+        return self.data.get("concurrency", settings.CONCURRENCY)
+
+    @property
+    def host_concurrency(self):
+        """Number of objects of a host which are reported simultaneously."""
+        return self.data.get("host_concurrency", settings.HOST_CONCURRENCY)
+
+    @property
+    def probe_timeout(self):
+        """Timeout of checking that hosts are reachable, 0 disables it."""
+        return self.data.get("probe_timeout", settings.PROBE_TIMEOUT)
+
+    @property
+    def max_connections(self):
+        """Maximum number of SSH connections opened simultaneously."""
+        return self.data.get("max_connections", settings.MAX_CONNECTIONS)
+
+    @property
+    def connection_idle_timeout(self):
+        """Seconds after which unused SSH connection is closed."""
+        return self.data.get("connection_idle_timeout",
+                             settings.CONNECTION_IDLE_TIMEOUT)
+
+    @property
+    def command_cache_size(self):
+        """Bytes of command output which are kept for reuse."""
+        return self.data.get("command_cache_size",
+                             settings.COMMAND_CACHE_SIZE)
 
     @property
     def timeout(self):
@@ -0,0 +1,149 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import OrderedDict
+import logging
+from multiprocessing.pool import ThreadPool
+import socket
+import sys
+import time
+
+from shotgun import lazy
+from shotgun import settings
+
+fabric = lazy.LazyModule("fabric", "state")
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Keeps track of SSH connections opened by fabric
+
+    Fabric caches connections in fabric.state.connections by host string,
+    but it never closes them and doesn't take ssh keys into account. The
+    pool makes connections shared by all drivers of a process, closes
+    connections which haven't been used for idle_timeout seconds and keeps
+    no more than max_size connections opened, closing the least recently
+    used ones first.
+
+    Connections are keyed by (host, ssh_key). Fabric can hold only one
+    connection per host, so using another key for the same host closes
+    the previous connection.
+    """
+
+    def __init__(self, max_size=settings.MAX_CONNECTIONS,
+                 idle_timeout=settings.CONNECTION_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # (host, ssh_key) -> time of the last usage, oldest first
+        self.last_used = OrderedDict()
+
+    def acquire(self, host, ssh_key=None):
+        """Marks connection to the host as being used
+
+        Should be called inside fabric.api.settings() context for the host
+        right before running anything on it. The connection itself is
+        opened by fabric on demand.
+        """
+        key = (host, ssh_key)
+        now = time.time()
+        for used_key, used_at in list(self.last_used.items()):
+            if used_key == key:
+                continue
+            if used_key[0] == host:
+                logger.debug("SSH key changed, reconnecting to %s", host)
+                self.release(used_key)
+            elif now - used_at > self.idle_timeout:
+                logger.debug("Closing idle connection to %s", used_key[0])
+                self.release(used_key)
+
+        self.last_used.pop(key, None)
+        while self.last_used and len(self.last_used) >= self.max_size:
+            lru_key = next(iter(self.last_used))
+            logger.debug("Too many connections, closing connection to %s",
+                         lru_key[0])
+            self.release(lru_key)
+        self.last_used[key] = now
+
+    def release(self, key):
+        """Closes connection of the given (host, ssh_key) pair"""
+        self.last_used.pop(key, None)
+        host = key[0]
+        if host in fabric.state.connections:
+            fabric.state.connections[host].close()
+            del fabric.state.connections[host]
+
+    def close_all(self):
+        """Closes all connections of the pool"""
+        for key in list(self.last_used):
+            self.release(key)
+
+    @staticmethod
+    def forget_inherited():
+        """Drops connections inherited from the parent process
+
+        Forked processes must not use sockets of their parent, so they
+        have to start with an empty fabric cache. Nothing is inherited if
+        the parent hasn't imported fabric.
+        """
+        if "fabric.state" in sys.modules:
+            dict.clear(fabric.state.connections)
+
+
+# pool shared by all drivers of the current process
+pool = ConnectionPool()
+
+
+def configure(conf):
+    """Replaces the shared pool with one set up according to the config"""
+    global pool
+    pool = ConnectionPool(conf.max_connections, conf.connection_idle_timeout)
+
+
+def _reachable(args):
+    host, port, timeout = args
+    # fabric host strings may set the port as host:port
+    address, _, host_port = host.rpartition(":")
+    if address and host_port.isdigit() and ":" not in address:
+        host, port = address, int(host_port)
+    try:
+        socket.create_connection((host, port), timeout).close()
+        return True
+    except (socket.error, socket.timeout) as e:
+        logger.debug("Host %s is unreachable: %s", host, e)
+        return False
+
+
+def probe(hosts, timeout, port=22, max_workers=50):
+    """Checks which hosts accept connections to the SSH port
+
+    All hosts are probed simultaneously, so it takes no longer than
+    timeout seconds for unreachable ones. Hosts are connected directly,
+    so hosts reached through an SSH gateway or proxy can't be probed.
+
+    :param port: SSH port of hosts which don't set it as host:port
+    :returns: set of unreachable hosts
+    """
+    hosts = sorted(hosts)
+    if not hosts:
+        return set()
+    pool = ThreadPool(min(len(hosts), max_workers))
+    try:
+        results = pool.map(_reachable,
+                           [(host, port, timeout) for host in hosts])
+    finally:
+        pool.close()
+        pool.join()
+    return set(host for host, ok in zip(hosts, results) if not ok)
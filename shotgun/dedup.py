@@ -0,0 +1,128 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Deduplication of identical files collected from different hosts
+
+The same object is collected from every host, so configuration files
+and command outputs are often identical on all of them. Identical files
+of the snapshot directory are replaced with hard links to a single copy,
+which tar stores as links without data, so the archive and the time of
+its compression depend on unique content only.
+"""
+
+from collections import defaultdict
+from collections import OrderedDict
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# number of files hashed simultaneously, hashlib releases GIL
+HASH_WORKERS = 4
+
+
+def _digest(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except (IOError, OSError) as e:
+        logger.error("Failed to read %s: %s", path, e)
+        return None
+    return digest.hexdigest()
+
+
+def _candidates(target, min_size):
+    """Returns lists of paths of files having the same size
+
+    Files which are already hard links of each other are listed once.
+    """
+    sizes = defaultdict(list)
+    inodes = set()
+    for root, _, filenames in os.walk(target):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            info = os.lstat(path)
+            if not stat.S_ISREG(info.st_mode) or info.st_size < min_size:
+                continue
+            if (info.st_dev, info.st_ino) in inodes:
+                continue
+            inodes.add((info.st_dev, info.st_ino))
+            sizes[info.st_size].append(path)
+    return [paths for paths in sizes.values() if len(paths) > 1]
+
+
+def _link(source, path):
+    """Replaces the file at path with hard link of source"""
+    temp = "{0}.dedup".format(path)
+    os.link(source, temp)
+    os.rename(temp, path)
+
+
+def link_duplicates(target, min_size=1, workers=HASH_WORKERS):
+    """Replaces identical files under target with hard links
+
+    Only files of the same size are hashed, so unique files are never
+    read. Links share metadata, so only files with the same mode, owner
+    and mtime are linked.
+
+    :param min_size: smaller files are left as they are
+    :returns: dict with numbers of linked files and saved bytes
+    """
+    groups = _candidates(target, min_size)
+    paths = sorted(path for group in groups for path in group)
+    if len(paths) > 1 and workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            digests = pool.map(_digest, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        digests = [_digest(path) for path in paths]
+
+    result = OrderedDict([("files", 0), ("bytes", 0)])
+    blobs = {}
+    for path, digest in zip(paths, digests):
+        if digest is None:
+            continue
+        try:
+            info = os.lstat(path)
+        except OSError as e:
+            logger.error("Failed to stat %s: %s", path, e)
+            continue
+        # linked files get metadata of the source, tar keeps whole
+        # seconds of mtime only
+        key = (digest, info.st_mode, info.st_uid, info.st_gid,
+               int(info.st_mtime))
+        source = blobs.setdefault(key, path)
+        if source == path:
+            continue
+        try:
+            size = info.st_size
+            _link(source, path)
+        except OSError as e:
+            logger.error("Failed to link %s to %s: %s", path, source, e)
+            continue
+        result["files"] += 1
+        result["bytes"] += size
+    logger.info("Replaced %(files)s duplicate files with hard links, "
+                "%(bytes)s bytes saved", result)
+    return result
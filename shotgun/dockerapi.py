@@ -0,0 +1,171 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Minimal client of the Docker Engine API
+
+Talks HTTP to the docker daemon over its unix socket, so containers are
+inspected without running docker CLI. Every request uses its own
+connection, which is cheap for a unix socket and lets the client be used
+from several threads.
+"""
+
+import contextlib
+import httplib
+import json
+import logging
+import socket
+import struct
+import urllib
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+
+# stream types of multiplexed output of exec
+STDOUT = 1
+STDERR = 2
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super(APIError, self).__init__(
+            "Docker API error {0}: {1}".format(status, message))
+        self.status = status
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a unix socket"""
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.socket_timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def _read_exactly(fileobj, size):
+    data = []
+    while size:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        data.append(chunk)
+        size -= len(chunk)
+    return "".join(data)
+
+
+def demux(fileobj):
+    """Splits multiplexed output of exec
+
+    Every frame of the output starts with 8 bytes header: stream type,
+    3 zero bytes and big endian size of the frame.
+
+    :returns: iterator of (stream type, data)
+    """
+    while True:
+        header = _read_exactly(fileobj, 8)
+        if len(header) < 8:
+            return
+        stream, size = struct.unpack(">BxxxL", header)
+        yield stream, _read_exactly(fileobj, size)
+
+
+class Client(object):
+    """Client of the docker daemon listening on the unix socket
+
+    :param socket_path: path of the socket, remote daemons can be reached
+                        through a forwarded one
+    :param timeout: timeout of socket operations in seconds
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    @contextlib.contextmanager
+    def request(self, method, path, body=None, query=None):
+        """Sends request yielding the response to read
+
+        :raises: APIError if the daemon responds with an error
+        """
+        if query:
+            path = "{0}?{1}".format(path, urllib.urlencode(query))
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        logger.debug("Docker API request: %s %s", method, path)
+        connection = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise APIError(response.status, response.read().strip())
+            yield response
+        finally:
+            connection.close()
+
+    def _json(self, method, path, body=None, query=None):
+        with self.request(method, path, body, query) as response:
+            data = response.read()
+        return json.loads(data) if data else None
+
+    def containers(self):
+        """Returns running containers as list of dicts"""
+        return self._json("GET", "/containers/json")
+
+    def exec_create(self, container, cmd):
+        """Creates exec instance of the command, returns its id
+
+        :param cmd: list of program arguments
+        """
+        return self._json(
+            "POST", "/containers/{0}/exec".format(container),
+            {"AttachStdout": True, "AttachStderr": True, "Cmd": cmd})["Id"]
+
+    @contextlib.contextmanager
+    def exec_start(self, exec_id):
+        """Starts the exec instance yielding its multiplexed output"""
+        with self.request("POST", "/exec/{0}/start".format(exec_id),
+                          {"Detach": False, "Tty": False}) as response:
+            yield response
+
+    def exec_inspect(self, exec_id):
+        return self._json("GET", "/exec/{0}/json".format(exec_id))
+
+    def execute(self, container, cmd):
+        """Runs the command in the container
+
+        :returns: tuple (exit code, stdout, stderr)
+        """
+        exec_id = self.exec_create(container, cmd)
+        output = {STDOUT: [], STDERR: []}
+        with self.exec_start(exec_id) as response:
+            for stream, data in demux(response):
+                output.get(stream, output[STDERR]).append(data)
+        return (self.exec_inspect(exec_id).get("ExitCode"),
+                "".join(output[STDOUT]), "".join(output[STDERR]))
+
+    @contextlib.contextmanager
+    def get_archive(self, container, path):
+        """Yields tar stream of the path in the container"""
+        with self.request("GET", "/containers/{0}/archive".format(container),
+                          query={"path": path}) as response:
+            yield response
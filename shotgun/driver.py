@@ -12,22 +12,42 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import itertools
+import json
 import logging
+import math
+from multiprocessing.pool import ThreadPool
 import os
-import pprint
+import pipes
 import pwd
 import re
+import shutil
 import socket
 import stat
+import StringIO
 import sys
-import xmlrpclib
-
-import fabric.api
-import fabric.exceptions
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
 
+from shotgun import archive
+from shotgun import cache
+from shotgun import connections
+from shotgun import fs
+from shotgun import incremental
+from shotgun import lazy
+from shotgun import metrics
+from shotgun import settings
 from shotgun import utils
 
+# imported when used by drivers, see shotgun.lazy
+dockerapi = lazy.LazyModule("shotgun.dockerapi")
+fabric = lazy.LazyModule("fabric", "api", "exceptions", "state")
+xmlrpclib = lazy.LazyModule("xmlrpclib")
+
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +71,9 @@ class Driver(object):
 
     default_report_message = 'Reporting is not implemented for the driver.'
 
+    # bytes read from remote command output at once
+    chunk_size = 64 * 1024
+
     @classmethod
     def getDriver(cls, data, conf):
         driver_type = data["type"]
@@ -87,27 +110,78 @@ class Driver(object):
 
         self.conf = conf
         self.timeout = data.get("timeout", self.conf.timeout)
+        self.local_timeout = data.get("timeout")
+        # copy output of remote commands to stdout
+        self.echo = data.get("echo", False)
+        # bytes of output of remote commands kept in memory
+        self.max_output = data.get("max_output", settings.MAX_OUTPUT_SIZE)
+        self.metrics = metrics.new_counters()
 
     def snapshot(self):
         raise NotImplementedError
 
+    def _connect(self):
+        """Opens connection to the host unless it is already opened
+
+        Should be called inside fabric.api.settings() context for the host.
+        """
+        connections.pool.acquire(self.dest_host, self.ssh_key)
+        if self.dest_host not in fabric.state.connections:
+            started = time.time()
+            fabric.state.connections.connect(self.dest_host)
+            self.metrics["connect_seconds"] += time.time() - started
+
+    def _open_connection(self):
+        """Opens connection to the host with settings of the driver
+
+        Channels of the connection can be used from several threads at
+        once then, see _channel_to_file(), fabric settings can't.
+        """
+        with fabric.api.settings(
+            host_string=self.dest_host,  # destination host
+            key_filename=self.ssh_key,    # a path to ssh key
+            timeout=2,                    # connection timeout
+            abort_on_prompts=True,        # non-interactive mode
+        ):
+            self._connect()
+
     def report(self):
         """Should be generator"""
         yield (self.host,
                'Driver: {0}'.format(self.__class__.__name__),
                self.default_report_message)
 
-    def command(self, command):
+    def command(self, command, timeout=None, cacheable=False):
+        """Runs the command on the host of the driver
+
+        :param cacheable: whether result of the same command which was
+                          already run on the host during the current run
+                          can be reused, see shotgun.cache
+        """
+        if cacheable:
+            out = cache.cache.get(self.dest_host, command)
+            if out is not None:
+                return out
+        out = self._command(command, timeout)
+        # return code is unknown when running failed unexpectedly
+        if cacheable and out.return_code is not None:
+            cache.cache.put(self.dest_host, command, out)
+        return out
+
+    def _command(self, command, timeout=None):
         out = CommandOut()
 
-        raw_stdout = utils.CCStringIO(writers=sys.stdout)
+        raw_stdout = utils.CCStringIO(
+            writers=sys.stdout if self.echo else None,
+            max_size=self.max_output)
         try:
             if self.dest_host:
                 with fabric.api.settings(
                     host_string=self.dest_host,   # destination host
                     key_filename=self.ssh_key,     # a path to ssh key
                     timeout=2,                     # connection timeout
-                    command_timeout=self.timeout,  # command execution timeout
+                    # command execution timeout
+                    command_timeout=timeout or self.timeout,
                     warn_only=True,                # don't exit on error
                     abort_on_prompts=True,         # non-interactive mode
                     use_shell=True,
@@ -115,6 +189,7 @@ class Driver(object):
                     logger.debug(
                         "Running remote command: host: %s command: %s",
                         self.host, command)
+                    self._connect()
                     try:
                         output = fabric.api.run(command, stdout=raw_stdout)
                     except SystemExit:
@@ -125,10 +200,20 @@ class Driver(object):
                     out.output = output
                     out.stdout = raw_stdout.getvalue()
                     out.return_code = output.return_code
+                    if raw_stdout.truncated:
+                        logger.warning(
+                            "Output of command is truncated to %s bytes: "
+                            "host: %s command: %s",
+                            self.max_output, self.host, command)
+                        out.stdout += ("\n[output truncated to {0} bytes]"
+                                       "".format(self.max_output))
+                        # don't keep the full copy made by fabric
+                        out.output = out.stdout
             else:
                 logger.debug("Running local command: %s", command)
+                # local commands are limited only by explicit timeouts
                 out.return_code, out.stdout, out.stderr = utils.execute(
-                    command)
+                    command, timeout=timeout or self.local_timeout)
                 out.output = out.stdout
         except fabric.exceptions.NetworkError as e:
             logger.error("NetworkError occured: %s", str(e))
@@ -136,8 +221,170 @@ class Driver(object):
         except Exception as e:
             logger.error("Unexpected error occured: %s", str(e))
             out.stdout = raw_stdout.getvalue()
+        self.metrics["bytes_transferred"] += (
+            len(out.stdout or '') + len(out.stderr or ''))
         return out
 
+    def command_to_file(self, command, fileobj):
+        """Runs remote or local command writing its output into a file
+
+        Output is written chunk by chunk as it arrives, so it's never
+        kept in memory as a whole. Stderr is combined with stdout.
+        Driver timeout is applied to every read.
+
+        :returns: CommandOut with return code only
+        """
+        out = CommandOut()
+        try:
+            if self.dest_host:
+                with fabric.api.settings(
+                    host_string=self.dest_host,  # destination host
+                    key_filename=self.ssh_key,    # a path to ssh key
+                    timeout=2,                    # connection timeout
+                    abort_on_prompts=True,        # non-interactive mode
+                ):
+                    logger.debug(
+                        "Running remote command into file: host: %s "
+                        "command: %s", self.host, command)
+                    self._connect()
+                    out.return_code = self._channel_to_file(
+                        command, metrics.CountingWriter(
+                            fileobj, self.metrics, "bytes_transferred"))
+            else:
+                start = fileobj.tell()
+                out.return_code = utils.execute_to_file(
+                    command, fileobj, timeout=self.local_timeout)
+                fileobj.seek(0, os.SEEK_END)
+                self.metrics["bytes_transferred"] += fileobj.tell() - start
+        except fabric.exceptions.NetworkError as e:
+            logger.error("NetworkError occured: %s", str(e))
+            raise
+        except Exception as e:
+            logger.error("Unexpected error occured: %s", str(e))
+        return out
+
+    def _channel_to_file(self, command, fileobj, stderr=None, stdin=None):
+        """Runs command on the connected host writing its output into a file
+
+        Connection should be opened by _connect() beforehand. Unlike
+        command_to_file() it can be called from several threads at once,
+        every call uses its own channel of the connection.
+
+        :param stderr: file object to write stderr into, by default it's
+                       combined with stdout
+        :param stdin: string sent to stdin of the command, which is closed
+                      then
+        :returns: return code of the command
+        """
+        client = fabric.state.connections[self.dest_host]
+        channel = client.get_transport().open_session()
+        try:
+            channel.settimeout(self.timeout)
+            channel.set_combine_stderr(stderr is None)
+            channel.exec_command(command)
+            if stdin is not None:
+                channel.sendall(stdin)
+                channel.shutdown_write()
+            for chunk in iter(lambda: channel.recv(self.chunk_size), ''):
+                fileobj.write(chunk)
+                # stderr is read as it arrives, so it can't block stdout
+                while stderr is not None and channel.recv_stderr_ready():
+                    stderr.write(channel.recv_stderr(self.chunk_size))
+            if stderr is not None:
+                for chunk in iter(
+                        lambda: channel.recv_stderr(self.chunk_size), ''):
+                    stderr.write(chunk)
+            return channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    def command_batch(self, commands, cacheable=False):
+        """Runs several commands within a single shell session
+
+        Every command is run separately on the executing side and its
+        output is sent back between boundary lines, so the result is the
+        same as of calling command() for each of them, except that stderr
+        is never mixed into stdout.
+
+        :param commands: list of shell commands
+        :param cacheable: whether results are cached per command, as for
+                          command(); only commands which aren't cached
+                          are run then
+        :returns: list of CommandOut, one per command
+        """
+        outs = [None] * len(commands)
+        if cacheable:
+            outs = [cache.cache.get(self.dest_host, command)
+                    for command in commands]
+        missing = [i for i, out in enumerate(outs) if out is None]
+        if not missing:
+            return outs
+        run = [commands[i] for i in missing]
+        boundary = 'SHOTGUN-{0}'.format(uuid.uuid4().hex)
+        out = self.command(utils.batch_script(run, boundary),
+                           timeout=self.timeout * len(run))
+        for i, cmd_out in zip(missing,
+                              self._batch_outs(run, out.stdout, boundary)):
+            outs[i] = cmd_out
+            # commands after an interrupted one have no return code
+            if cacheable and cmd_out.return_code is not None:
+                cache.cache.put(self.dest_host, commands[i], cmd_out)
+        return outs
+
+    def _batch_outs(self, commands, output, boundary):
+        """Splits output of utils.batch_script() into CommandOut objects"""
+        results = utils.parse_batch_output(output or '', boundary)
+        if len(results) < len(commands):
+            logger.error("Batch of commands was interrupted: host: %s, "
+                         "%s of %s commands completed", self.host,
+                         len(results), len(commands))
+
+        outs = []
+        for i in range(len(commands)):
+            result = results.get(i, {})
+            cmd_out = CommandOut()
+            cmd_out.stdout = result.get('stdout')
+            cmd_out.stderr = result.get('stderr')
+            cmd_out.output = cmd_out.stdout
+            cmd_out.return_code = result.get('rc')
+            outs.append(cmd_out)
+        return outs
+
+    @contextlib.contextmanager
+    def stream(self, command):
+        """Runs remote or local command yielding its stdout as file object
+
+        Unlike command(), output isn't collected in memory, so the caller
+        should consume it while the command is running. Driver timeout is
+        applied to every read.
+        """
+        if self.dest_host:
+            with fabric.api.settings(
+                host_string=self.dest_host,  # destination host
+                key_filename=self.ssh_key,    # a path to ssh key
+                timeout=2,                    # connection timeout
+                abort_on_prompts=True,        # non-interactive mode
+            ):
+                logger.debug(
+                    "Streaming remote command: host: %s command: %s",
+                    self.host, command)
+                self._connect()
+                client = fabric.state.connections[self.dest_host]
+                channel = client.get_transport().open_session()
+                channel.settimeout(self.timeout)
+                channel.exec_command(command)
+                try:
+                    yield metrics.CountingReader(
+                        channel.makefile("rb"), self.metrics,
+                        "bytes_transferred")
+                finally:
+                    channel.close()
+        else:
+            logger.debug("Streaming local command: %s", command)
+            with utils.execute_stream(command) as stdout:
+                yield metrics.CountingReader(
+                    stdout, self.metrics, "bytes_transferred")
+
     def get(self, path, target_path):
         """Get remote or local file
 
@@ -155,30 +402,56 @@ class Driver(object):
                 ):
                     logger.debug("Getting remote file: %s %s",
                                  path, target_path)
-                    utils.execute('mkdir -p "{0}"'.format(target_path))
+                    fs.makedirs(target_path)
+                    self._connect()
                     try:
-                        return fabric.api.get(path, target_path)
+                        fetched = fabric.api.get(path, target_path)
                     except SystemExit:
                         logger.error("Fabric aborted this iteration")
+                    else:
+                        self._count_fetched(fetched)
+                        return fetched
             else:
                 logger.debug(
-                    "Getting local file: cp -r %s %s", path, target_path)
-                utils.execute('mkdir -p "{0}"'.format(target_path))
-                return utils.execute(
-                    'cp -r "{0}" "{1}"'.format(path, target_path))
+                    "Getting local file: %s %s", path, target_path)
+                fs.makedirs(target_path)
+                result = fs.copy(path, target_path)
+                self._count_fetched([os.path.join(
+                    target_path, os.path.basename(path.rstrip("/")))])
+                return result
         except fabric.exceptions.NetworkError as e:
             logger.error("NetworkError occured: %s", str(e))
             raise
         except Exception as e:
             logger.error("Unexpected error occured: %s", str(e))
 
+    def _count_fetched(self, paths):
+        size = sum(metrics.disk_usage(path) for path in paths
+                   if os.path.exists(path))
+        self.metrics["bytes_transferred"] += size
+        self.metrics["bytes_written"] += size
+
 
 class File(Driver):
 
+    # number of files packed by a single tar command
+    tar_batch_size = 100
+    # size budget of the whole snapshot set by the manager, see
+    # scheduler.Budget
+    budget = None
+
     def __init__(self, data, conf):
         super(File, self).__init__(data, conf)
         self.path = data["path"]
         self.exclude = data.get('exclude', [])
+        # put files right into the archive instead of target directory
+        self.streaming = data.get('stream', False)
+        # fetch only files changed since the previous snapshot
+        self.incremental = data.get('incremental', False)
+        # limits of collected data, see snapshot_limited()
+        self.max_bytes = data.get('max_bytes')
+        self.tail_bytes = data.get('tail_bytes')
+        self.newer_than = data.get('newer_than')
         logger.debug("File to get: %s", self.path)
         self.target_path = str(os.path.join(
             self.conf.target, self.host,
@@ -197,11 +470,243 @@ class File(Driver):
         self.path IS /var/log/somedir
         self.target_path IS /target/host.domain.tld/var/log
         """
+        if self.incremental:
+            self.snapshot_incremental()
+            return
+
+        if (self.max_bytes is not None or self.tail_bytes is not None or
+                self.newer_than or self.budget is not None):
+            if self.streaming:
+                logger.info("Size and age limits of %s on %s turn off "
+                            "streaming", self.path, self.host)
+            self.snapshot_limited()
+            return
+
+        if self.streaming:
+            self.snapshot_stream()
+            return
+
+        if self.exclude:
+            try:
+                self.snapshot_excluded()
+                return
+            except fabric.exceptions.NetworkError as e:
+                logger.error("NetworkError occured: %s", str(e))
+                raise
+            except Exception as e:
+                logger.warning("Failed to exclude files on the host, they "
+                               "will be removed after copying: %s", str(e))
+
         self.get(self.path, self.target_path)
 
         if self.exclude:
             utils.remove(self.full_dst_path, self.exclude)
 
+    @property
+    def tar_command(self):
+        """Command which packs the object skipping excluded paths
+
+        Exclude patterns are relative to the object path and are matched
+        as by utils.remove(): wildcards don't match '/' and excluding a
+        directory excludes everything inside it.
+        """
+        path = self.path.lstrip("/")
+        excludes = "".join(
+            " --exclude={0}".format(
+                pipes.quote(os.path.join(path, pattern.lstrip("/"))))
+            for pattern in self.exclude)
+        return ("cd / && tar cf - --ignore-failed-read --anchored "
+                "--no-wildcards-match-slash{0} {1}"
+                "".format(excludes, path))
+
+    def snapshot_excluded(self):
+        """Make a snapshot skipping excluded files on the host
+
+        Excluded files are never sent over network or written to disk.
+        Requires GNU tar on the host.
+        """
+        with self._count_extracted():
+            with self.stream(self.tar_command) as stdout:
+                archive.extract_stream(
+                    stdout, os.path.join(self.conf.target, self.host))
+
+    @contextlib.contextmanager
+    def _count_extracted(self):
+        # extracted tar stream takes about the same space on the disk
+        transferred = self.metrics["bytes_transferred"]
+        yield
+        self.metrics["bytes_written"] += (
+            self.metrics["bytes_transferred"] - transferred)
+
+    def list_files(self, options=""):
+        """Lists regular files of the object on its host
+
+        :param options: additional find options
+        :returns: list of (path, size, mtime) tuples of not excluded files
+        """
+        listing = self.command("find {0} -type f{1} -printf '%s %T@ %p\\n'"
+                               "".format(self.path, options))
+        files = []
+        for line in (listing.stdout or "").splitlines():
+            try:
+                size, mtime, path = line.strip().split(" ", 2)
+                size = int(size)
+            except ValueError:
+                logger.debug("Skipping unexpected line: %s", line)
+                continue
+            if not archive.excluded(path.lstrip("/"), self.path,
+                                    self.exclude):
+                files.append((path, size, mtime))
+        return files
+
+    def snapshot_limited(self):
+        """Make a snapshot within size and age limits
+
+        Only files modified within newer_than seconds are taken, newest
+        first. Files larger than tail_bytes, as well as the file which
+        doesn't fit into max_bytes or the budget of the snapshot any
+        more, are cut to their last bytes; files which don't fit at all
+        are skipped. Every cut is listed in TRUNCATED.txt of the host
+        directory.
+        """
+        options = ""
+        if self.newer_than:
+            options = " -mmin -{0}".format(
+                int(math.ceil(self.newer_than / 60.0)))
+        files = sorted(self.list_files(options),
+                       key=lambda f: float(f[2]), reverse=True)
+
+        budget = self.max_bytes
+        whole, truncated = [], []
+        for path, size, _ in files:
+            take = size
+            if self.tail_bytes is not None:
+                take = min(take, self.tail_bytes)
+            if budget is not None:
+                take = min(take, budget)
+                budget -= take
+            if self.budget is not None:
+                take = self.budget.take(take)
+            if take == size:
+                whole.append(path)
+            else:
+                truncated.append((path, size, take))
+
+        for i in range(0, len(whole), self.tar_batch_size):
+            paths = " ".join(pipes.quote(path.lstrip("/"))
+                             for path in whole[i:i + self.tar_batch_size])
+            with self._count_extracted(), self.stream(
+                    "cd / && tar cf - --ignore-failed-read -- {0}"
+                    "".format(paths)) as stdout:
+                archive.extract_stream(
+                    stdout, os.path.join(self.conf.target, self.host))
+        for path, size, take in truncated:
+            if take:
+                self._fetch_part(path, size - take, size)
+
+        if truncated:
+            logger.debug("Files truncated: host: %s path: %s, %s of %s",
+                         self.host, self.path, len(truncated), len(files))
+            self._record_truncated(truncated)
+
+    def _record_truncated(self, truncated):
+        path = os.path.join(self.conf.target, self.host, "TRUNCATED.txt")
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "a") as f:
+            for file_path, size, take in truncated:
+                if take:
+                    f.write("{0}: last {1} of {2} bytes kept\n".format(
+                        file_path, take, size))
+                else:
+                    f.write("{0}: skipped, {1} bytes\n".format(
+                        file_path, size))
+
+    def snapshot_incremental(self):
+        """Make a snapshot of files changed since the previous one
+
+        Files which have the same size and mtime as in the manifest of the
+        previous snapshot are skipped. If a file grew and its beginning
+        still has the same checksum, only the appended part is fetched.
+        Files are read up to the size they had when listed, so checksums
+        stay consistent for growing logs.
+        """
+        previous = incremental.load_manifest(self.conf.manifest).files(
+            self.host, self.path)
+        current = {}
+        for path, size, mtime in self.list_files():
+            current[path] = {"size": size, "mtime": mtime}
+
+        changed = {}
+        for path, info in current.items():
+            old = previous.get(path)
+            if old and (old["size"], old["mtime"]) == (info["size"],
+                                                       info["mtime"]):
+                info["sha1"] = old.get("sha1")
+            elif old and info["size"] > old["size"]:
+                changed[path] = old["size"]
+            else:
+                changed[path] = 0
+
+        paths = sorted(changed)
+        commands = []
+        for path in paths:
+            commands.append("head -c {0} {1} | sha1sum".format(
+                current[path]["size"], pipes.quote(path)))
+            if changed[path]:
+                commands.append("head -c {0} {1} | sha1sum".format(
+                    changed[path], pipes.quote(path)))
+        outs = iter(self.command_batch(commands) if commands else [])
+
+        for path in paths:
+            current[path]["sha1"] = (next(outs).stdout or "").split(" ")[0]
+            if changed[path]:
+                prefix_sha1 = (next(outs).stdout or "").split(" ")[0]
+                if prefix_sha1 != previous[path].get("sha1"):
+                    changed[path] = 0
+            self._fetch_part(path, changed[path], current[path]["size"])
+
+        logger.debug("Incremental snapshot: host: %s path: %s, %s of %s "
+                     "files changed", self.host, self.path, len(changed),
+                     len(current))
+        incremental.write_fragment(
+            self.conf.target, self.host, self.path, current, changed)
+
+    def _fetch_part(self, path, offset, size):
+        destination = os.path.join(
+            self.conf.target, self.host, path.lstrip("/"))
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        command = "tail -c +{0} {1} | head -c {2}".format(
+            offset + 1, pipes.quote(path), size - offset)
+        with self.stream(command) as stdout:
+            with open(destination, "wb") as f:
+                shutil.copyfileobj(stdout, f)
+                self.metrics["bytes_written"] += f.tell()
+
+    def snapshot_stream(self):
+        """Make a snapshot bypassing the target directory
+
+        Files are packed by tar on the host and their stream is
+        compressed into an archive segment as it arrives, under the same
+        names they would have in the target directory.
+        """
+        prefix = os.path.join(os.path.basename(self.conf.target), self.host)
+        try:
+            with self.stream(self.tar_command) as stdout:
+                with archive.Segment(
+                        self.conf.target, self.conf.compression_level,
+                        self.conf.compression,
+                        self.conf.compression_threads) as segment:
+                    segment.add_stream(stdout, prefix, self.path,
+                                       self.exclude)
+            self.metrics["bytes_written"] += os.path.getsize(segment.path)
+        except fabric.exceptions.NetworkError as e:
+            logger.error("NetworkError occured: %s", str(e))
+            raise
+        except Exception as e:
+            logger.error("Unexpected error occured: %s", str(e))
+
 Dir = File
 
 
@@ -209,16 +714,62 @@ class Postgres(Driver):
     def __init__(self, data, conf):
         super(Postgres, self).__init__(data, conf)
         self.dbhost = data.get("dbhost", "localhost")
-        self.dbname = data["dbname"]
+        if isinstance(data["dbname"], list):
+            self.dbnames = data["dbname"]
+        else:
+            self.dbnames = [data["dbname"]]
+        self.dbname = self.dbnames[0]
         self.username = data.get("username", "postgres")
         self.password = data.get("password")
+        # pipe output of pg_dump into the target instead of dumping into
+        # a temporary file first
+        self.streaming = data.get("stream", False)
+        # "plain" SQL script or "custom" compressed archive for pg_restore
+        self.format = data.get("format", "plain")
+        self.tables = data.get("tables", [])
+        self.exclude_tables = data.get("exclude_tables", [])
+        self.exclude_table_data = data.get("exclude_table_data", [])
+        # number of databases which are dumped simultaneously
+        self.jobs = data.get("jobs", self.conf.host_concurrency)
         self.target_path = str(os.path.join(self.conf.target,
                                self.host, "pg_dump"))
 
+    def dump_command(self, dbname, filename=None):
+        args = ["pg_dump", "-h", self.dbhost, "-U", self.username, "-w"]
+        if self.format == "custom":
+            args.append("-Fc")
+        for table in self.tables:
+            args.extend(["-t", table])
+        for table in self.exclude_tables:
+            args.extend(["-T", table])
+        for table in self.exclude_table_data:
+            args.append("--exclude-table-data={0}".format(table))
+        if filename:
+            args.extend(["-f", filename])
+        args.append(dbname)
+        return " ".join(pipes.quote(arg) for arg in args)
+
+    def dump_path(self, dbname):
+        return os.path.join(self.target_path, "{0}_{1}.{2}".format(
+            self.dbhost, dbname,
+            "dump" if self.format == "custom" else "sql"))
+
     def snapshot(self):
+        if self.streaming:
+            self.snapshot_stream()
+            return
         if self.password:
+            self._write_pgpass()
+        fs.makedirs(self.target_path)
+        for dbname in self.dbnames:
+            temp = self.command("mktemp").output.strip()
+            self.command(self.dump_command(dbname, temp))
+            fs.move(temp, self.dump_path(dbname))
+
+    def _write_pgpass(self):
+        for dbname in self.dbnames:
             authline = "{host}:{port}:{dbname}:{username}:{password}".format(
-                host=self.dbhost, port="5432", dbname=self.dbname,
+                host=self.dbhost, port="5432", dbname=dbname,
                 username=self.username, password=self.password)
             home_dir = pwd.getpwuid(os.getuid()).pw_dir
             pgpass = os.path.join(home_dir, ".pgpass")
@@ -233,17 +784,86 @@ class Postgres(Driver):
                     fo.seek(0, 2)
                     fo.write("{0}\n".format(authline))
             os.chmod(pgpass, stat.S_IRUSR + stat.S_IWUSR)
-        temp = self.command("mktemp").output.strip()
-        self.command("pg_dump -h {dbhost} -U {username} -w "
-                     "-f {file} {dbname}".format(
-                         dbhost=self.dbhost, username=self.username,
-                         file=temp, dbname=self.dbname))
-        utils.execute('mkdir -p "{0}"'.format(self.target_path))
-        dump_basename = "{0}_{1}.sql".format(self.dbhost, self.dbname)
 
-        utils.execute('mv -f "{0}" "{1}"'.format(
-            temp,
-            os.path.join(self.target_path, dump_basename)))
+    def snapshot_stream(self):
+        """Make a snapshot piping output of pg_dump into the target
+
+        Dumps go to the target as they are produced wherever pg_dump runs,
+        nothing is written on the executing host. Password is passed in
+        the environment of local pg_dump rather than in ~/.pgpass, remote
+        pg_dump reads it from a temporary password file written from
+        stdin, so it never appears in command lines. Several databases
+        are dumped simultaneously over the same connection.
+        """
+        fs.makedirs(self.target_path)
+        try:
+            if self.dest_host:
+                self._open_connection()
+            jobs = max(min(self.jobs, len(self.dbnames)), 1)
+            if jobs > 1:
+                pool = ThreadPool(jobs)
+                try:
+                    sizes = pool.map(self._dump_stream, self.dbnames)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                sizes = [self._dump_stream(dbname)
+                         for dbname in self.dbnames]
+            self.metrics["bytes_transferred"] += sum(sizes)
+            self.metrics["bytes_written"] += sum(sizes)
+        except fabric.exceptions.NetworkError as e:
+            logger.error("NetworkError occured: %s", str(e))
+            raise
+        except Exception as e:
+            logger.error("Unexpected error occured: %s", str(e))
+
+    def _dump_stream(self, dbname):
+        """Dumps the database into the target
+
+        Messages of pg_dump are put next to the dump with .log suffix.
+
+        :returns: size of the dump
+        """
+        command = self.dump_command(dbname)
+        logger.debug("Dumping database %s on %s: %s",
+                     dbname, self.host, command)
+        path = self.dump_path(dbname)
+        with open(path, "wb") as f, tempfile.TemporaryFile() as stderr:
+            if self.dest_host:
+                stdin = None
+                if self.password:
+                    command, stdin = self._with_pgpass(command)
+                return_code = self._channel_to_file(command, f, stderr,
+                                                    stdin)
+            else:
+                env = dict(os.environ)
+                if self.password:
+                    env["PGPASSWORD"] = self.password
+                return_code = utils.execute_to_file(
+                    command, f, env=env, timeout=self.local_timeout,
+                    stderr=stderr)
+            stderr.seek(0)
+            messages = stderr.read()
+        if messages:
+            with open("{0}.log".format(path), "w") as f:
+                f.write(messages)
+        if return_code:
+            logger.error("Dumping database %s on %s failed with code %s: "
+                         "%s", dbname, self.host, return_code, messages)
+        return os.path.getsize(path)
+
+    def _with_pgpass(self, command):
+        """Makes remote command read the password from its stdin
+
+        :returns: tuple (command, its stdin)
+        """
+        password = self.password.replace("\\", "\\\\").replace(":", "\\:")
+        # mktemp creates the file readable by its owner only
+        command = ("pgpass=$(mktemp) && trap 'rm -f \"$pgpass\"' EXIT && "
+                   "cat > \"$pgpass\" && PGPASSFILE=\"$pgpass\" {0}"
+                   "".format(command))
+        return command, "*:*:*:*:{0}\n".format(password)
 
 
 class XmlRpc(Driver):
@@ -253,24 +873,92 @@ class XmlRpc(Driver):
         self.server = data.get("server", "localhost")
         self.methods = data.get("methods", [])
         self.to_file = data.get("to_file")
+        # call all methods in a single system.multicall request
+        self.multicall = data.get("multicall", True)
+        # number of methods called simultaneously when the server doesn't
+        # support system.multicall
+        self.jobs = data.get("jobs", self.conf.host_concurrency)
+        # server proxy of every thread, keeps its HTTP connection opened
+        self._local = threading.local()
 
         self.target_path = os.path.join(
             self.conf.target, self.host, "xmlrpc", self.to_file)
 
     def snapshot(self):
-        utils.execute('mkdir -p "{0}"'.format(os.path.dirname(
-            self.target_path)))
+        """Writes responses of the methods as JSON lines
+
+        Every line is an object with "method" and either "result" or
+        "error" keys, lines go in the order of methods.
+        """
+        fs.makedirs(os.path.dirname(self.target_path))
 
-        server = xmlrpclib.Server(self.server)
         with open(self.target_path, "w") as f:
-            for method in self.methods:
-                if hasattr(server, method):
-                    response = getattr(server, method)()
-                    response = pprint.pformat(response, indent=2)
+            for method, response in self.call_methods():
+                if isinstance(response, xmlrpclib.Fault):
+                    line = {"method": method, "error": response.faultString}
                 else:
-                    response = "no such method on remote server"
+                    line = {"method": method, "result": response}
+                json.dump(line, f, sort_keys=True, default=str)
+                f.write("\n")
+            self.metrics["bytes_written"] += f.tell()
+
+    def call_methods(self):
+        """Calls the methods of the server
+
+        Methods are called in a single system.multicall request, or
+        simultaneously if the server doesn't support it.
+
+        :returns: iterator of (method, response) in order of the methods,
+                  response is xmlrpclib.Fault if the call failed
+        """
+        if self.multicall and len(self.methods) > 1:
+            responses = self._multicall()
+            if responses is not None:
+                return itertools.izip(self.methods, responses)
+        jobs = max(min(self.jobs, len(self.methods)), 1)
+        if jobs == 1:
+            return ((method, self._call(method)) for method in self.methods)
+        return self._call_parallel(jobs)
 
-                f.write("===== {0} =====\n{1}\n\n".format(method, response))
+    def _proxy(self):
+        if getattr(self._local, "server", None) is None:
+            self._local.server = xmlrpclib.ServerProxy(self.server)
+        return self._local.server
+
+    def _multicall(self):
+        multicall = xmlrpclib.MultiCall(self._proxy())
+        for method in self.methods:
+            getattr(multicall, method)()
+        try:
+            results = multicall()
+        except (xmlrpclib.Fault, xmlrpclib.ProtocolError) as e:
+            logger.debug("Server %s doesn't support system.multicall: %s",
+                         self.server, e)
+            return None
+        return self._multicall_responses(results)
+
+    def _multicall_responses(self, results):
+        for i in range(len(self.methods)):
+            try:
+                yield results[i]
+            except xmlrpclib.Fault as e:
+                yield e
+
+    def _call(self, method):
+        try:
+            return getattr(self._proxy(), method)()
+        except xmlrpclib.Fault as e:
+            return e
+
+    def _call_parallel(self, jobs):
+        pool = ThreadPool(jobs)
+        try:
+            for item in itertools.izip(
+                    self.methods, pool.imap(self._call, self.methods)):
+                yield item
+        finally:
+            pool.close()
+            pool.join()
 
 
 class Command(Driver):
@@ -284,48 +972,260 @@ class Command(Driver):
         self.to_file = data.get("to_file", "/dev/null")
         self.target_path = os.path.join(
             self.conf.target, self.host, "commands", self.to_file)
+        # run all commands in a single session
+        self.batch = data.get("batch", False)
+        # reuse results of the same commands run earlier, should be
+        # disabled for commands which aren't idempotent
+        self.cacheable = data.get("cache", True)
+        # write output into the target file as it arrives instead of
+        # collecting it in memory
+        self.streaming = data.get("stream", False)
 
     def snapshot(self):
-        for cmd in self.cmds:
-            self._snapshot_single(cmd)
+        if self.batch:
+            outs = self.command_batch(self.cmds, self.cacheable)
+            for cmd, out in zip(self.cmds, outs):
+                self._write_output(cmd, out)
+        else:
+            for cmd in self.cmds:
+                self._snapshot_single(cmd)
 
     def _snapshot_single(self, cmd):
-        out = self.command(cmd)
-        utils.execute('mkdir -p "{0}"'.format(os.path.dirname(
-            self.target_path)))
+        if self.streaming:
+            self._snapshot_stream(cmd)
+        else:
+            self._write_output(
+                cmd, self.command(cmd, cacheable=self.cacheable))
+
+    def _snapshot_stream(self, cmd):
+        """Runs the command with its output going to the disk
+
+        Return code goes before the output in the target file, so the
+        output is put into a temporary file next to it first.
+        """
+        fs.makedirs(os.path.dirname(self.target_path))
+        part = "{0}.part".format(self.target_path)
+        try:
+            with open(part, "w+b") as f:
+                out = self.command_to_file(cmd, f)
+                f.seek(0)
+                self._write_output(cmd, out, stdout=f)
+        finally:
+            os.remove(part)
+
+    def _write_output(self, cmd, out, stdout=None):
+        """Appends output of the command to the target file
+
+        :param stdout: file object to copy stdout from instead of
+                       out.stdout
+        """
+        fs.makedirs(os.path.dirname(self.target_path))
         with open(self.target_path, "a") as f:
+            f.seek(0, os.SEEK_END)
+            start = f.tell()
             f.write("===== COMMAND =====: {0}\n".format(cmd))
             f.write("===== RETURN CODE =====: {0}\n".format(out.return_code))
             f.write("===== STDOUT =====:\n")
-            if out.stdout:
+            if stdout is not None:
+                shutil.copyfileobj(stdout, f)
+            elif out.stdout:
                 f.write(out.stdout)
             f.write("\n===== STDERR =====:\n")
             if out.stderr:
                 f.write(out.stderr)
+            self.metrics["bytes_written"] += f.tell() - start
 
     def report(self):
-        for cmd in self.cmds:
-            for report_line in self._report_single(cmd):
-                yield report_line
+        if self.batch:
+            outs = self.command_batch(self.cmds, self.cacheable)
+            for cmd, out in zip(self.cmds, outs):
+                for report_line in self._report_lines(cmd, out):
+                    yield report_line
+        else:
+            for cmd in self.cmds:
+                for report_line in self._report_single(cmd):
+                    yield report_line
 
     def _report_single(self, cmd):
+        return self._report_lines(
+            cmd, self.command(cmd, cacheable=self.cacheable))
+
+    def _report_lines(self, cmd, out):
         return itertools.izip_longest(
             [self.host],
             cmd.split('\n'),
-            self.command(cmd).stdout.split('\n'),
+            (out.stdout or '').split('\n'),
             fillvalue='')
 
 
 class DockerCommand(Command):
+    """Runs commands inside docker containers of the host
+
+    Container ids are looked up once per host and run (see shotgun.cache),
+    all commands of a container run in a single exec session and
+    containers are processed simultaneously, up to "jobs" at a time.
+    So "batch" is always on, while "stream" and "cache" of Command are
+    ignored.
+    """
+
+    ps_command = "docker ps --format '{{.ID}} {{.Names}}'"
+
     def __init__(self, data, conf):
         super(DockerCommand, self).__init__(data, conf)
-        self.cmds = [
-            'docker exec \\\n'
-            '$(docker ps -q \\\n'
-            '  --filter \'name={0}\' \\\n'
-            '  --format \'{{{{.Names}}}}\') '
-            '{1}'.format(cnt, cmd)
-            for cnt in data["containers"] for cmd in self.cmds]
+        self.containers = data["containers"]
+        self.jobs = data.get("jobs", self.conf.host_concurrency)
+        # paths in the containers which are copied into the target
+        self.files = data.get("files", [])
+        self.files_path = os.path.join(self.conf.target, self.host, "docker")
+        # "cli" runs docker on the host, "api" talks to the docker daemon
+        # over its socket, which has to be forwarded for remote hosts
+        self.client = None
+        if data.get("backend", "cli") == "api":
+            if self.dest_host and "docker_socket" not in data:
+                # the local socket would give containers of this host
+                raise ValueError(
+                    "docker_socket forwarded from {0} is required for the "
+                    "api backend".format(self.host))
+            self.client = dockerapi.Client(
+                data.get("docker_socket", dockerapi.DEFAULT_SOCKET),
+                self.timeout)
+
+    def snapshot(self):
+        for cmd, out in self.container_outs():
+            self._write_output(cmd, out)
+        if self.files:
+            ids = self.container_ids()
+            for container in self.containers:
+                if container in ids:
+                    self._copy_files(container, ids[container])
+
+    def report(self):
+        for cmd, out in self.container_outs():
+            for report_line in self._report_lines(cmd, out):
+                yield report_line
+
+    def container_ids(self):
+        """Returns {container name: id} of running containers
+
+        Containers are matched by substring of the name as docker ps
+        --filter does, the exact match wins.
+        """
+        if self.client:
+            try:
+                running = [(c["Id"], name.lstrip("/"))
+                           for c in self.client.containers()
+                           for name in c.get("Names") or []]
+            except (dockerapi.APIError, socket.error) as e:
+                logger.error("Docker API request failed: %s", str(e))
+                running = []
+        else:
+            out = self.command(self.ps_command, cacheable=True)
+            running = [line.split(None, 1) for line in
+                       (out.stdout or '').splitlines() if ' ' in line.strip()]
+        ids = {}
+        for container in self.containers:
+            matches = [cid for cid, name in running if name == container]
+            matches += [cid for cid, name in running if container in name]
+            if matches:
+                ids[container] = matches[0]
+        return ids
+
+    def container_outs(self):
+        """Runs the commands in every container
+
+        :returns: list of (command, CommandOut) in order of containers
+                  and commands
+        """
+        ids = self.container_ids()
+        found = [c for c in self.containers if c in ids]
+        if found and self.dest_host and not self.client:
+            # the container ids may come from the cache without connecting
+            self._open_connection()
+        jobs = max(min(self.jobs, len(found)), 1)
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                results = pool.map(lambda c: self._exec(ids[c]), found)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._exec(ids[c]) for c in found]
+        outs = dict(zip(found, results))
+
+        items = []
+        for container in self.containers:
+            if container in outs:
+                container_outs = outs[container]
+            else:
+                out = CommandOut()
+                out.stderr = "No such container: {0}".format(container)
+                container_outs = [out] * len(self.cmds)
+            for cmd, out in zip(self.cmds, container_outs):
+                items.append(
+                    ("docker exec {0} {1}".format(container, cmd), out))
+        return items
+
+    def _exec(self, container_id):
+        """Runs all commands in the container
+
+        Called from several threads at once, so remote commands use own
+        channels of the connection opened by container_outs().
+        """
+        if self.client:
+            return [self._exec_api(container_id, cmd) for cmd in self.cmds]
+        boundary = 'SHOTGUN-{0}'.format(uuid.uuid4().hex)
+        command = "docker exec {0} sh -c {1}".format(
+            pipes.quote(container_id), pipes.quote(utils.batch_script(
+                self.cmds, boundary, shell='sh')))
+        if self.dest_host:
+            stdout = StringIO.StringIO()
+            try:
+                self._channel_to_file(command, stdout, StringIO.StringIO())
+            except fabric.exceptions.NetworkError as e:
+                logger.error("NetworkError occured: %s", str(e))
+                raise
+            except Exception as e:
+                logger.error("Unexpected error occured: %s", str(e))
+            output = stdout.getvalue()
+        else:
+            timeout = self.local_timeout and self.local_timeout * len(
+                self.cmds)
+            _, output, _ = utils.execute(command, timeout=timeout)
+        return self._batch_outs(self.cmds, output, boundary)
+
+    def _exec_api(self, container_id, cmd):
+        out = CommandOut()
+        try:
+            out.return_code, out.stdout, out.stderr = self.client.execute(
+                container_id, ["sh", "-c", cmd])
+        except (dockerapi.APIError, socket.error) as e:
+            logger.error("Docker API request failed: %s", str(e))
+            out.stderr = str(e)
+        out.output = out.stdout
+        self.metrics["bytes_transferred"] += (len(out.stdout or '') +
+                                              len(out.stderr or ''))
+        return out
+
+    def _copy_files(self, container, container_id):
+        """Copies the files of the container into the target"""
+        path = os.path.join(self.files_path, container)
+        fs.makedirs(path)
+        for filepath in self.files:
+            try:
+                if self.client:
+                    with self.client.get_archive(
+                            container_id, filepath) as stream:
+                        archive.extract_stream(metrics.CountingReader(
+                            stream, self.metrics, "bytes_transferred"), path)
+                else:
+                    with self.stream("docker cp {0}:{1} -".format(
+                            container_id, pipes.quote(filepath))) as stream:
+                        archive.extract_stream(stream, path)
+            except (dockerapi.APIError, socket.error, tarfile.TarError) as e:
+                logger.error("Failed to copy %s of container %s: %s",
+                             filepath, container, str(e))
+        self.metrics["bytes_written"] += metrics.disk_usage(path)
 
 
 class Offline(Driver):
@@ -339,8 +1239,7 @@ class Offline(Driver):
 
     def snapshot(self):
         if not os.path.exists(self.target_path):
-            utils.execute('mkdir -p "{0}"'.format(os.path.dirname(
-                self.target_path)))
+            fs.makedirs(os.path.dirname(self.target_path))
             with open(self.target_path, "w") as f:
                 f.write("Host {0} was offline/unreachable during "
                         "logs obtaining.\n".format(self.host))
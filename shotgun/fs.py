@@ -0,0 +1,195 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Local filesystem operations done in-process
+
+Replacements of mkdir -p, rm -rf, mv -f and cp -r which don't spawn a
+shell and take paths as they are, without any quoting. File data is
+copied by the kernel with copy_file_range() or sendfile() where
+available.
+"""
+
+import ctypes
+import errno
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import stat
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# number of files copied simultaneously by copy()
+COPY_WORKERS = 4
+# errors meaning that kernel copy isn't possible for the pair of files
+_FALLBACK_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+                    errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def _libc_function(name, restype, *argtypes):
+    try:
+        function = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    function.restype = restype
+    function.argtypes = argtypes
+    return function
+
+
+_copy_file_range = _libc_function(
+    "copy_file_range", ctypes.c_ssize_t, ctypes.c_int, ctypes.c_void_p,
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+_sendfile = _libc_function(
+    "sendfile", ctypes.c_ssize_t, ctypes.c_int, ctypes.c_int,
+    ctypes.c_void_p, ctypes.c_size_t)
+
+
+def _kernel_copy(src_fd, dst_fd):
+    """Copies the rest of src_fd into dst_fd without reading it
+
+    :returns: False if the kernel can't copy between the files or
+              copies nothing from the source, as for some sysfs files
+    """
+    calls = []
+    if _copy_file_range is not None:
+        calls.append(lambda: _copy_file_range(
+            src_fd, None, dst_fd, None, CHUNK_SIZE, 0))
+    if _sendfile is not None:
+        calls.append(lambda: _sendfile(dst_fd, src_fd, None, CHUNK_SIZE))
+    for call in calls:
+        copied = 0
+        while True:
+            result = call()
+            if result > 0:
+                copied += result
+                continue
+            if result == 0:
+                return copied > 0
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if error in _FALLBACK_ERRORS and not copied:
+                break
+            raise OSError(error, os.strerror(error))
+    return False
+
+
+def copy_file(src, dst):
+    """Copies contents and mode of the file
+
+    Files which report zero size, like ones in /proc, are read as usual
+    because the kernel copies nothing from them.
+    """
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            if not (os.fstat(fsrc.fileno()).st_size and
+                    _kernel_copy(fsrc.fileno(), fdst.fileno())):
+                shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    shutil.copymode(src, dst)
+
+
+def makedirs(path, mode=0o777):
+    """Creates the directory with its parents, like mkdir -p"""
+    try:
+        os.makedirs(path, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def remove(path):
+    """Removes the file or directory if it exists, like rm -rf"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def move(src, dst):
+    """Moves the file replacing the destination, like mv -f"""
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    shutil.move(src, dst)
+
+
+def _copy_item(item):
+    src, dst = item
+    try:
+        copy_file(src, dst)
+    except (IOError, OSError) as e:
+        logger.error("Failed to copy %s: %s", src, e)
+        return False
+    return True
+
+
+def copy(src, directory, workers=COPY_WORKERS):
+    """Copies the file or directory tree into the directory, like cp -r
+
+    Symlinks are copied as symlinks, special files are skipped. Files
+    are copied by several threads at once.
+
+    :returns: True if everything was copied
+    """
+    ok = True
+    files = []
+    src = src.rstrip("/") or "/"
+    dst = os.path.join(directory, os.path.basename(src))
+    for path, target in _walk(src, dst):
+        try:
+            mode = os.lstat(path).st_mode
+            if stat.S_ISLNK(mode):
+                remove(target)
+                os.symlink(os.readlink(path), target)
+            elif stat.S_ISDIR(mode):
+                makedirs(target)
+            elif stat.S_ISREG(mode):
+                files.append((path, target))
+            else:
+                logger.debug("Skipping special file: %s", path)
+        except (IOError, OSError) as e:
+            logger.error("Failed to copy %s: %s", path, e)
+            ok = False
+
+    if len(files) > 1 and workers > 1:
+        pool = ThreadPool(min(workers, len(files)))
+        try:
+            results = pool.map(_copy_item, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_copy_item(item) for item in files]
+    return ok and all(results)
+
+
+def _walk(src, dst):
+    """Yields (path, target) of src and everything under it"""
+    yield src, dst
+    if not os.path.isdir(src) or os.path.islink(src):
+        return
+
+    def onerror(e):
+        logger.error("Failed to list %s: %s", e.filename, e)
+
+    for root, dirnames, filenames in os.walk(src, onerror=onerror):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        for name in dirnames + filenames:
+            yield (os.path.join(root, name),
+                   os.path.normpath(os.path.join(target_root, name)))
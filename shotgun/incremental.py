@@ -0,0 +1,206 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fnmatch
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+from shotgun import fs
+from shotgun import utils
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+def fragments_dir(target):
+    """Returns directory where drivers put manifests of their objects"""
+    return "{0}.manifest.d".format(target)
+
+
+def under(path, base):
+    """Whether the path belongs to the object with the given base path"""
+    base = base.rstrip("/") or "/"
+    return (path == base or path.startswith(base.rstrip("/") + "/") or
+            fnmatch.fnmatch(path, base))
+
+
+class Manifest(object):
+    """Files of incremental objects collected by a snapshot
+
+    Next snapshot fetches only files which are new or changed since then,
+    files which only grew are fetched starting from their previous size.
+    Every archive keeps its own manifest with the list of files it
+    contains, so restore() can rebuild the full view from the first
+    archive and all the following ones.
+
+    :param hosts: dict {host: {path: {'size': .., 'mtime': .., 'sha1': ..}}}
+    :param delta: dict {host: {path: offset}} of files contained in the
+                  archive, offset is 0 for whole files and previous size
+                  for files which only grew
+    """
+
+    def __init__(self, hosts=None, delta=None):
+        self.hosts = hosts or {}
+        self.delta = delta or {}
+
+    @classmethod
+    def load(cls, path):
+        """Loads manifest, missing file gives empty manifest"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data.get("hosts"), data.get("delta"))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"hosts": self.hosts, "delta": self.delta}, f,
+                      indent=1, sort_keys=True)
+
+    def files(self, host, base):
+        """Returns entries of files of the object"""
+        return dict((path, info)
+                    for path, info in self.hosts.get(host, {}).items()
+                    if under(path, base))
+
+    def update(self, host, base, files, delta):
+        """Replaces entries of the object with the collected ones"""
+        entries = self.hosts.setdefault(host, {})
+        for path in list(entries):
+            if under(path, base):
+                del entries[path]
+        entries.update(files)
+        self.delta.setdefault(host, {}).update(delta)
+
+
+# manifests loaded by the current process during the snapshot
+_loaded = {}
+
+
+def load_manifest(path):
+    """Loads manifest once per snapshot in a process"""
+    if path not in _loaded:
+        _loaded[path] = Manifest.load(path)
+    return _loaded[path]
+
+
+def reset():
+    """Forgets loaded manifests, so the next snapshot reads them again"""
+    _loaded.clear()
+
+
+def write_fragment(target, host, base, files, delta):
+    """Saves what was collected for the object
+
+    Fragments are files so that objects processed by parallel workers
+    can be merged by the manager.
+    """
+    directory = fragments_dir(target)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    path = os.path.join(directory, "{0}.json".format(uuid.uuid4().hex))
+    with open(path, "w") as f:
+        json.dump({"host": host, "base": base, "files": files,
+                   "delta": delta}, f)
+
+
+def merge_fragments(target, previous_path):
+    """Builds manifest of the snapshot and puts it into the target
+
+    Objects which weren't collected this time keep their previous
+    entries, so an offline host doesn't cause full download next time.
+
+    :returns: True if there were incremental objects
+    """
+    directory = fragments_dir(target)
+    if not os.path.isdir(directory):
+        return False
+    previous = Manifest.load(previous_path)
+    manifest = Manifest(previous.hosts)
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as f:
+            fragment = json.load(f)
+        manifest.update(fragment["host"], fragment["base"],
+                        fragment["files"], fragment["delta"])
+        os.remove(os.path.join(directory, name))
+    fs.makedirs(target)
+    manifest.save(os.path.join(target, MANIFEST_NAME))
+    manifest.save(os.path.join(directory, MANIFEST_NAME))
+    return True
+
+
+def commit(target, manifest_path):
+    """Makes manifest of the snapshot the base for the next one
+
+    Should be called when the archive is successfully created.
+    """
+    reset()
+    directory = fragments_dir(target)
+    if not os.path.isdir(directory):
+        return
+    fs.makedirs(os.path.dirname(manifest_path))
+    shutil.move(os.path.join(directory, MANIFEST_NAME), manifest_path)
+    shutil.rmtree(directory)
+
+
+def _apply(source, directory):
+    """Applies one extracted snapshot over the restored directory"""
+    manifest = Manifest.load(os.path.join(source, MANIFEST_NAME))
+    for path in utils.iterfiles(source):
+        relative = os.path.relpath(path, source)
+        if relative == MANIFEST_NAME:
+            continue
+        host, _, remote_path = relative.partition("/")
+        offset = manifest.delta.get(host, {}).get("/" + remote_path, 0)
+        destination = os.path.join(directory, relative)
+        fs.makedirs(os.path.dirname(destination))
+        if offset and os.path.exists(destination):
+            with open(destination, "r+b") as out:
+                out.seek(offset)
+                out.truncate()
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        elif os.stat(path).st_nlink > 1:
+            # files deduplicated in the archive are extracted as hard
+            # links, they must not share later deltas
+            shutil.copy2(path, destination)
+        else:
+            shutil.move(path, destination)
+
+
+def restore(archives, directory):
+    """Rebuilds full snapshot from the base archive and its deltas
+
+    :param archives: list of archives, the oldest first
+    :param directory: directory to put files of hosts into
+    """
+    fs.makedirs(directory)
+    for path in archives:
+        logger.debug("Applying snapshot %s", path)
+        tmp = tempfile.mkdtemp(dir=directory)
+        try:
+            utils.execute('tar xf "{0}" -C "{1}"'.format(path, tmp))
+            for name in os.listdir(tmp):
+                _apply(os.path.join(tmp, name), directory)
+        finally:
+            shutil.rmtree(tmp)
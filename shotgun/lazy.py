@@ -0,0 +1,60 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Imports of heavy modules postponed until they are used
+
+fabric pulls in paramiko and cryptography, which take longer to import
+than the rest of shotgun, while e.g. a report of local commands never
+uses them. Such modules are bound to a LazyModule instead:
+
+    fabric = lazy.LazyModule("fabric", "api", "exceptions")
+
+and are imported when any of their attributes is accessed first.
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """Module which is imported on the first access of its attributes
+
+    :param name: full name of the module
+    :param submodules: names of submodules which are used as attributes
+                       of the module and have to be imported with it
+    """
+
+    def __init__(self, name, *submodules):
+        self.__dict__["_name"] = name
+        self.__dict__["_submodules"] = submodules
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            for submodule in self._submodules:
+                importlib.import_module(
+                    "{0}.{1}".format(self._name, submodule))
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._load(), name)
+
+    def __repr__(self):
+        return "<lazy module '{0}'>".format(self._name)
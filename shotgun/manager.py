@@ -12,39 +12,293 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from collections import defaultdict
+from collections import deque
+from collections import OrderedDict
 import logging
+import multiprocessing
 import os
+import Queue
+import time
 
-import fabric.exceptions
-
+from shotgun import archive
+from shotgun import cache
+from shotgun import connections
+from shotgun import dedup
 from shotgun.driver import Driver
+from shotgun import fs
+from shotgun import incremental
+from shotgun import lazy
+from shotgun import metrics
+from shotgun import scheduler
 from shotgun import utils
 
+fabric = lazy.LazyModule("fabric", "exceptions")
+
 
 logger = logging.getLogger(__name__)
 
+# config of the snapshot which is handled by the current worker process
+_worker_conf = None
+# deadline of the snapshot, see scheduler.Deadline
+_worker_deadline = None
+# size budget of the snapshot, see scheduler.Budget
+_worker_budget = None
+
+
+def _init_worker(conf, deadline=None, budget=None):
+    global _worker_conf, _worker_deadline, _worker_budget
+    _worker_conf = conf
+    _worker_deadline = deadline
+    _worker_budget = budget
+    connections.ConnectionPool.forget_inherited()
+    connections.configure(conf)
+    cache.configure(conf)
+
+
+def _snapshot_object(obj_data, conf, records, deadline=None, budget=None):
+    """Makes snapshot of the object appending its metrics to records
+
+    Object which doesn't fit into the deadline is recorded as dropped.
+    Files of the object are taken from the size budget.
+    """
+    if deadline is not None:
+        # only remote commands are limited by the default timeout
+        timeout = None
+        if obj_data.get("host") and conf.get_network_address(obj_data):
+            timeout = conf.timeout
+        admitted, reason = deadline.admit(obj_data, timeout)
+        if admitted is None:
+            logger.warning("Dropping object: %s: %s", obj_data, reason)
+            metrics.drop(records, obj_data,
+                         Driver.getDriver(obj_data, conf), reason)
+            return
+        obj_data = admitted
+    logger.debug("Dumping: %s", obj_data)
+    driver = Driver.getDriver(obj_data, conf)
+    if budget is not None:
+        driver.budget = budget
+    with metrics.measure(records, obj_data, driver):
+        driver.snapshot()
+
+
+def _snapshot_host(objs):
+    """Makes snapshot of objects which belong to the same host
+
+    Objects are processed in the given order. Processing stops on the first
+    network error because the host is considered unreachable then.
+
+    :param objs: list of objects of a single host
+    :returns: tuple (list of objects which were not processed due to
+              network error, list of metrics records)
+    """
+    records = []
+    try:
+        for i, obj_data in enumerate(objs):
+            try:
+                _snapshot_object(obj_data, _worker_conf, records,
+                                 _worker_deadline, _worker_budget)
+            except fabric.exceptions.NetworkError:
+                return objs[i:], records
+        return [], records
+    finally:
+        connections.pool.close_all()
+
+
+def _report_object(obj):
+    """Gathers report of a single object in a worker process
+
+    :returns: tuple (rows, whether network error occurred)
+    """
+    logger.debug("Gathering report for: %s", obj)
+    try:
+        driver = Driver.getDriver(obj, _worker_conf)
+        return list(driver.report()), False
+    except fabric.exceptions.NetworkError:
+        return [], True
+    except Exception as e:
+        # exception in a worker would leave the object unfinished forever
+        logger.exception("Failed to gather report for: %s", obj)
+        return [_report_row(obj, _worker_conf,
+                            'Report failed: {0}'.format(e))], False
+
+
+def _report_row(obj, conf, message):
+    """Row of the report with the message instead of output of the object"""
+    try:
+        driver = Driver.getDriver(obj, conf)
+    except Exception:
+        driver = Driver(obj, conf)
+    return (driver.host, 'Driver: {0}'.format(type(driver).__name__),
+            message)
+
 
 class Manager(object):
     def __init__(self, conf):
         logger.debug("Initializing snapshot manager")
         self.conf = conf
+        # metrics of the last snapshot
+        self.profile = metrics.Profile()
+
+    def probe_hosts(self):
+        """Makes unreachable hosts be processed as offline at once
+
+        Otherwise every object of such host would wait for connection
+        timeout in every attempt.
+        """
+        if not self.conf.probe_timeout:
+            return
+        unreachable = connections.probe(self.conf.hosts,
+                                        self.conf.probe_timeout)
+        if unreachable:
+            logger.warning("Hosts are unreachable: %s",
+                           ", ".join(sorted(unreachable)))
+            self.conf.set_offline(unreachable)
 
     def snapshot(self):
         logger.debug("Making snapshot")
-        utils.execute("rm -rf {0}".format(os.path.dirname(self.conf.target)))
-        for obj_data in self.conf.objects:
-            logger.debug("Dumping: %s", obj_data)
-            self.action_single(obj_data, action='snapshot')
+        fs.remove(os.path.dirname(self.conf.target))
+        connections.configure(self.conf)
+        cache.configure(self.conf)
+        # workers are forked later, so they don't inherit manifests of
+        # a previous snapshot either
+        incremental.reset()
+        self.profile = metrics.Profile()
+        deadline = scheduler.Deadline(self.conf.deadline)
+        budget = None
+        if self.conf.max_snapshot_bytes is not None:
+            budget = scheduler.Budget(self.conf.max_snapshot_bytes)
+        self.probe_hosts()
+        try:
+            if self.conf.concurrency > 1:
+                self.snapshot_parallel(deadline, budget)
+            else:
+                for obj_data in self.conf.objects:
+                    self.snapshot_single(obj_data, deadline, budget)
+        finally:
+            connections.pool.close_all()
 
         logger.debug("Dumping shotgun log and archiving dump directory: %s",
                      self.conf.target)
-        self.action_single(self.conf.self_log_object, action='snapshot')
+        self.snapshot_single(self.conf.self_log_object)
+        scheduler.write_dropped(self.conf.target, self.profile.objects)
 
-        utils.compress(self.conf.target, self.conf.compression_level)
+        incremental.merge_fragments(self.conf.target, self.conf.manifest)
+        # linked files share content and metadata, so a kept directory
+        # isn't deduplicated
+        if (self.conf.dedup and not self.conf.keep_target and
+                os.path.isdir(self.conf.target)):
+            self.profile.dedup = dedup.link_duplicates(self.conf.target)
+        with self.profile.measure_compression(self.conf.target) as result:
+            path = utils.compress(
+                self.conf.target, self.conf.compression_level,
+                keep_target=self.conf.keep_target,
+                codec=self.conf.compression,
+                threads=self.conf.compression_threads)
+            result["path"] = path
+        self.profile.save(self.conf)
+        archive.prepend_segments(path, self.conf.target)
+        incremental.commit(self.conf.target, self.conf.manifest)
 
         with open(self.conf.lastdump, "w") as fo:
-            fo.write("{0}.tar.xz".format(self.conf.target))
-        return "{0}.tar.xz".format(self.conf.target)
+            fo.write(path)
+        return path
+
+    def snapshot_parallel(self, deadline=None, budget=None):
+        """Makes snapshot of several hosts simultaneously
+
+        Objects of every pass of conf.objects are grouped by host and each
+        group is handled by a worker process, so objects of the same host
+        are still processed one by one. Hosts don't wait for each other:
+        objects of a host which is still being processed are handed over
+        when its worker is done, retries of a failed host start while
+        other hosts are processed. Fabric keeps its state in globals,
+        which is why processes are used instead of threads.
+
+        :param deadline: scheduler.Deadline of the snapshot
+        :param budget: scheduler.Budget of the snapshot
+        """
+        pool = multiprocessing.Pool(
+            self.conf.concurrency, _init_worker,
+            (self.conf, deadline, budget))
+        results = Queue.Queue()
+        running = OrderedDict()
+        waiting = OrderedDict()
+
+        def submit():
+            for host in list(waiting):
+                if host in running:
+                    continue
+                objs = waiting.pop(host)
+                if self.conf.retries.is_open(host):
+                    # the host went offline while the objects were waiting
+                    objs = [o for o in objs if o.get("type") == 'offline']
+                if objs:
+                    running[host] = pool.apply_async(
+                        _snapshot_host, (objs,),
+                        callback=lambda result, host=host:
+                        results.put((host, result)))
+
+        try:
+            while True:
+                # backoff of failed hosts doesn't hold up results of
+                # others, it is waited for below
+                for obj_data in self.conf.iter_objects(wait=False):
+                    host = self.conf.get_network_address(obj_data)
+                    waiting.setdefault(host, []).append(obj_data)
+                    if self.conf.pass_completed:
+                        submit()
+                        self._collect_hosts(running, results, block=False)
+                submit()
+                if running:
+                    timeout = None
+                    if self.conf.try_again:
+                        timeout = self.conf.retry_delay
+                    self._collect_hosts(running, results, block=True,
+                                        timeout=timeout)
+                elif self.conf.try_again:
+                    self.conf.wait_retry()
+                else:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+
+    def _collect_hosts(self, running, results, block, timeout=None):
+        """Handles results of hosts which are done
+
+        :param block: whether to wait until at least one host is done
+        :param timeout: seconds to wait for it at most, None means as long
+                        as it takes
+        """
+        until = None if timeout is None else time.time() + timeout
+        while running:
+            wait = 1
+            if until is not None:
+                wait = min(max(until - time.time(), 0), wait)
+            try:
+                host, (failed, records) = results.get(block, timeout=wait)
+            except Queue.Empty:
+                for result in running.values():
+                    if result.ready() and not result.successful():
+                        # re-raises exception of the worker
+                        result.get()
+                if not block or (until is not None and
+                                 time.time() >= until):
+                    return
+                continue
+            block = False
+            del running[host]
+            self.profile.add(records)
+            for obj_data in failed:
+                self.conf.on_network_error(obj_data)
+
+    def snapshot_single(self, obj_data, deadline=None, budget=None):
+        try:
+            _snapshot_object(obj_data, self.conf, self.profile.objects,
+                             deadline, budget)
+        except fabric.exceptions.NetworkError:
+            self.conf.on_network_error(obj_data)
 
     def action_single(self, object, action='snapshot'):
         driver = Driver.getDriver(object, self.conf)
@@ -53,9 +307,126 @@ class Manager(object):
         except fabric.exceptions.NetworkError:
             self.conf.on_network_error(object)
 
-    def report(self):
+    def report(self, timeout=None):
+        """Generates rows of the report
+
+        :param timeout: seconds the whole report may take, objects which
+                        haven't been reported by then are reported as
+                        timed out
+        """
         logger.debug("Making report")
-        for obj_data in self.conf.objects:
-            logger.debug("Gathering report for: %s", obj_data)
-            for report in self.action_single(obj_data, action='report'):
+        self.probe_hosts()
+        if self.conf.concurrency > 1 or timeout:
+            for report in self.report_parallel(timeout):
+                yield report
+            return
+        connections.configure(self.conf)
+        cache.configure(self.conf)
+        try:
+            for obj_data in self.conf.objects:
+                logger.debug("Gathering report for: %s", obj_data)
+                for report in self.action_single(obj_data,
+                                                 action='report') or []:
+                    yield report
+        finally:
+            connections.pool.close_all()
+
+    def report_parallel(self, timeout=None):
+        """Gathers reports of several objects simultaneously
+
+        Objects are handled by worker processes, no more than
+        conf.host_concurrency objects of the same host at a time. Rows are
+        yielded as soon as the object they belong to is reported.
+        """
+        deadline = time.time() + timeout if timeout else None
+        pool = multiprocessing.Pool(
+            self.conf.concurrency, _init_worker, (self.conf,))
+        try:
+            objs = []
+            for obj_data in self.conf.objects:
+                objs.append(obj_data)
+                if self.conf.pass_completed:
+                    for report in self._report_objects(pool, objs, deadline):
+                        yield report
+                    objs = []
+            for report in self._report_objects(pool, objs, deadline):
                 yield report
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _report_objects(self, pool, objs, deadline):
+        results = Queue.Queue()
+        waiting = OrderedDict()
+        running = defaultdict(int)
+        for obj_data in objs:
+            host = self.conf.get_network_address(obj_data)
+            waiting.setdefault(host, deque()).append(obj_data)
+
+        def submit():
+            for host, queue in waiting.items():
+                while queue and running[host] < self.conf.host_concurrency:
+                    obj_data = queue.popleft()
+                    running[host] += 1
+                    submitted.append((obj_data, pool.apply_async(
+                        _report_object, (obj_data,),
+                        callback=lambda result, obj_data=obj_data:
+                        results.put((obj_data, result)))))
+
+        submitted = []
+        unfinished = list(objs)
+        submit()
+        while unfinished:
+            # wait with a timeout, otherwise get() isn't interruptible by
+            # KeyboardInterrupt, and failed workers are checked meanwhile
+            timeout = 1
+            if deadline is not None:
+                timeout = min(max(deadline - time.time(), 0), timeout)
+            try:
+                obj_data, (rows, failed) = results.get(timeout=timeout)
+            except Queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                submitted[:] = self._check_reports(submitted, results)
+                continue
+            unfinished.remove(obj_data)
+            running[self.conf.get_network_address(obj_data)] -= 1
+            submit()
+            if failed:
+                self.conf.on_network_error(obj_data)
+            for row in rows:
+                yield row
+
+        if unfinished:
+            logger.error("Report timed out, %s objects are not reported",
+                         len(unfinished))
+            # nothing will be reported for objects left in the config too
+            self.conf.objs.clear()
+            self.conf.try_again.clear()
+        for obj_data in unfinished:
+            yield _report_row(obj_data, self.conf, 'Report timed out.')
+
+    def _check_reports(self, submitted, results):
+        """Puts results of objects whose workers raised into results
+
+        Callback isn't called if the worker raised, e.g. when its result
+        couldn't be pickled, so such objects would never be finished.
+
+        :param submitted: list of (object, AsyncResult)
+        :returns: list of (object, AsyncResult) which are not ready yet
+        """
+        pending = []
+        for obj_data, result in submitted:
+            if not result.ready():
+                pending.append((obj_data, result))
+            elif not result.successful():
+                try:
+                    result.get()
+                except Exception as e:
+                    logger.error("Failed to gather report for %s: %s",
+                                 obj_data, e)
+                    results.put((obj_data, ([_report_row(
+                        obj_data, self.conf,
+                        'Report failed: {0}'.format(e))], False)))
+        return pending
@@ -0,0 +1,271 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import OrderedDict
+import contextlib
+import json
+import logging
+import os
+import StringIO
+import tarfile
+import time
+
+from shotgun import archive
+from shotgun import lazy
+
+fabric = lazy.LazyModule("fabric", "exceptions")
+
+
+logger = logging.getLogger(__name__)
+
+METRICS_NAME = "metrics.json"
+
+
+def new_counters():
+    """Returns counters which drivers update while making a snapshot"""
+    return {
+        "connect_seconds": 0.0,
+        "bytes_transferred": 0,
+        "bytes_written": 0,
+    }
+
+
+class CountingReader(object):
+    """File-like object which counts bytes read from fileobj"""
+
+    def __init__(self, fileobj, counters, *names):
+        self.fileobj = fileobj
+        self.counters = counters
+        self.names = names
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for name in self.names:
+            self.counters[name] += len(data)
+        return data
+
+
+class CountingWriter(object):
+    """File-like object which counts bytes written into fileobj"""
+
+    def __init__(self, fileobj, counters, *names):
+        self.fileobj = fileobj
+        self.counters = counters
+        self.names = names
+
+    def write(self, data):
+        self.fileobj.write(data)
+        for name in self.names:
+            self.counters[name] += len(data)
+
+
+def describe(obj):
+    """Returns short human readable description of the object"""
+    for key in ("path", "command", "dbname", "server", "containers"):
+        value = obj.get(key)
+        if value:
+            if isinstance(value, list):
+                value = "; ".join(value)
+            value = " ".join(str(value).split())
+            return value if len(value) <= 80 else value[:77] + "..."
+    return ""
+
+
+def disk_usage(path):
+    """Returns total size of regular files under the path
+
+    Hard links of the same file are counted once.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    inodes = set()
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            if os.path.isfile(filepath) and not os.path.islink(filepath):
+                info = os.stat(filepath)
+                if (info.st_dev, info.st_ino) not in inodes:
+                    inodes.add((info.st_dev, info.st_ino))
+                    total += info.st_size
+    return total
+
+
+def _record(obj, driver, status):
+    return OrderedDict([
+        ("host", driver.host),
+        ("type", obj.get("type")),
+        ("object", describe(obj)),
+        ("status", status),
+    ])
+
+
+def drop(records, obj, driver, reason):
+    """Records that the object was not collected at all"""
+    record = _record(obj, driver, "dropped")
+    record["reason"] = reason
+    record["seconds"] = 0.0
+    records.append(record)
+
+
+@contextlib.contextmanager
+def measure(records, obj, driver):
+    """Measures processing of the object by the driver
+
+    Record is appended to records even if processing fails. Network
+    errors are recorded, every further attempt gets its own record.
+    """
+    record = _record(obj, driver,
+                     "offline" if obj.get("type") == "offline" else "ok")
+    started = time.time()
+    try:
+        yield record
+    except fabric.exceptions.NetworkError:
+        record["status"] = "network_error"
+        raise
+    except Exception:
+        record["status"] = "failed"
+        raise
+    finally:
+        record["seconds"] = round(time.time() - started, 3)
+        counters = getattr(driver, "metrics", None)
+        if isinstance(counters, dict):
+            record.update(sorted(counters.items()))
+        records.append(record)
+
+
+class Profile(object):
+    """Metrics of a snapshot
+
+    Keeps per-object records and compression metrics which are put into
+    the archive as metrics.json.
+    """
+
+    def __init__(self):
+        self.objects = []
+        self.compression = None
+        self.dedup = None
+
+    def add(self, records):
+        self.objects.extend(records)
+
+    @contextlib.contextmanager
+    def measure_compression(self, target):
+        """Measures compression of the target directory
+
+        Yields dict which the path of the archive should be put into.
+        """
+        result = {}
+        input_bytes = disk_usage(target)
+        segments = archive.segments_dir(target)
+        segments_bytes = (disk_usage(segments)
+                          if os.path.isdir(segments) else 0)
+        started = time.time()
+        yield result
+        seconds = time.time() - started
+        output_bytes = os.path.getsize(result["path"])
+        self.compression = OrderedDict([
+            ("seconds", round(seconds, 3)),
+            ("input_bytes", input_bytes),
+            ("output_bytes", output_bytes),
+            ("ratio", round(float(input_bytes) / output_bytes, 2)
+             if output_bytes else None),
+            # data streamed into the archive is compressed while
+            # being collected
+            ("streamed_bytes", segments_bytes),
+        ])
+
+    def retries(self):
+        """Returns number of network errors per (host, object)"""
+        counts = {}
+        for record in self.objects:
+            if record["status"] == "network_error":
+                key = (record["host"], record["object"])
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def to_dict(self):
+        return OrderedDict([
+            ("objects", self.objects),
+            ("compression", self.compression),
+            ("dedup", self.dedup),
+        ])
+
+    def save(self, conf):
+        """Puts metrics.json into the archive of the target
+
+        Should be called after compression and before joining archive
+        segments, see archive.prepend_segments().
+        """
+        data = json.dumps(self.to_dict(), indent=1)
+        info = tarfile.TarInfo(os.path.join(
+            os.path.basename(conf.target), METRICS_NAME))
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        with archive.Segment(conf.target, conf.compression_level,
+                             conf.compression, 1) as segment:
+            segment.add(info, StringIO.StringIO(data))
+
+    def summary(self, top=10):
+        """Returns text report about the slowest objects and hosts"""
+        lines = []
+        hosts = OrderedDict()
+        for record in self.objects:
+            host = hosts.setdefault(record["host"], [0.0, 0, 0])
+            host[0] += record["seconds"]
+            host[1] += record.get("bytes_transferred", 0)
+            host[2] += record.get("bytes_written", 0)
+
+        lines.append("Slowest objects:")
+        for record in sorted(self.objects, key=lambda r: r["seconds"],
+                             reverse=True)[:top]:
+            lines.append(
+                "  {seconds:8.2f}s {status:<13} {host} {type}: {object} "
+                "({transferred} bytes transferred, {written} written)"
+                "".format(transferred=record.get("bytes_transferred", 0),
+                          written=record.get("bytes_written", 0),
+                          **record))
+
+        lines.append("Hosts:")
+        for host, (seconds, transferred, written) in sorted(
+                hosts.items(), key=lambda h: h[1][0], reverse=True):
+            lines.append(
+                "  {0:8.2f}s {1} ({2} bytes transferred, {3} written)"
+                "".format(seconds, host, transferred, written))
+
+        retries = self.retries()
+        if retries:
+            lines.append("Network errors:")
+            for (host, obj), count in sorted(retries.items()):
+                lines.append("  {0} {1}: {2}".format(host, obj, count))
+
+        dropped = [r for r in self.objects if r["status"] == "dropped"]
+        if dropped:
+            lines.append("Dropped objects:")
+            for record in dropped:
+                lines.append("  {host} {type}: {object}: {reason}".format(
+                    **record))
+
+        if self.dedup:
+            lines.append(
+                "Deduplication: {files} files, {bytes} bytes".format(
+                    **self.dedup))
+
+        if self.compression:
+            lines.append(
+                "Compression: {seconds:.2f}s, {input_bytes} -> "
+                "{output_bytes} bytes, ratio {ratio}".format(
+                    **self.compression))
+        return "\n".join(lines)
@@ -0,0 +1,196 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compiled plans of snapshots cached by content of their configs
+
+Generated configs may take megabytes of YAML, parsing them takes longer
+than the rest of the start. A plan is the parsed config with its object
+templates, see shotgun.config.compile_templates(). It is pickled into
+the cache directory under the hash of the config content, its parser
+and shotgun version, so the next run with the same config loads the plan
+without parsing the config.
+
+Unpickling runs code, so plans are read only from a directory and files
+owned by the current user and not writable by anybody else.
+"""
+
+import cPickle as pickle
+import errno
+import hashlib
+import logging
+import os
+import stat
+import tempfile
+
+import shotgun
+from shotgun import config
+from shotgun import fs
+from shotgun import metrics
+from shotgun import settings
+
+
+logger = logging.getLogger(__name__)
+
+# version of pickled plans, plans of other versions are compiled again
+FORMAT = 1
+EXTENSION = ".plan"
+
+
+class Plan(object):
+    """Config data with its compiled object templates"""
+
+    def __init__(self, data, templates=None):
+        self.data = data or {}
+        if templates is None:
+            templates = config.compile_templates(self.data)
+        self.templates = templates
+
+    def config(self):
+        return config.Config(self.data, self.templates)
+
+    def objects(self):
+        """Yields (host, type, description) of every object in order"""
+        for template, hosts in self.templates:
+            for host in hosts:
+                yield (config.Config.get_network_address({"host": host}) or
+                       "localhost",
+                       template.get("type"), metrics.describe(template))
+
+
+def diff(old, new):
+    """Returns objects removed from the old plan and added to the new one
+
+    :returns: list of (change, host, type, description), change is "-"
+              or "+"
+    """
+    old_objects = list(old.objects())
+    new_objects = list(new.objects())
+    old_set = set(old_objects)
+    new_set = set(new_objects)
+    return ([("-",) + obj for obj in old_objects if obj not in new_set] +
+            [("+",) + obj for obj in new_objects if obj not in old_set])
+
+
+def cache_path(content, parse, cache_dir):
+    """Returns path of the plan of the config content parsed by parse"""
+    key = hashlib.sha1(content)
+    # plans are compiled differently by other parsers and versions
+    key.update("\0{0}.{1}\0{2}".format(
+        getattr(parse, "__module__", ""), getattr(parse, "__name__", ""),
+        shotgun.__version__))
+    return os.path.join(cache_dir, "{0}.v{1}{2}".format(
+        key.hexdigest(), FORMAT, EXTENSION))
+
+
+def _trusted(info):
+    """Whether the stat result belongs to a file only we can change"""
+    return (info.st_uid == os.geteuid() and
+            not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def load(path, parse, cache_dir=settings.PLAN_CACHE):
+    """Returns plan of the config file
+
+    :param parse: function which parses content of the config, it is
+                  called only if the plan isn't cached
+    :param cache_dir: directory of compiled plans, None disables caching
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    if not cache_dir:
+        return Plan(parse(content))
+
+    cached = cache_path(content, parse, cache_dir)
+    plan = _read(cached)
+    if plan is not None:
+        logger.debug("Using compiled plan %s of %s", cached, path)
+        try:
+            # recently used plans are kept by prune()
+            os.utime(cached, None)
+        except OSError:
+            pass
+        return plan
+
+    plan = Plan(parse(content))
+    save(plan, cached)
+    return plan
+
+
+def _read(path):
+    """Returns the cached plan or None if it can't be used"""
+    try:
+        f = open(path, "rb")
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning("Failed to read plan %s: %s", path, e)
+        return None
+    with f:
+        if not (_trusted(os.fstat(f.fileno())) and
+                _trusted(os.stat(os.path.dirname(path)))):
+            logger.warning("Ignoring plan %s, it may be changed by other "
+                           "users", path)
+            return None
+        try:
+            return Plan(**pickle.load(f))
+        except Exception as e:
+            logger.warning("Plan %s is broken, compiling it again: %s",
+                           path, e)
+            return None
+
+
+def save(plan, path, keep=settings.PLAN_CACHE_SIZE):
+    """Writes the plan into the cache, failures are only logged
+
+    :param keep: number of the most recently used plans kept in the
+                 directory of the plan
+    """
+    directory = os.path.dirname(path)
+    temp = None
+    try:
+        fs.makedirs(directory, 0o700)
+        if not _trusted(os.stat(directory)):
+            logger.warning("Not saving plan %s, its directory may be "
+                           "changed by other users", path)
+            return
+        # the file is created readable and writable by its owner only
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"data": plan.data, "templates": plan.templates},
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+    except (IOError, OSError) as e:
+        logger.warning("Failed to save plan %s: %s", path, e)
+        if temp:
+            fs.remove(temp)
+        return
+    logger.debug("Saved compiled plan %s", path)
+    prune(directory, keep)
+
+
+def prune(directory, keep):
+    """Removes plans which weren't used recently"""
+    mtimes = {}
+    for name in os.listdir(directory):
+        if not name.endswith(EXTENSION):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError as e:
+            # removed by another run in the meantime
+            if e.errno != errno.ENOENT:
+                raise
+    for path in sorted(mtimes, key=mtimes.get, reverse=True)[keep:]:
+        logger.debug("Removing compiled plan %s", path)
+        fs.remove(path)
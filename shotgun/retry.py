@@ -0,0 +1,83 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+import logging
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def backoff(failures, base, cap):
+    """Returns delay before the next attempt after the given failures
+
+    The delay is doubled with every failure up to cap, half of it is
+    random, so hosts which failed together aren't retried together.
+    """
+    delay = min(cap, base * 2 ** (failures - 1))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class HostRetries(object):
+    """Network errors of hosts
+
+    Objects of a host which failed are retried after backoff(). After
+    the host fails threshold times its circuit is open: the host is
+    considered offline and its objects aren't tried anymore.
+
+    :param threshold: number of failures which opens the circuit
+    :param base: delay after the first failure in seconds
+    :param cap: maximum delay in seconds
+    """
+
+    def __init__(self, threshold, base, cap):
+        self.threshold = threshold
+        self.base = base
+        self.cap = cap
+        self.failures = defaultdict(int)
+        self.retry_at = {}
+
+    def failed(self, host):
+        """Records failure of the host
+
+        :returns: whether the circuit of the host is open now
+        """
+        self.failures[host] += 1
+        if self.is_open(host):
+            logger.warning("Host %s failed %s times, it is considered "
+                           "offline", host, self.failures[host])
+            self.retry_at.pop(host, None)
+            return True
+        delay = backoff(self.failures[host], self.base, self.cap)
+        logger.debug("Host %s failed, retrying in %.1f seconds",
+                     host, delay)
+        self.retry_at[host] = time.time() + delay
+        return False
+
+    def is_open(self, host):
+        return self.failures[host] >= self.threshold
+
+    def delay(self, host):
+        """Returns seconds until objects of the host may be retried"""
+        return max(self.retry_at.get(host, 0) - time.time(), 0)
+
+    def wait(self, hosts):
+        """Waits until objects of any of the hosts may be retried"""
+        delay = min([self.delay(host) for host in hosts] or [0])
+        if delay:
+            logger.debug("Waiting %.1f seconds for hosts to be retried",
+                         delay)
+            time.sleep(delay)
@@ -0,0 +1,119 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import ctypes
+import math
+import multiprocessing
+import os
+import time
+
+from shotgun import fs
+
+
+DROPPED_NAME = "DROPPED.txt"
+
+
+def sort_key(obj):
+    """Key which puts important and cheap objects first
+
+    Objects may declare "priority", higher is more important, and
+    "cost", estimated seconds it takes to collect the object. Both are 0
+    by default.
+    """
+    return (-obj.get("priority", 0), obj.get("cost", 0))
+
+
+class Deadline(object):
+    """Time budget of collecting objects of a snapshot
+
+    :param seconds: budget, None means unlimited
+    :param started: time the budget is counted from, now by default
+    """
+
+    def __init__(self, seconds, started=None):
+        self.at = None
+        if seconds:
+            self.at = (started or time.time()) + seconds
+
+    def remaining(self):
+        if self.at is None:
+            return None
+        return self.at - time.time()
+
+    def admit(self, obj, timeout):
+        """Decides whether the object can still be collected
+
+        Object which is expected to take longer than the rest of the
+        budget is dropped. Command timeout of an admitted object is cut
+        to the rest of the budget if it is longer, so its output is
+        truncated rather than making the snapshot late. Objects without
+        any timeout are left as they are.
+
+        :param obj: object data
+        :param timeout: command timeout applied to the object unless it
+                        sets its own one, None means unlimited
+        :returns: tuple (object data to collect or None, reason of
+                  dropping the object)
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return obj, None
+        if remaining <= 0:
+            return None, "deadline reached"
+        cost = obj.get("cost", 0)
+        if cost > remaining:
+            return None, ("estimated cost {0}s exceeds remaining {1:.0f}s"
+                          "".format(cost, remaining))
+        timeout = obj.get("timeout", timeout)
+        if timeout is None or timeout <= remaining:
+            return obj, None
+        return dict(obj, timeout=int(math.ceil(remaining))), None
+
+
+class Budget(object):
+    """Size of files which all objects of a snapshot may collect
+
+    The rest of the budget is shared by worker processes forked after it
+    is created.
+
+    :param size: bytes, None means unlimited
+    """
+
+    def __init__(self, size):
+        self._left = None
+        if size is not None:
+            self._left = multiprocessing.Value(ctypes.c_longlong, size)
+
+    def take(self, size):
+        """Takes up to size bytes from the budget
+
+        :returns: number of bytes taken
+        """
+        if self._left is None:
+            return size
+        with self._left.get_lock():
+            taken = min(size, max(self._left.value, 0))
+            self._left.value -= taken
+        return taken
+
+
+def write_dropped(target, records):
+    """Lists objects dropped because of the deadline in the target"""
+    dropped = [r for r in records if r["status"] == "dropped"]
+    if not dropped:
+        return
+    fs.makedirs(target)
+    with open(os.path.join(target, DROPPED_NAME), "w") as f:
+        for record in dropped:
+            f.write("{host} {type}: {object}: {reason}\n".format(**record))
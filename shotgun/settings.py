@@ -14,8 +14,42 @@
 
 TARGET = "/tmp/snapshot"
 LASTDUMP = "/tmp/snapshot_last"
+MANIFEST = "/var/lib/shotgun/manifest.json"
 TIMESTAMP = True
+COMPRESSION = "xz"
 COMPRESSION_LEVEL = 3
+# 0 means number of CPUs, xz before 5.2 supports a single thread only
+COMPRESSION_THREADS = 1
+# replace identical collected files with hard links before compression,
+# files of a single host can't be extracted from such archive alone
+DEDUP = False
 LOG_FILE = "/var/log/shotgun.log"
+# compiled plans of configs, see shotgun.plan, None disables caching
+PLAN_CACHE = "/var/cache/shotgun/plans"
+# number of the most recently used plans kept in the cache
+PLAN_CACHE_SIZE = 16
 DEFAULT_TIMEOUT = 10
+# bytes of command output kept in memory, larger output is truncated
+MAX_OUTPUT_SIZE = 64 * 1024 * 1024
+# network errors after which host is considered offline
 ATTEMPTS = 2
+# seconds before retrying objects of a host after its first network error,
+# doubled on every next one up to RETRY_BACKOFF_MAX
+RETRY_BACKOFF = 1
+RETRY_BACKOFF_MAX = 30
+# seconds for collecting all objects of a snapshot, None means unlimited
+DEADLINE = None
+# bytes of files collected by all file objects of a snapshot, None means
+# unlimited, see shotgun.scheduler.Budget
+MAX_SNAPSHOT_BYTES = None
+CONCURRENCY = 1
+# number of report objects of a single host processed simultaneously
+HOST_CONCURRENCY = 4
+MAX_CONNECTIONS = 50
+CONNECTION_IDLE_TIMEOUT = 60
+# timeout of checking that hosts accept connections to their SSH port
+# before collecting, 0 disables the check; it connects to the hosts
+# directly, so it can't be used for hosts behind an SSH gateway
+PROBE_TIMEOUT = 0
+# bytes of command output kept for reuse during a run, 0 disables caching
+COMMAND_CACHE_SIZE = 16 * 1024 * 1024
@@ -0,0 +1,124 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Fake docker daemon serving a part of the Engine API on a unix socket"""
+
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import StringIO
+import struct
+import subprocess
+import tarfile
+import threading
+import urlparse
+import uuid
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=None, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self, message):
+        self.respond(404, {"message": message})
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        containers = self.server.containers
+        if parts == ["containers", "json"]:
+            self.respond(200, [{"Id": cid, "Names": ["/" + c["name"]]}
+                               for cid, c in sorted(containers.items())])
+        elif parts[0] == "exec" and parts[2] == "json":
+            self.respond(200, {"ExitCode": self.server.execs[parts[1]][1]})
+        elif parts[0] == "containers" and parts[2] == "archive":
+            if parts[1] not in containers:
+                return self.not_found("No such container")
+            path = urlparse.parse_qs(url.query)["path"][0]
+            files = containers[parts[1]]["files"]
+            if path not in files:
+                return self.not_found("No such file: " + path)
+            data = StringIO.StringIO()
+            with tarfile.open(fileobj=data, mode="w") as tar:
+                info = tarfile.TarInfo(os.path.basename(path))
+                info.size = len(files[path])
+                tar.addfile(info, StringIO.StringIO(files[path]))
+            self.respond(200, data.getvalue(), "application/x-tar")
+        else:
+            self.not_found("Unknown path")
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        body = json.loads(
+            self.rfile.read(int(self.headers["Content-Length"])))
+        if parts[0] == "containers" and parts[2] == "exec":
+            if parts[1] not in self.server.containers:
+                return self.not_found("No such container")
+            exec_id = uuid.uuid4().hex
+            self.server.execs[exec_id] = [body["Cmd"], None]
+            self.respond(201, {"Id": exec_id})
+        elif parts[0] == "exec" and parts[2] == "start":
+            # commands are run locally
+            process = subprocess.Popen(
+                self.server.execs[parts[1]][0], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+            self.server.execs[parts[1]][1] = process.returncode
+            frames = "".join(
+                struct.pack(">BxxxL", stream, len(data)) + data
+                for stream, data in ((1, stdout), (2, stderr)) if data)
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "application/vnd.docker.raw-stream")
+            self.end_headers()
+            self.wfile.write(frames)
+        else:
+            self.not_found("Unknown path")
+
+
+class FakeDocker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Docker daemon with the given containers
+
+    :param containers: {id: {"name": name, "files": {path: content}}}
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, containers):
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.containers = containers
+        self.execs = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={"poll_interval": 0.01})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,176 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import gzip
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+
+import mock
+
+from shotgun import archive
+from shotgun.test import base
+from shotgun import utils
+
+
+def make_tar(files):
+    buf = StringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO.StringIO(content))
+    buf.seek(0)
+    return buf
+
+
+class TestArchive(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.target = os.path.join(self.tmp, "snapshot")
+
+    def read_archive(self, path):
+        with tarfile.open(path.replace(".xz", ""), "r") as tar:
+            return dict((m.name, tar.extractfile(m).read())
+                        for m in tar if m.isreg())
+
+    def test_segment_add_stream(self):
+        stream = make_tar([
+            ("var/log/a.log", "a" * 1000),
+            ("var/log/sub/b.test", "b"),
+            ("var/log/sub/c.log", "c"),
+        ])
+        with archive.Segment(self.target, "-1") as segment:
+            count = segment.add_stream(
+                stream, "snapshot/node-1", "/var/log", ["sub/*.test"])
+        self.assertEqual(2, count)
+
+        os.makedirs(self.target)
+        with open(os.path.join(self.target, "local.txt"), "w") as f:
+            f.write("local")
+        utils.compress(self.target, "-1")
+        path = "{0}.tar.xz".format(self.target)
+        archive.prepend_segments(path, self.target)
+
+        self.assertFalse(os.path.exists(archive.segments_dir(self.target)))
+        utils.execute("xz -d {0}".format(path))
+        self.assertEqual({
+            "snapshot/node-1/var/log/a.log": "a" * 1000,
+            "snapshot/node-1/var/log/sub/c.log": "c",
+            "snapshot/local.txt": "local",
+        }, self.read_archive(path))
+
+    def test_segment_discarded_on_error(self):
+        with self.assertRaises(tarfile.ReadError):
+            with archive.Segment(self.target, "-1") as segment:
+                segment.add_stream(StringIO.StringIO("garbage"), "prefix")
+        self.assertEqual(
+            [], os.listdir(archive.segments_dir(self.target)))
+
+    def test_process_writer_failure(self):
+        with tempfile.TemporaryFile() as f:
+            writer = archive.ProcessWriter(
+                ["sh", "-c", "cat >/dev/null; exit 3"], f)
+            writer.write("data")
+            self.assertRaises(archive.CompressionError, writer.close)
+
+    def test_extract_stream(self):
+        stream = make_tar([
+            ("var/log/a.log", "a"),
+            ("../escape", "x"),
+            ("/abs", "x"),
+        ])
+        self.assertEqual(1, archive.extract_stream(stream, self.target))
+        self.assertEqual(
+            ["var/log/a.log"],
+            [os.path.relpath(os.path.join(root, f), self.target)
+             for root, _, files in os.walk(self.tmp) for f in files])
+
+    def test_extract_stream_links(self):
+        outside = os.path.join(self.tmp, "outside")
+        os.mkdir(outside)
+        os.makedirs(self.target)
+        os.symlink(outside, os.path.join(self.target, "existing"))
+        buf = StringIO.StringIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for name, linkname, kind in (
+                    ("link", outside, tarfile.SYMTYPE),
+                    ("up", "../outside", tarfile.SYMTYPE),
+                    ("hard", "../outside/x", tarfile.LNKTYPE),
+                    ("etc/local", "../data", tarfile.SYMTYPE)):
+                info = tarfile.TarInfo(name)
+                info.type = kind
+                info.linkname = linkname
+                tar.addfile(info)
+            for name in ("link/evil", "up/evil", "existing/evil", "data"):
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                tar.addfile(info, StringIO.StringIO("evil"))
+        buf.seek(0)
+
+        # skipped links leave plain directories for members inside them
+        self.assertEqual(4, archive.extract_stream(buf, self.target))
+        self.assertEqual([], os.listdir(outside))
+        self.assertTrue(os.path.isdir(os.path.join(self.target, "link")))
+        self.assertEqual(
+            "evil", open(os.path.join(self.target, "etc/local")).read())
+
+    def test_excluded_directory(self):
+        self.assertTrue(archive.excluded(
+            "var/log/remote/node-1/x.log", "/var/log/", ["remote"]))
+        self.assertFalse(archive.excluded(
+            "var/log/remote.log", "/var/log/", ["remote"]))
+        self.assertFalse(archive.excluded(
+            "var/log", "/var/log/", ["*"]))
+
+    def test_excluded_wildcards_dont_match_slash(self):
+        self.assertTrue(archive.excluded(
+            "var/log/a.test", "/var/log/", ["*.test"]))
+        self.assertFalse(archive.excluded(
+            "var/log/sub/a.test", "/var/log/", ["*.test"]))
+        self.assertTrue(archive.excluded(
+            "var/log/sub/a.test", "/var/log/", ["*/*.test"]))
+
+
+class TestCodecs(base.BaseTestCase):
+
+    @mock.patch.object(archive.GzipWriter, 'block_size', 10)
+    def test_gzip_writer(self):
+        data = "".join(str(i) for i in range(1000))
+        out = StringIO.StringIO()
+        writer = archive.get_codec("gzip", "-6", threads=3).writer(out)
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+        writer.close()
+
+        out.seek(0)
+        self.assertEqual(data, gzip.GzipFile(fileobj=out).read())
+
+    def test_xz_tar_command(self):
+        codec = archive.get_codec("xz", "-3", 4)
+        self.assertEqual(
+            ("tar cJvf /a.tar.xz -C / a", {"XZ_OPT": "-3 -T4"}),
+            codec.tar_command("/a.tar.xz", "/", "a"))
+
+    @mock.patch('shotgun.archive.multiprocessing.cpu_count')
+    def test_zero_threads_use_all_cpus(self, mcpu_count):
+        mcpu_count.return_value = 16
+        self.assertEqual(16, archive.get_codec("zstd", 3, 0).threads)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, archive.get_codec, "rar", 3)
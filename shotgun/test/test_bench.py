@@ -0,0 +1,67 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import shutil
+import tempfile
+
+from shotgun import bench
+from shotgun import driver
+from shotgun.test import base
+
+
+class TestBench(base.BaseTestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_local_hosts(self):
+        data = {"type": "command", "command": "true",
+                "host": {"hostname": "bench-0"}}
+        with bench.local_hosts():
+            drv = driver.Driver.getDriver(data, bench.Config({}))
+        self.assertIsInstance(drv, driver.Command)
+        self.assertEqual("bench-0", drv.host)
+        self.assertIsNone(drv.dest_host)
+        self.assertEqual(
+            "bench-0",
+            driver.Driver.getDriver(data, bench.Config({})).dest_host)
+
+    def test_run(self):
+        results = bench.run(self.workdir, hosts=2, objects=1, files=2,
+                            file_size=100, concurrency=[1, 2], repeat=1,
+                            compression="gzip")
+        self.assertEqual(
+            ["startup",
+             "snapshot concurrency=1", "report concurrency=1",
+             "snapshot concurrency=2", "report concurrency=2"],
+            list(results["results"]))
+        snapshot = results["results"]["snapshot concurrency=2"]
+        self.assertEqual(2, snapshot["drivers"]["dir"]["objects"])
+        self.assertEqual(2, snapshot["drivers"]["command"]["objects"])
+        self.assertLessEqual(400, snapshot["drivers"]["dir"]["bytes_written"])
+        self.assertTrue(snapshot["compression"]["ratio"])
+        report = results["results"]["report concurrency=2"]
+        # output line and the empty one after it for both hosts
+        self.assertEqual(4, report["rows"])
+
+    def test_compare(self):
+        old = {"params": {"hosts": 1},
+               "results": {"snapshot": {"best": 2.0},
+                           "removed": {"best": 1.0}}}
+        new = {"params": {"hosts": 1},
+               "results": {"snapshot": {"best": 1.5},
+                           "added": {"best": 1.0}}}
+        self.assertEqual(["snapshot: 2.000s -> 1.500s (-25.0%)"],
+                         bench.compare(old, new))
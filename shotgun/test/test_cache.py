@@ -0,0 +1,62 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from shotgun import cache
+from shotgun.driver import CommandOut
+from shotgun.test import base
+
+
+def command_out(stdout):
+    out = CommandOut()
+    out.stdout = stdout
+    out.return_code = 0
+    return out
+
+
+class TestCommandCache(base.BaseTestCase):
+
+    def test_get_put(self):
+        commands = cache.CommandCache(max_size=100)
+        out = command_out("output")
+        self.assertIsNone(commands.get("host", "cmd"))
+        commands.put("host", "cmd", out)
+        self.assertIs(out, commands.get("host", "cmd"))
+        self.assertIsNone(commands.get("other", "cmd"))
+        self.assertIsNone(commands.get(None, "cmd"))
+
+    def test_disabled(self):
+        commands = cache.CommandCache(max_size=0)
+        commands.put("host", "cmd", command_out(""))
+        self.assertIsNone(commands.get("host", "cmd"))
+
+    def test_size_cap(self):
+        commands = cache.CommandCache(max_size=10)
+        commands.put("host", "big", command_out("x" * 11))
+        self.assertIsNone(commands.get("host", "big"))
+
+        commands.put("host", "cmd1", command_out("x" * 4))
+        commands.put("host", "cmd2", command_out("x" * 4))
+        # cmd1 becomes the most recently used one
+        commands.get("host", "cmd1")
+        commands.put("host", "cmd3", command_out("x" * 4))
+        self.assertIsNone(commands.get("host", "cmd2"))
+        self.assertIsNotNone(commands.get("host", "cmd1"))
+        self.assertIsNotNone(commands.get("host", "cmd3"))
+        self.assertEqual(8, commands.size)
+
+    def test_put_replaces(self):
+        commands = cache.CommandCache(max_size=10)
+        commands.put("host", "cmd", command_out("x" * 6))
+        commands.put("host", "cmd", command_out("x" * 8))
+        self.assertEqual(8, commands.size)
@@ -156,3 +156,219 @@ class TestConfig(base.BaseTestCase):
             {'host': 'fake_host3', 'fake_obj_1': '1'},
             {'host': 'fake_host3', 'fake_obj_2': '2'}]
         self.assertItemsEqual(expected_objs, conf.objs)
+
+    @mock.patch('shotgun.config.settings')
+    def test_concurrency(self, m_settings):
+        self.assertIs(Config({}).concurrency, m_settings.CONCURRENCY)
+        self.assertEqual(Config({'concurrency': 8}).concurrency, 8)
+
+    @mock.patch('shotgun.config.settings')
+    def test_deadline(self, m_settings):
+        self.assertIs(Config({}).deadline, m_settings.DEADLINE)
+        self.assertEqual(Config({'deadline': 300}).deadline, 300)
+
+    def test_objects_ordered_by_priority(self):
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects": [
+                        {"path": "/low", "priority": -1},
+                        {"path": "/default"},
+                        {"path": "/high", "priority": 1},
+                    ],
+                    "hosts": [{"address": "h1"}],
+                },
+            },
+        }
+        conf = Config(data)
+        self.assertEqual(["/high", "/default", "/low"],
+                         [o["path"] for o in conf.objs])
+
+    @mock.patch('shotgun.config.settings')
+    def test_command_cache_size(self, m_settings):
+        self.assertIs(Config({}).command_cache_size,
+                      m_settings.COMMAND_CACHE_SIZE)
+        self.assertEqual(
+            Config({'command_cache_size': 0}).command_cache_size, 0)
+
+    @mock.patch('shotgun.config.settings')
+    def test_host_concurrency(self, m_settings):
+        self.assertIs(Config({}).host_concurrency,
+                      m_settings.HOST_CONCURRENCY)
+        self.assertEqual(
+            Config({'host_concurrency': 2}).host_concurrency, 2)
+
+    def test_pass_completed(self):
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects":
+                        [{"fake_obj_1": '1'}, {"fake_obj_2": '2'}]},
+            }
+        }
+        conf = Config(data)
+        objects = conf.objects
+        objects.next()
+        self.assertFalse(conf.pass_completed)
+        objects.next()
+        self.assertTrue(conf.pass_completed)
+
+    @mock.patch('shotgun.retry.random.uniform', return_value=0)
+    @mock.patch('shotgun.retry.time')
+    def test_objects_retry_with_backoff(self, mtime, muniform):
+        mtime.time.return_value = 100.0
+
+        def sleep(seconds):
+            mtime.time.return_value += seconds
+        mtime.sleep.side_effect = sleep
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects": [{"path": "/file1"}, {"path": "/file2"}],
+                    "hosts": [{"address": "host1"}, {"address": "host2"}],
+                },
+            },
+            "attempts": 3,
+            "retry_backoff": 4,
+        }
+        conf = Config(data)
+        objects = conf.objects
+        processed = []
+        for obj in objects:
+            processed.append((obj["host"]["address"], obj["path"]))
+            if processed == [("host1", "/file1")]:
+                conf.on_network_error(obj)
+
+        # host1 is retried after the rest of objects, when its delay is over
+        self.assertEqual([("host1", "/file1"), ("host2", "/file1"),
+                          ("host2", "/file2"), ("host1", "/file1"),
+                          ("host1", "/file2")], processed)
+        mtime.sleep.assert_called_once_with(2)
+
+    @mock.patch('shotgun.retry.random.uniform', return_value=0)
+    @mock.patch('shotgun.retry.time')
+    def test_iter_objects_without_waiting(self, mtime, muniform):
+        mtime.time.return_value = 100.0
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects": [{"path": "/file1"}],
+                    "hosts": [{"address": "host1"}, {"address": "host2"}],
+                },
+            },
+            "retry_backoff": 4,
+        }
+        conf = Config(data)
+        processed = []
+        for obj in conf.iter_objects(wait=False):
+            processed.append(obj["host"]["address"])
+            if obj["host"]["address"] == "host1":
+                conf.on_network_error(obj)
+
+        # the failed object is left for its retry time
+        self.assertEqual(["host1", "host2"], processed)
+        self.assertFalse(mtime.sleep.called)
+        self.assertEqual(2, conf.retry_delay)
+
+        mtime.time.return_value += 2
+        self.assertEqual(0, conf.retry_delay)
+        self.assertEqual(["host1"], [obj["host"]["address"] for obj in
+                                     conf.iter_objects(wait=False)])
+
+    def test_objects_circuit_breaker(self):
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects": [{"path": "/file1", "type": "file"},
+                                {"path": "/file2", "type": "file"}],
+                    "hosts": [{"address": "host1"}],
+                },
+            },
+            "attempts": 1,
+        }
+        conf = Config(data)
+        processed = []
+        for obj in conf.objects:
+            processed.append((obj["type"], obj["path"]))
+            if obj["type"] != "offline":
+                conf.on_network_error(obj)
+
+        # the failed object is processed as offline, the rest is skipped
+        self.assertEqual([("file", "/file1"), ("offline", "/file1")],
+                         processed)
+
+    def test_compression_level(self):
+        self.assertEqual('-6', Config({'compression_level': 6})
+                         .compression_level)
+
+    @mock.patch('shotgun.config.settings')
+    def test_compression_defaults(self, m_settings):
+        conf = Config({})
+        self.assertIs(conf.compression, m_settings.COMPRESSION)
+        self.assertIs(conf.compression_threads,
+                      m_settings.COMPRESSION_THREADS)
+
+    def test_default_limits(self):
+        data = {
+            "limits": {"max_bytes": 100, "tail_bytes": 10},
+            "dump": {
+                "fake_role1": {
+                    "objects": [
+                        {"type": "dir", "path": "/var/log",
+                         "max_bytes": 200},
+                        {"type": "command", "command": "ls"}]},
+            }
+        }
+        conf = Config(data)
+        self.assertItemsEqual([
+            {"host": {}, "type": "dir", "path": "/var/log",
+             "max_bytes": 200, "tail_bytes": 10},
+            {"host": {}, "type": "command", "command": "ls"},
+        ], conf.objs)
+
+    def test_objects_of_large_inventory(self):
+        hosts = [{"address": "node-{0}".format(i)} for i in range(2000)]
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects": [{"type": "file", "path": "/file{0}".format(i)}
+                                for i in range(60)],
+                    "hosts": hosts,
+                },
+            },
+        }
+        conf = Config(data)
+        # objects are bound to hosts only when they are taken
+        self.assertEqual(60, len(conf.objs.templates))
+        self.assertEqual(120000, len(conf.objs))
+
+        objects = conf.objects
+        obj = objects.next()
+        self.assertEqual({"type": "file", "path": "/file0",
+                          "host": {"address": "node-0"}}, obj)
+        obj["type"] = "offline"
+        self.assertEqual("file", objects.next()["type"])
+        self.assertEqual(set(h["address"] for h in hosts), conf.hosts)
+
+    def test_set_offline(self):
+        data = {
+            "dump": {
+                "fake_role1": {
+                    "objects": [{"type": "file", "path": "/file1"},
+                                {"type": "file", "path": "/file2"}],
+                    "hosts": [{"address": "host1"}, {"address": "host2"}],
+                },
+            },
+        }
+        conf = Config(data)
+        conf.set_offline(set(["host1"]))
+        expected = [
+            ("host1", "offline", "/file1"),
+            ("host2", "file", "/file1"),
+            ("host2", "file", "/file2"),
+        ]
+        self.assertEqual(expected, [
+            (o["host"]["address"], o["type"], o["path"]) for o in conf.objs])
+        self.assertEqual(expected, [
+            (o["host"]["address"], o["type"], o["path"])
+            for o in conf.objects])
@@ -0,0 +1,108 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from shotgun import connections
+from shotgun.test import base
+
+
+class TestConnectionPool(base.BaseTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('shotgun.connections.fabric.state.connections',
+                             new={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def opened(self, *hosts):
+        for host in hosts:
+            connections.fabric.state.connections[host] = mock.Mock()
+
+    @mock.patch('shotgun.connections.time.time')
+    def test_idle_connections_closed(self, mtime):
+        pool = connections.ConnectionPool(max_size=10, idle_timeout=5)
+        mtime.return_value = 100
+        pool.acquire('host1', 'key')
+        self.opened('host1')
+        client = connections.fabric.state.connections['host1']
+
+        mtime.return_value = 103
+        pool.acquire('host2', 'key')
+        self.assertIn('host1', connections.fabric.state.connections)
+
+        mtime.return_value = 106
+        pool.acquire('host2', 'key')
+        client.close.assert_called_once_with()
+        self.assertNotIn('host1', connections.fabric.state.connections)
+        self.assertEqual([('host2', 'key')], list(pool.last_used))
+
+    def test_least_recently_used_closed(self):
+        pool = connections.ConnectionPool(max_size=2, idle_timeout=100)
+        for host in ('host1', 'host2', 'host1', 'host3'):
+            pool.acquire(host, 'key')
+            self.opened(host)
+        self.assertEqual([('host1', 'key'), ('host3', 'key')],
+                         list(pool.last_used))
+        self.assertNotIn('host2', connections.fabric.state.connections)
+
+    def test_ssh_key_change_reconnects(self):
+        pool = connections.ConnectionPool(max_size=2, idle_timeout=100)
+        pool.acquire('host1', 'key1')
+        self.opened('host1')
+        client = connections.fabric.state.connections['host1']
+        pool.acquire('host1', 'key2')
+        client.close.assert_called_once_with()
+        self.assertEqual([('host1', 'key2')], list(pool.last_used))
+
+    def test_close_all(self):
+        pool = connections.ConnectionPool(max_size=10, idle_timeout=100)
+        for host in ('host1', 'host2'):
+            pool.acquire(host)
+            self.opened(host)
+        clients = connections.fabric.state.connections.values()
+        pool.close_all()
+        for client in clients:
+            client.close.assert_called_once_with()
+        self.assertEqual({}, connections.fabric.state.connections)
+        self.assertFalse(pool.last_used)
+
+
+class TestProbe(base.BaseTestCase):
+
+    @mock.patch('shotgun.connections.socket.create_connection')
+    def test_probe(self, mconnect):
+        def connect(address, timeout):
+            if address[0] == 'down':
+                raise connections.socket.timeout('timed out')
+            return mock.Mock()
+        mconnect.side_effect = connect
+
+        unreachable = connections.probe(set(['up', 'down']), 3)
+
+        self.assertEqual(set(['down']), unreachable)
+        mconnect.assert_has_calls([mock.call(('down', 22), 3),
+                                   mock.call(('up', 22), 3)],
+                                  any_order=True)
+
+    @mock.patch('shotgun.connections.socket.create_connection')
+    def test_probe_port(self, mconnect):
+        self.assertEqual(set(), connections.probe(
+            set(['10.0.0.1:2222', 'fe80::1']), 3))
+        mconnect.assert_has_calls([mock.call(('10.0.0.1', 2222), 3),
+                                   mock.call(('fe80::1', 22), 3)],
+                                  any_order=True)
+
+    def test_probe_no_hosts(self):
+        self.assertEqual(set(), connections.probe(set(), 3))
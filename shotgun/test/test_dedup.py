@@ -0,0 +1,104 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tarfile
+import tempfile
+
+from shotgun import dedup
+from shotgun import metrics
+from shotgun.test import base
+
+
+class TestDedup(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.target = os.path.join(self.tmp, "snapshot")
+        self.files = {
+            "node-1/etc/nova/nova.conf": "debug = True\n",
+            "node-2/etc/nova/nova.conf": "debug = True\n",
+            "node-3/etc/nova/nova.conf": "debug = Fals\n",
+            "node-1/commands/rpm-qa.txt": "bash\npython\n" * 100,
+            "node-2/commands/rpm-qa.txt": "bash\npython\n" * 100,
+            "node-3/commands/rpm-qa.txt": "bash\npython\n" * 100,
+            "node-1/empty": "",
+            "node-2/empty": "",
+            "node-2/unique": "unique\n",
+        }
+        for name, content in self.files.items():
+            path = self.path(name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(content)
+            os.utime(path, (1000000000, 1000000000))
+
+    def path(self, name):
+        return os.path.join(self.target, name)
+
+    def inode(self, name):
+        return os.stat(self.path(name)).st_ino
+
+    def test_link_duplicates(self):
+        result = dedup.link_duplicates(self.target)
+
+        self.assertEqual({"files": 3, "bytes": 13 + 2 * 1200}, result)
+        self.assertEqual(self.inode("node-1/etc/nova/nova.conf"),
+                         self.inode("node-2/etc/nova/nova.conf"))
+        self.assertNotEqual(self.inode("node-1/etc/nova/nova.conf"),
+                            self.inode("node-3/etc/nova/nova.conf"))
+        self.assertEqual(self.inode("node-1/commands/rpm-qa.txt"),
+                         self.inode("node-3/commands/rpm-qa.txt"))
+        self.assertNotEqual(self.inode("node-1/empty"),
+                            self.inode("node-2/empty"))
+        for name, content in self.files.items():
+            with open(self.path(name)) as f:
+                self.assertEqual(content, f.read())
+
+        # files which are already linked aren't linked again
+        self.assertEqual({"files": 0, "bytes": 0},
+                         dedup.link_duplicates(self.target, workers=1))
+
+    def test_different_mode_not_linked(self):
+        os.chmod(self.path("node-2/etc/nova/nova.conf"), 0o600)
+        result = dedup.link_duplicates(self.target)
+
+        self.assertEqual({"files": 2, "bytes": 2 * 1200}, result)
+        self.assertNotEqual(self.inode("node-1/etc/nova/nova.conf"),
+                            self.inode("node-2/etc/nova/nova.conf"))
+
+    def test_different_mtime_not_linked(self):
+        os.utime(self.path("node-2/etc/nova/nova.conf"),
+                 (1000000000, 1000000001))
+        result = dedup.link_duplicates(self.target)
+
+        self.assertEqual({"files": 2, "bytes": 2 * 1200}, result)
+        self.assertEqual(1000000001, os.stat(
+            self.path("node-2/etc/nova/nova.conf")).st_mtime)
+
+    def test_archive_size(self):
+        size = metrics.disk_usage(self.target)
+        dedup.link_duplicates(self.target)
+        self.assertEqual(size - 13 - 2 * 1200,
+                         metrics.disk_usage(self.target))
+
+        path = os.path.join(self.tmp, "snapshot.tar")
+        with tarfile.open(path, "w") as tar:
+            tar.add(self.target, "snapshot")
+        with tarfile.open(path) as tar:
+            links = [m.name for m in tar.getmembers() if m.islnk()]
+        self.assertEqual(3, len(links))
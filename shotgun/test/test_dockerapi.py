@@ -0,0 +1,71 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import StringIO
+import struct
+import tarfile
+import tempfile
+
+from shotgun import dockerapi
+from shotgun.test import base
+from shotgun.test.fake_docker import FakeDocker
+
+
+class TestDockerAPI(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        socket_path = os.path.join(self.tmp, "docker.sock")
+        self.server = FakeDocker(socket_path, {
+            "abc": {"name": "nailgun",
+                    "files": {"/etc/nailgun/settings.yaml": "DEBUG: true\n"}},
+        })
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.client = dockerapi.Client(socket_path, timeout=10)
+
+    def test_demux(self):
+        stream = StringIO.StringIO(
+            struct.pack(">BxxxL", 1, 3) + "out" +
+            struct.pack(">BxxxL", 2, 3) + "err" +
+            struct.pack(">BxxxL", 1, 0))
+        self.assertEqual([(1, "out"), (2, "err"), (1, "")],
+                         list(dockerapi.demux(stream)))
+
+    def test_containers(self):
+        self.assertEqual([{"Id": "abc", "Names": ["/nailgun"]}],
+                         self.client.containers())
+
+    def test_execute(self):
+        self.assertEqual(
+            (3, "out\n", "err\n"),
+            self.client.execute("abc", ["sh", "-c",
+                                        "echo out; echo err >&2; exit 3"]))
+
+    def test_execute_no_container(self):
+        with self.assertRaises(dockerapi.APIError) as cm:
+            self.client.execute("xyz", ["true"])
+        self.assertEqual(404, cm.exception.status)
+
+    def test_get_archive(self):
+        with self.client.get_archive(
+                "abc", "/etc/nailgun/settings.yaml") as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                member = tar.next()
+                self.assertEqual("settings.yaml", member.name)
+                self.assertEqual("DEBUG: true\n",
+                                 tar.extractfile(member).read())
@@ -13,15 +13,24 @@
 #    under the License.
 
 import itertools
+import json
 import os
 import random
-import sys
+import shlex
+import shutil
+import SimpleXMLRPCServer
+import subprocess
+import tarfile
+import tempfile
+import threading
 
-import fabric
+import fabric.exceptions
 import mock
 
 import shotgun
+import shotgun.scheduler
 from shotgun.test import base
+from shotgun.test.fake_docker import FakeDocker
 
 
 class RunOut(object):
@@ -34,6 +43,12 @@ class RunOut(object):
 
 
 class TestDriver(base.BaseTestCase):
+    def setUp(self):
+        # connections are opened by fabric.api calls mocked in the tests
+        patcher = mock.patch('shotgun.driver.fabric.state.connections')
+        self.mconnections = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_driver_factory(self):
         types = {
             "file": "File",
@@ -54,6 +69,7 @@ class TestDriver(base.BaseTestCase):
         out.stdout = "STDOUT"
         out.return_code = "RETURN_CODE"
         mccstring.return_value.getvalue.return_value = out.stdout
+        mccstring.return_value.truncated = False
 
         runout = RunOut()
         runout.return_code = "RETURN_CODE"
@@ -118,9 +134,14 @@ class TestDriver(base.BaseTestCase):
         conf = mock.Mock()
         driver = shotgun.driver.Driver({}, conf)
         result = driver.command(command)
-        shotgun.driver.utils.execute.assert_called_with(command)
+        shotgun.driver.utils.execute.assert_called_with(command,
+                                                        timeout=None)
         self.assertEqual(result, out)
 
+        driver = shotgun.driver.Driver({"timeout": 5}, conf)
+        driver.command(command)
+        shotgun.driver.utils.execute.assert_called_with(command, timeout=5)
+
     @mock.patch('shotgun.driver.utils.CCStringIO')
     @mock.patch('shotgun.driver.fabric.api.settings')
     @mock.patch('shotgun.driver.fabric.api.run')
@@ -143,16 +164,89 @@ class TestDriver(base.BaseTestCase):
         result = driver.command(command)
 
         mstringio.assert_has_calls([
-            mock.call(writers=sys.stdout),
+            mock.call(writers=None,
+                      max_size=shotgun.settings.MAX_OUTPUT_SIZE),
         ])
         mfabrun.assert_called_with(command, stdout=mstdout)
         self.assertEqual(result.stdout, 'FULL STDOUT')
 
-    @mock.patch('shotgun.driver.utils.execute')
+    @mock.patch('shotgun.driver.fabric.api.settings')
+    @mock.patch('shotgun.driver.fabric.api.run')
+    def test_command_output_capped(self, mfabrun, mfabset):
+        def run(command, stdout):
+            stdout.write('0123456789')
+            result = RunOut()
+            result.return_code = 0
+            return result
+
+        mfabrun.side_effect = run
+        driver = shotgun.driver.Driver({
+            "host": {"address": "10.109.0.2"},
+            "max_output": 4,
+            "echo": True,
+        }, mock.Mock())
+        with mock.patch('shotgun.driver.sys.stdout') as mstdout:
+            result = driver.command("COMMAND")
+        mstdout.write.assert_called_once_with('0123456789')
+        self.assertEqual("0123\n[output truncated to 4 bytes]",
+                         result.stdout)
+        self.assertEqual(result.stdout, result.output)
+
+    @mock.patch('shotgun.driver.fabric.api.settings')
+    @mock.patch('shotgun.driver.connections.pool')
+    def test_remote_command_to_file(self, mpool, mfabset):
+        channel = mock.Mock()
+        channel.recv.side_effect = ['chunk1', 'chunk2', '']
+        channel.recv_exit_status.return_value = 3
+        client = mock.Mock()
+        client.get_transport.return_value.open_session.return_value = channel
+        driver = shotgun.driver.Driver({
+            "host": {"address": "10.109.0.2"},
+        }, mock.Mock())
+        self.mconnections.__getitem__.return_value = client
+        fileobj = mock.Mock()
+        out = driver.command_to_file("COMMAND", fileobj)
+
+        channel.set_combine_stderr.assert_called_once_with(True)
+        channel.exec_command.assert_called_once_with("COMMAND")
+        self.assertFalse(channel.sendall.called)
+        self.assertEqual([mock.call('chunk1'), mock.call('chunk2')],
+                         fileobj.write.call_args_list)
+        self.assertEqual(3, out.return_code)
+        channel.close.assert_called_once_with()
+        self.assertEqual(12, driver.metrics["bytes_transferred"])
+
+    @mock.patch('shotgun.driver.time')
+    @mock.patch('shotgun.driver.fabric.api.settings')
+    @mock.patch('shotgun.driver.fabric.api.run')
+    def test_connect_time(self, mfabrun, mfabset, mtime):
+        mtime.time.side_effect = [10.0, 12.5]
+        mfabrun.return_value = RunOut()
+        driver = shotgun.driver.Driver({
+            "host": {"address": "10.109.0.2"},
+        }, mock.Mock())
+        self.mconnections.__contains__.return_value = False
+        driver.command("COMMAND")
+        self.mconnections.connect.assert_called_once_with("10.109.0.2")
+
+        self.mconnections.__contains__.return_value = True
+        driver.command("COMMAND")
+        self.mconnections.connect.assert_called_once_with("10.109.0.2")
+        self.assertEqual(2.5, driver.metrics["connect_seconds"])
+
+    def test_local_command_to_file(self):
+        driver = shotgun.driver.Driver({}, mock.Mock())
+        with tempfile.TemporaryFile() as f:
+            out = driver.command_to_file("echo out; echo err >&2; exit 2", f)
+            f.seek(0)
+            self.assertEqual("out\nerr\n", f.read())
+        self.assertEqual(2, out.return_code)
+
+    @mock.patch('shotgun.driver.fs.copy')
+    @mock.patch('shotgun.driver.fs.makedirs')
     @mock.patch('shotgun.driver.fabric.api.settings')
     @mock.patch('shotgun.driver.fabric.api.get')
-    def test_driver_get(self, mfabget, mfabset, mexecute):
-        mexecute.return_value = ("RETURN_CODE", "STDOUT", "STDERR")
+    def test_driver_get(self, mfabget, mfabset, mmakedirs, mcopy):
         remote_path = "/remote_dir/remote_file"
         target_path = "/target_dir"
         conf = mock.Mock()
@@ -165,19 +259,62 @@ class TestDriver(base.BaseTestCase):
             },
         }, conf)
         driver.get(remote_path, target_path)
-        mexecute.assert_called_with('mkdir -p "{0}"'.format(target_path))
+        mmakedirs.assert_called_with(target_path)
         mfabget.assert_called_with(remote_path, target_path)
 
         mfabset.assert_called_with(
             host_string="10.109.0.2", key_filename="path_to_key",
             timeout=2, warn_only=True, abort_on_prompts=True)
 
-        mexecute.reset_mock()
+        self.assertFalse(mcopy.called)
         driver = shotgun.driver.Driver({}, conf)
         driver.get(remote_path, target_path)
-        self.assertEqual(mexecute.mock_calls, [
-            mock.call('mkdir -p "{0}"'.format(target_path)),
-            mock.call('cp -r "{0}" "{1}"'.format(remote_path, target_path))])
+        mcopy.assert_called_once_with(remote_path, target_path)
+
+    @mock.patch('shotgun.driver.uuid.uuid4')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_command_batch(self, mcommand, muuid):
+        muuid.return_value.hex = 'abc'
+        mcommand.return_value.stdout = (
+            '\nSHOTGUN-abc 0 stdout\nout1\nSHOTGUN-abc 0 stderr\n'
+            '\nSHOTGUN-abc 0 rc\n0\nSHOTGUN-abc 1 stdout\nout2')
+        conf = mock.Mock(timeout=10)
+        driver = shotgun.driver.Driver({}, conf)
+
+        outs = driver.command_batch(['cmd1', 'cmd2', 'cmd3'])
+
+        mcommand.assert_called_once_with(
+            shotgun.driver.utils.batch_script(
+                ['cmd1', 'cmd2', 'cmd3'], 'SHOTGUN-abc'),
+            timeout=30)
+        self.assertEqual(
+            [('out1', '', '0'), ('out2', None, None), (None, None, None)],
+            [(o.stdout, o.stderr, o.return_code) for o in outs])
+
+    @mock.patch('shotgun.driver.cache.cache',
+                new_callable=lambda: shotgun.cache.CommandCache(100))
+    @mock.patch('shotgun.driver.uuid.uuid4')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_command_batch_cached(self, mcommand, muuid, mcache):
+        muuid.return_value.hex = 'abc'
+        mcommand.return_value.stdout = (
+            '\nSHOTGUN-abc 0 stdout\nout2\nSHOTGUN-abc 0 stderr\n'
+            '\nSHOTGUN-abc 0 rc\n0\n')
+        driver = shotgun.driver.Driver({}, mock.Mock(timeout=10))
+        cached = shotgun.driver.CommandOut()
+        cached.stdout, cached.return_code = 'out1', 0
+        mcache.put(None, 'cmd1', cached)
+
+        outs = driver.command_batch(['cmd1', 'cmd2'], cacheable=True)
+
+        mcommand.assert_called_once_with(
+            shotgun.driver.utils.batch_script(['cmd2'], 'SHOTGUN-abc'),
+            timeout=10)
+        self.assertEqual(['out1', 'out2'], [o.stdout for o in outs])
+        # both are cached now
+        self.assertEqual(outs, driver.command_batch(['cmd1', 'cmd2'],
+                                                    cacheable=True))
+        self.assertEqual(1, mcommand.call_count)
 
     def test_use_timeout_from_global_conf(self):
         data = {}
@@ -252,9 +389,40 @@ class TestFile(base.BaseTestCase):
 
         mget.assert_called_with(data["path"], target_path)
 
+    @mock.patch('shotgun.driver.archive.extract_stream')
+    @mock.patch('shotgun.driver.Driver.stream')
     @mock.patch('shotgun.driver.utils.remove')
     @mock.patch('shotgun.driver.Driver.get')
-    def test_dir_exclude_called(self, mget, mremove):
+    def test_dir_exclude_on_host(self, mget, mremove, mstream, mextract):
+        data = {
+            "type": "dir",
+            "path": "/remote_dir/",
+            "exclude": ["*test", "/sub dir"],
+            "host": {
+                "hostname": "remote_host",
+                "address": "10.109.0.2",
+            },
+        }
+        conf = mock.MagicMock()
+        conf.target = "/target"
+        dir_driver = shotgun.driver.Dir(data, conf)
+        dir_driver.snapshot()
+
+        mstream.assert_called_once_with(
+            "cd / && tar cf - --ignore-failed-read --anchored "
+            "--no-wildcards-match-slash --exclude='remote_dir/*test' "
+            "--exclude='remote_dir/sub dir' remote_dir/")
+        mextract.assert_called_once_with(
+            mstream.return_value.__enter__.return_value,
+            "/target/remote_host")
+        self.assertFalse(mget.called)
+        self.assertFalse(mremove.called)
+
+    @mock.patch('shotgun.driver.File.snapshot_excluded',
+                side_effect=tarfile.ReadError)
+    @mock.patch('shotgun.driver.utils.remove')
+    @mock.patch('shotgun.driver.Driver.get')
+    def test_dir_exclude_called(self, mget, mremove, _):
         data = {
             "type": "dir",
             "path": "/remote_dir/",
@@ -274,6 +442,178 @@ class TestFile(base.BaseTestCase):
         mget.assert_called_with(data["path"], target_path)
         mremove.assert_called_with(dir_driver.full_dst_path, data['exclude'])
 
+    @mock.patch('shotgun.driver.archive.Segment')
+    @mock.patch('shotgun.driver.Driver.stream')
+    @mock.patch('shotgun.driver.Driver.get')
+    def test_snapshot_stream(self, mget, mstream, msegment):
+        data = {
+            "type": "dir",
+            "path": "/var/log/",
+            "exclude": ["*test"],
+            "stream": True,
+            "host": {
+                "hostname": "remote_host",
+                "address": "10.109.0.2",
+            },
+        }
+        conf = mock.MagicMock()
+        conf.target = "/target/snapshot"
+        dir_driver = shotgun.driver.Dir(data, conf)
+        dir_driver.snapshot()
+
+        self.assertFalse(mget.called)
+        mstream.assert_called_once_with(
+            "cd / && tar cf - --ignore-failed-read --anchored "
+            "--no-wildcards-match-slash --exclude='var/log/*test' var/log/")
+        msegment.assert_called_once_with(
+            conf.target, conf.compression_level, conf.compression,
+            conf.compression_threads)
+        segment = msegment.return_value.__enter__.return_value
+        segment.add_stream.assert_called_once_with(
+            mstream.return_value.__enter__.return_value,
+            "snapshot/remote_host", "/var/log/", ["*test"])
+
+    @mock.patch('shotgun.driver.incremental.write_fragment')
+    @mock.patch('shotgun.driver.incremental.load_manifest')
+    @mock.patch('shotgun.driver.File._fetch_part')
+    @mock.patch('shotgun.driver.Driver.command_batch')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_snapshot_incremental(self, mcommand, mbatch, mfetch, mload,
+                                  mfragment):
+        data = {
+            "type": "dir",
+            "path": "/var/log",
+            "incremental": True,
+            "host": {"hostname": "node-1"},
+        }
+        conf = mock.MagicMock()
+        conf.target = "/target"
+        mload.return_value.files.return_value = {
+            "/var/log/same.log": {"size": 5, "mtime": "1.0", "sha1": "s"},
+            "/var/log/grown.log": {"size": 5, "mtime": "1.0", "sha1": "g"},
+            "/var/log/rotated.log": {"size": 5, "mtime": "1.0", "sha1": "r"},
+        }
+        mcommand.return_value.stdout = (
+            "5 1.0 /var/log/same.log\r\n"
+            "9 2.0 /var/log/grown.log\r\n"
+            "9 2.0 /var/log/rotated.log\r\n"
+            "find: permission denied\r\n"
+            "3 2.0 /var/log/new log\r\n")
+        outs = []
+        for sha1 in ("grown", "g", "new", "rotated", "other"):
+            outs.append(mock.Mock(stdout="{0}  -\n".format(sha1)))
+        mbatch.return_value = outs
+
+        file_driver = shotgun.driver.File(data, conf)
+        file_driver.snapshot()
+
+        mload.return_value.files.assert_called_once_with(
+            "node-1", "/var/log")
+        self.assertEqual([
+            "head -c 9 /var/log/grown.log | sha1sum",
+            "head -c 5 /var/log/grown.log | sha1sum",
+            "head -c 3 '/var/log/new log' | sha1sum",
+            "head -c 9 /var/log/rotated.log | sha1sum",
+            "head -c 5 /var/log/rotated.log | sha1sum",
+        ], mbatch.call_args[0][0])
+        self.assertEqual([
+            mock.call("/var/log/grown.log", 5, 9),
+            mock.call("/var/log/new log", 0, 3),
+            mock.call("/var/log/rotated.log", 0, 9),
+        ], mfetch.call_args_list)
+        mfragment.assert_called_once_with(
+            "/target", "node-1", "/var/log", {
+                "/var/log/same.log": {"size": 5, "mtime": "1.0",
+                                      "sha1": "s"},
+                "/var/log/grown.log": {"size": 9, "mtime": "2.0",
+                                       "sha1": "grown"},
+                "/var/log/rotated.log": {"size": 9, "mtime": "2.0",
+                                         "sha1": "rotated"},
+                "/var/log/new log": {"size": 3, "mtime": "2.0",
+                                     "sha1": "new"},
+            }, {
+                "/var/log/grown.log": 5,
+                "/var/log/rotated.log": 0,
+                "/var/log/new log": 0,
+            })
+
+    @mock.patch('shotgun.driver.File._record_truncated')
+    @mock.patch('shotgun.driver.archive.extract_stream')
+    @mock.patch('shotgun.driver.Driver.stream')
+    @mock.patch('shotgun.driver.File._fetch_part')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_snapshot_limited(self, mcommand, mfetch, mstream, mextract,
+                              mrecord):
+        data = {
+            "type": "dir",
+            "path": "/var/log",
+            "max_bytes": 200,
+            "tail_bytes": 100,
+            "newer_than": 3600,
+            "host": {"hostname": "node-1"},
+        }
+        conf = mock.MagicMock()
+        conf.target = "/target"
+        mcommand.return_value.stdout = (
+            "50 5.0 /var/log/newest.log\n"
+            "500 4.0 /var/log/big.log\n"
+            "90 3.0 /var/log/cut.log\n"
+            "10 1.0 /var/log/oldest.log\n")
+
+        file_driver = shotgun.driver.File(data, conf)
+        file_driver.snapshot()
+
+        mcommand.assert_called_once_with(
+            "find /var/log -type f -mmin -60 -printf '%s %T@ %p\\n'")
+        mstream.assert_called_once_with(
+            "cd / && tar cf - --ignore-failed-read -- var/log/newest.log")
+        mextract.assert_called_once_with(
+            mstream.return_value.__enter__.return_value, "/target/node-1")
+        self.assertEqual([
+            mock.call("/var/log/big.log", 400, 500),
+            mock.call("/var/log/cut.log", 40, 90),
+        ], mfetch.call_args_list)
+        mrecord.assert_called_once_with([
+            ("/var/log/big.log", 500, 100),
+            ("/var/log/cut.log", 90, 50),
+            ("/var/log/oldest.log", 10, 0),
+        ])
+
+    @mock.patch('shotgun.driver.File._record_truncated')
+    @mock.patch('shotgun.driver.archive.extract_stream')
+    @mock.patch('shotgun.driver.Driver.stream')
+    @mock.patch('shotgun.driver.File._fetch_part')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_snapshot_budget(self, mcommand, mfetch, mstream, mextract,
+                             mrecord):
+        data = {
+            "type": "dir",
+            "path": "/var/log",
+            "stream": True,
+            "host": {"hostname": "node-1"},
+        }
+        conf = mock.MagicMock()
+        conf.target = "/target"
+        mcommand.return_value.stdout = (
+            "50 2.0 /var/log/new.log\n"
+            "100 1.0 /var/log/old.log\n")
+        budget = shotgun.scheduler.Budget(120)
+
+        # budget is shared by objects
+        for _ in range(2):
+            file_driver = shotgun.driver.File(data, conf)
+            file_driver.budget = budget
+            file_driver.snapshot()
+
+        mstream.assert_called_once_with(
+            "cd / && tar cf - --ignore-failed-read -- var/log/new.log")
+        mfetch.assert_called_once_with("/var/log/old.log", 30, 100)
+        self.assertEqual([
+            mock.call([("/var/log/old.log", 100, 70)]),
+            mock.call([("/var/log/new.log", 50, 0),
+                       ("/var/log/old.log", 100, 0)]),
+        ], mrecord.call_args_list)
+
 
 class TestCommand(base.BaseTestCase):
     def setUp(self):
@@ -313,8 +653,8 @@ class TestCommand(base.BaseTestCase):
     @mock.patch('shotgun.driver.open', create=True,
                 new_callable=mock.mock_open)
     @mock.patch('shotgun.driver.Command.command')
-    @mock.patch('shotgun.utils.execute')
-    def test_snapshot_single(self, mexec, mcom, mopen):
+    @mock.patch('shotgun.driver.fs.makedirs')
+    def test_snapshot_single(self, mmakedirs, mcom, mopen):
         mout = mock.Mock()
         mout.return_code = 0
         mout.stdout = "stdout"
@@ -334,6 +674,47 @@ class TestCommand(base.BaseTestCase):
         self.assertListEqual(expected_write,
                              file_handle_mock.write.call_args_list)
 
+    def test_snapshot_stream(self):
+        self.conf.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.conf.target)
+        driver_inst = shotgun.driver.Command(
+            {"command": "cmd", "stream": True, "to_file": "cmd.txt"},
+            self.conf)
+        out = shotgun.driver.CommandOut()
+        out.return_code = 0
+
+        def command_to_file(cmd, fileobj):
+            fileobj.write("line1\nline2\n")
+            return out
+
+        with mock.patch.object(driver_inst, 'command_to_file',
+                               side_effect=command_to_file):
+            driver_inst.snapshot()
+        with open(driver_inst.target_path) as f:
+            self.assertEqual(
+                "===== COMMAND =====: cmd\n"
+                "===== RETURN CODE =====: 0\n"
+                "===== STDOUT =====:\n"
+                "line1\nline2\n"
+                "\n===== STDERR =====:\n", f.read())
+        self.assertEqual(
+            ["cmd.txt"], os.listdir(os.path.dirname(driver_inst.target_path)))
+
+    @mock.patch('shotgun.driver.Command._write_output')
+    @mock.patch('shotgun.driver.Command.command_batch')
+    def test_snapshot_batch(self, mbatch, mwrite):
+        data = {
+            "command": ["cmd1", "cmd2"],
+            "batch": True,
+        }
+        mbatch.return_value = ["out1", "out2"]
+        driver_inst = shotgun.driver.Command(data, self.conf)
+        driver_inst.snapshot()
+        mbatch.assert_called_once_with(["cmd1", "cmd2"], True)
+        self.assertListEqual(
+            [mock.call("cmd1", "out1"), mock.call("cmd2", "out2")],
+            mwrite.call_args_list)
+
     @mock.patch('shotgun.driver.Command._report_single')
     def test_report(self, mrepsing):
         data = {
@@ -365,6 +746,29 @@ class TestCommand(base.BaseTestCase):
         ]
         result = driver_inst._report_single(data["command"])
         self.assertListEqual(expected, list(result))
+        mcom.assert_called_once_with("cmd1\ncmd2", cacheable=True)
+
+    @mock.patch('shotgun.driver.cache.cache',
+                new_callable=lambda: shotgun.cache.CommandCache(100))
+    @mock.patch('shotgun.driver.utils.execute')
+    def test_command_cache(self, mexecute, mcache):
+        mexecute.return_value = (0, "STDOUT", "")
+        driver_inst = shotgun.driver.Command({"command": "cmd"}, self.conf)
+        first = driver_inst.command("cmd", cacheable=True)
+        second = driver_inst.command("cmd", cacheable=True)
+        self.assertIs(first, second)
+        mexecute.assert_called_once_with("cmd", timeout=None)
+
+        driver_inst.command("cmd")
+        self.assertEqual(2, mexecute.call_count)
+
+    @mock.patch('shotgun.driver.Command.command')
+    def test_cache_opt_out(self, mcom):
+        mcom.return_value.stdout = ""
+        data = {"command": "cmd", "cache": False}
+        driver_inst = shotgun.driver.Command(data, self.conf)
+        list(driver_inst._report_single("cmd"))
+        mcom.assert_called_once_with("cmd", cacheable=False)
 
 
 class TestDockerCommand(base.BaseTestCase):
@@ -378,27 +782,301 @@ class TestDockerCommand(base.BaseTestCase):
             "containers": ["cont1", "cont2"],
         }
         driver_inst = shotgun.driver.DockerCommand(data, self.conf)
-        template_str = (
-            'docker exec \\\n'
-            '$(docker ps -q \\\n'
-            '  --filter \'name={0}\' \\\n'
-            '  --format \'{{{{.Names}}}}\') {1}')
-        expected = [
-            template_str.format("cont1", "cmd1"),
-            template_str.format("cont1", "cmd2"),
-            template_str.format("cont2", "cmd1"),
-            template_str.format("cont2", "cmd2"),
-        ]
-        self.assertListEqual(expected, driver_inst.cmds)
+        self.assertListEqual(["cmd1", "cmd2"], driver_inst.cmds)
+        self.assertListEqual(["cont1", "cont2"], driver_inst.containers)
+
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_container_ids(self, mcommand):
+        mcommand.return_value.stdout = (
+            "aaa fuel-core-nailgun-old\nbbb fuel-core-nailgun\n"
+            "ccc fuel-core-keystone\n")
+        driver_inst = shotgun.driver.DockerCommand({
+            "command": "cmd",
+            "containers": ["nailgun", "fuel-core-nailgun", "astute"],
+        }, self.conf)
+        self.assertEqual({"nailgun": "aaa", "fuel-core-nailgun": "bbb"},
+                         driver_inst.container_ids())
+        mcommand.assert_called_once_with(
+            shotgun.driver.DockerCommand.ps_command, cacheable=True)
+
+    @mock.patch('shotgun.driver.utils.execute')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_container_outs(self, mcommand, mexecute):
+        mcommand.return_value.stdout = "aaa nailgun\nbbb keystone\n"
+
+        def execute(command, timeout):
+            # runs the script given to docker exec locally
+            args = shlex.split(command)
+            self.assertEqual(["docker", "exec"], args[:2])
+            process = subprocess.Popen(["sh", "-c", args[-1]],
+                                       stdout=subprocess.PIPE)
+            stdout = process.communicate()[0]
+            return process.returncode, stdout, ""
+        mexecute.side_effect = execute
+
+        driver_inst = shotgun.driver.DockerCommand({
+            "command": ["echo out", "echo err >&2; exit 3"],
+            "containers": ["nailgun", "astute", "keystone"],
+            "jobs": 2,
+        }, self.conf)
+        items = driver_inst.container_outs()
+
+        # one exec per container
+        self.assertEqual(2, mexecute.call_count)
+        self.assertEqual(
+            ["docker exec nailgun echo out",
+             "docker exec nailgun echo err >&2; exit 3",
+             "docker exec astute echo out",
+             "docker exec astute echo err >&2; exit 3",
+             "docker exec keystone echo out",
+             "docker exec keystone echo err >&2; exit 3"],
+            [cmd for cmd, _ in items])
+        self.assertEqual("out\n", items[0][1].stdout)
+        self.assertEqual("3", items[1][1].return_code)
+        self.assertEqual("err\n", items[1][1].stderr)
+        self.assertEqual("No such container: astute", items[2][1].stderr)
+        self.assertEqual("out\n", items[4][1].stdout)
+
+    @mock.patch('shotgun.driver.fabric.api.settings')
+    @mock.patch('shotgun.driver.Driver._connect')
+    @mock.patch('shotgun.driver.Driver._channel_to_file',
+                side_effect=fabric.exceptions.NetworkError)
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_container_outs_remote(self, mcommand, mchannel, mconnect,
+                                   mfabset):
+        mcommand.return_value.stdout = "aaa nailgun\n"
+        driver_inst = shotgun.driver.DockerCommand({
+            "command": "cmd",
+            "containers": ["nailgun"],
+            "host": {"address": "10.109.0.2", "ssh-key": "/root/.ssh/key"},
+        }, self.conf)
+        self.assertRaises(fabric.exceptions.NetworkError,
+                          driver_inst.container_outs)
+        mconnect.assert_called_once_with()
+        self.assertEqual("10.109.0.2",
+                         mfabset.call_args[1]["host_string"])
+        self.assertEqual("/root/.ssh/key",
+                         mfabset.call_args[1]["key_filename"])
+
+    def test_api_socket_missing(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.conf.target = tmp
+        self.conf.timeout = 10
+        driver_inst = shotgun.driver.DockerCommand({
+            "command": "cmd",
+            "containers": ["nailgun"],
+            "files": ["/etc/nailgun"],
+            "backend": "api",
+            "docker_socket": os.path.join(tmp, "missing.sock"),
+        }, self.conf)
+        self.assertEqual({}, driver_inst.container_ids())
+        driver_inst._copy_files("nailgun", "abc")
+        self.assertEqual(
+            [], os.listdir(os.path.join(driver_inst.files_path, "nailgun")))
+
+    def test_api_remote_requires_socket(self):
+        data = {
+            "command": "cmd",
+            "containers": ["nailgun"],
+            "backend": "api",
+            "host": {"address": "10.109.0.2"},
+        }
+        self.assertRaises(ValueError, shotgun.driver.DockerCommand,
+                          data, self.conf)
+        data["docker_socket"] = "/run/node-1/docker.sock"
+        driver_inst = shotgun.driver.DockerCommand(data, self.conf)
+        self.assertIsNotNone(driver_inst.client)
+
+    def test_snapshot_api(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        socket_path = os.path.join(tmp, "docker.sock")
+        server = FakeDocker(socket_path, {
+            "abc": {"name": "fuel-core-nailgun",
+                    "files": {"/etc/nailgun/settings.yaml": "DEBUG: true\n"}},
+        })
+        server.start()
+        self.addCleanup(server.stop)
+        self.conf.target = os.path.join(tmp, "target")
+        self.conf.timeout = 10
+
+        driver_inst = shotgun.driver.DockerCommand({
+            "command": ["echo out", "exit 2"],
+            "containers": ["nailgun", "astute"],
+            "files": ["/etc/nailgun/settings.yaml", "/missing"],
+            "backend": "api",
+            "docker_socket": socket_path,
+            "to_file": "docker.txt",
+        }, self.conf)
+        with mock.patch('shotgun.driver.utils.execute') as mexecute:
+            driver_inst.snapshot()
+        # nothing is run on the host
+        self.assertFalse(mexecute.called)
+
+        items = driver_inst.container_outs()
+        self.assertEqual(("docker exec nailgun echo out", "out\n"),
+                         (items[0][0], items[0][1].stdout))
+        self.assertEqual(2, items[1][1].return_code)
+        self.assertEqual("No such container: astute", items[2][1].stderr)
+        with open(driver_inst.target_path) as f:
+            self.assertIn("===== COMMAND =====: docker exec nailgun echo out",
+                          f.read())
+        with open(os.path.join(driver_inst.files_path, "nailgun",
+                               "settings.yaml")) as f:
+            self.assertEqual("DEBUG: true\n", f.read())
+
+
+class TestPostgres(base.BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.conf = mock.Mock()
+        self.conf.target = self.tmp
+
+    def test_dump_command(self):
+        driver_inst = shotgun.driver.Postgres({
+            "dbname": "nailgun",
+            "format": "custom",
+            "tables": ["nodes"],
+            "exclude_tables": ["tasks*"],
+            "exclude_table_data": ["action_logs"],
+        }, self.conf)
+        self.assertEqual(
+            "pg_dump -h localhost -U postgres -w -Fc -t nodes -T 'tasks*' "
+            "--exclude-table-data=action_logs nailgun",
+            driver_inst.dump_command("nailgun"))
+        self.assertTrue(driver_inst.dump_path("nailgun").endswith(
+            "pg_dump/localhost_nailgun.dump"))
+
+    @mock.patch('shotgun.driver.fs.move')
+    @mock.patch('shotgun.driver.Driver.command')
+    def test_snapshot(self, mcommand, mmove):
+        mcommand.return_value.output = "/tmp/tmp.1\n"
+        driver_inst = shotgun.driver.Postgres({
+            "dbname": ["nailgun", "keystone"],
+        }, self.conf)
+        driver_inst.snapshot()
+        mcommand.assert_has_calls([
+            mock.call("mktemp"),
+            mock.call("pg_dump -h localhost -U postgres -w "
+                      "-f /tmp/tmp.1 nailgun"),
+            mock.call("mktemp"),
+            mock.call("pg_dump -h localhost -U postgres -w "
+                      "-f /tmp/tmp.1 keystone"),
+        ])
+        mmove.assert_called_with(
+            "/tmp/tmp.1", driver_inst.dump_path("keystone"))
+
+    @mock.patch('shotgun.driver.utils.execute_to_file')
+    def test_snapshot_stream_local(self, mexecute):
+        def execute_to_file(command, fileobj, env, timeout, stderr):
+            fileobj.write("dump of " + command.split()[-1])
+            stderr.write("warning")
+            return 0
+        mexecute.side_effect = execute_to_file
+        driver_inst = shotgun.driver.Postgres({
+            "dbname": ["nailgun", "keystone"],
+            "password": "secret",
+            "stream": True,
+            "jobs": 2,
+        }, self.conf)
+        driver_inst.snapshot()
+
+        for dbname in ("nailgun", "keystone"):
+            path = driver_inst.dump_path(dbname)
+            with open(path) as f:
+                self.assertEqual("dump of " + dbname, f.read())
+            with open(path + ".log") as f:
+                self.assertEqual("warning", f.read())
+        self.assertEqual("secret",
+                         mexecute.call_args[1]["env"]["PGPASSWORD"])
+        self.assertEqual(31, driver_inst.metrics["bytes_written"])
+
+    @mock.patch('shotgun.driver.fabric.api.settings')
+    @mock.patch('shotgun.driver.Driver._channel_to_file')
+    @mock.patch('shotgun.driver.Driver._connect')
+    def test_snapshot_stream_remote(self, mconnect, mchannel, mfabset):
+        mchannel.return_value = 1
+        driver_inst = shotgun.driver.Postgres({
+            "host": {"address": "10.109.0.2"},
+            "dbname": "nailgun",
+            "password": "secret",
+            "stream": True,
+        }, self.conf)
+        driver_inst.snapshot()
+
+        mconnect.assert_called_once_with()
+        command, _, _, stdin = mchannel.call_args[0]
+        self.assertNotIn("secret", command)
+        self.assertTrue(command.endswith(
+            'PGPASSFILE="$pgpass" pg_dump -h localhost -U postgres -w '
+            'nailgun'))
+        self.assertEqual("*:*:*:*:secret\n", stdin)
+        self.assertTrue(os.path.exists(driver_inst.dump_path("nailgun")))
+
+
+class TestXmlRpc(base.BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.conf = mock.Mock()
+        self.conf.target = self.tmp
+
+    def serve(self, multicall=True):
+        server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            ("127.0.0.1", 0), logRequests=False)
+        server.register_function(lambda: [{"name": "node-1"}],
+                                 "get_systems")
+        server.register_function(lambda: 42, "version")
+        if multicall:
+            server.register_multicall_functions()
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={"poll_interval": 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:{0}".format(server.server_address[1])
+
+    def snapshot(self, server, **data):
+        driver_inst = shotgun.driver.XmlRpc(dict(data, **{
+            "server": server,
+            "methods": ["get_systems", "missing", "version"],
+            "to_file": "cobbler.txt",
+        }), self.conf)
+        driver_inst.snapshot()
+        with open(driver_inst.target_path) as f:
+            return [json.loads(line) for line in f]
+
+    def assertResponses(self, lines):
+        self.assertEqual({"method": "get_systems",
+                          "result": [{"name": "node-1"}]}, lines[0])
+        self.assertEqual("missing", lines[1]["method"])
+        self.assertIn('method "missing" is not supported', lines[1]["error"])
+        self.assertEqual({"method": "version", "result": 42}, lines[2])
+        self.assertEqual(3, len(lines))
+
+    def test_snapshot_multicall(self):
+        with mock.patch.object(shotgun.driver.XmlRpc, '_call') as mcall:
+            lines = self.snapshot(self.serve())
+        self.assertFalse(mcall.called)
+        self.assertResponses(lines)
+
+    def test_snapshot_without_multicall(self):
+        self.assertResponses(self.snapshot(self.serve(multicall=False),
+                                           jobs=2))
+        self.assertResponses(self.snapshot(self.serve(multicall=False),
+                                           jobs=1))
 
 
 class TestOffline(base.BaseTestCase):
 
     @mock.patch('shotgun.driver.open', create=True,
                 new_callable=mock.mock_open)
-    @mock.patch('shotgun.driver.utils.execute', autospec=True)
+    @mock.patch('shotgun.driver.fs.makedirs')
     @mock.patch('shotgun.driver.os', autospec=True)
-    def test_snapshot(self, mos, mexec, mopen):
+    def test_snapshot(self, mos, mmakedirs, mopen):
         data = {
             "type": "offline",
             "path": "/remote_dir/remote_file",
@@ -420,5 +1098,5 @@ class TestOffline(base.BaseTestCase):
             'Host remote_host was offline/unreachable '
             'during logs obtaining.\n')
         mopen.assert_called_once_with(target_path, 'w')
-        mexec.assert_called_once_with('mkdir -p "/target/remote_host"')
+        mmakedirs.assert_called_once_with('/target/remote_host')
         self.assertEqual(target_path, offline_driver.target_path)
@@ -0,0 +1,110 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+
+import mock
+
+from shotgun import fs
+from shotgun.test import base
+
+
+class TestFs(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp, *parts)
+
+    def write(self, path, data):
+        with open(path, "w") as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_makedirs(self):
+        fs.makedirs(self.path("a", "b"))
+        fs.makedirs(self.path("a", "b"))
+        self.assertTrue(os.path.isdir(self.path("a", "b")))
+        self.write(self.path("file"), "")
+        self.assertRaises(OSError, fs.makedirs, self.path("file"))
+
+    def test_remove(self):
+        os.makedirs(self.path("dir", "sub"))
+        self.write(self.path("dir", "sub", "file"), "data")
+        os.symlink(self.path("dir"), self.path("link"))
+        fs.remove(self.path("link"))
+        self.assertTrue(os.path.isdir(self.path("dir", "sub")))
+        fs.remove(self.path("dir"))
+        fs.remove(self.path("missing"))
+        self.assertEqual([], os.listdir(self.tmp))
+
+    def test_move(self):
+        self.write(self.path("src"), "new")
+        self.write(self.path("dst"), "old")
+        fs.move(self.path("src"), self.path("dst"))
+        self.assertEqual("new", self.read(self.path("dst")))
+        self.assertFalse(os.path.exists(self.path("src")))
+
+        os.mkdir(self.path("dir"))
+        fs.move(self.path("dst"), self.path("dir"))
+        self.assertEqual("new", self.read(self.path("dir", "dst")))
+
+    def test_copy_file(self):
+        data = os.urandom(1024) * 3 * 1024
+        self.write(self.path("src"), data)
+        os.chmod(self.path("src"), 0o600)
+        fs.copy_file(self.path("src"), self.path("dst"))
+        self.assertEqual(data, self.read(self.path("dst")))
+        self.assertEqual(0o600,
+                         stat.S_IMODE(os.stat(self.path("dst")).st_mode))
+
+    @mock.patch('shotgun.fs._sendfile', None)
+    @mock.patch('shotgun.fs._copy_file_range', None)
+    def test_copy_file_without_kernel_copy(self):
+        self.write(self.path("src"), "data")
+        fs.copy_file(self.path("src"), self.path("dst"))
+        self.assertEqual("data", self.read(self.path("dst")))
+
+    def test_copy_file_of_zero_size(self):
+        # files in /proc report zero size but have contents
+        fs.copy_file("/proc/self/status", self.path("status"))
+        self.assertIn("Name:", self.read(self.path("status")))
+
+    def test_copy(self):
+        os.makedirs(self.path("src", "sub"))
+        for name in ("a", "b", os.path.join("sub", "c")):
+            self.write(self.path("src", name), name)
+        os.symlink("a", self.path("src", "link"))
+        os.mkfifo(self.path("src", "fifo"))
+        os.mkdir(self.path("target"))
+
+        self.assertTrue(fs.copy(self.path("src") + "/", self.path("target")))
+        copied = self.path("target", "src")
+        self.assertEqual(["a", "b", "link", "sub"],
+                         sorted(os.listdir(copied)))
+        self.assertEqual("sub/c",
+                         self.read(os.path.join(copied, "sub", "c")))
+        self.assertEqual("a", os.readlink(os.path.join(copied, "link")))
+
+        self.assertTrue(fs.copy(self.path("src", "a"), self.path("target")))
+        self.assertEqual("a", self.read(self.path("target", "a")))
+        self.assertFalse(fs.copy(self.path("missing"), self.path("target")))
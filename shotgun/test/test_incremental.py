@@ -0,0 +1,142 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+from shotgun import incremental
+from shotgun.test import base
+
+
+class TestIncremental(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.target = os.path.join(self.tmp, "snapshot")
+
+    def write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_manifest_update(self):
+        manifest = incremental.Manifest({"node-1": {
+            "/var/log/a.log": {"size": 1},
+            "/var/log/removed.log": {"size": 1},
+            "/etc/hosts": {"size": 1},
+        }})
+        manifest.update("node-1", "/var/log/",
+                        {"/var/log/a.log": {"size": 2}},
+                        {"/var/log/a.log": 1})
+        self.assertEqual({
+            "/var/log/a.log": {"size": 2},
+            "/etc/hosts": {"size": 1},
+        }, manifest.hosts["node-1"])
+        self.assertEqual({"node-1": {"/var/log/a.log": 1}}, manifest.delta)
+        self.assertEqual({"/etc/hosts": {"size": 1}},
+                         manifest.files("node-1", "/etc/hosts"))
+
+    def test_merge_and_commit(self):
+        manifest_path = os.path.join(self.tmp, "manifest.json")
+        incremental.Manifest({
+            "node-1": {"/etc/hosts": {"size": 1}},
+            "node-2": {"/var/log/b.log": {"size": 1}},
+        }).save(manifest_path)
+        incremental.write_fragment(self.target, "node-1", "/var/log",
+                                   {"/var/log/a.log": {"size": 3}},
+                                   {"/var/log/a.log": 0})
+
+        self.assertTrue(
+            incremental.merge_fragments(self.target, manifest_path))
+        incremental.commit(self.target, manifest_path)
+
+        expected = {
+            "node-1": {"/etc/hosts": {"size": 1},
+                       "/var/log/a.log": {"size": 3}},
+            "node-2": {"/var/log/b.log": {"size": 1}},
+        }
+        self.assertEqual(
+            expected, incremental.Manifest.load(manifest_path).hosts)
+        in_archive = incremental.Manifest.load(
+            os.path.join(self.target, incremental.MANIFEST_NAME))
+        self.assertEqual(expected, in_archive.hosts)
+        self.assertEqual({"node-1": {"/var/log/a.log": 0}},
+                         in_archive.delta)
+        self.assertFalse(
+            os.path.exists(incremental.fragments_dir(self.target)))
+
+    def test_manifest_reloaded_after_commit(self):
+        manifest_path = os.path.join(self.tmp, "manifest.json")
+        self.addCleanup(incremental.reset)
+        self.assertEqual(
+            {}, incremental.load_manifest(manifest_path).hosts)
+        incremental.write_fragment(self.target, "node-1", "/var/log",
+                                   {"/var/log/a.log": {"size": 3}}, {})
+        incremental.merge_fragments(self.target, manifest_path)
+        incremental.commit(self.target, manifest_path)
+
+        self.assertEqual(
+            {"/var/log/a.log": {"size": 3}},
+            incremental.load_manifest(manifest_path).files(
+                "node-1", "/var/log"))
+
+    def test_merge_without_fragments(self):
+        self.assertFalse(incremental.merge_fragments(self.target, "/none"))
+
+    def test_apply(self):
+        restored = os.path.join(self.tmp, "restored")
+        self.write(os.path.join(restored, "node-1/var/log/a.log"), "old\n")
+        self.write(os.path.join(restored, "node-1/var/log/b.log"), "old\n")
+        self.write(os.path.join(self.target, "node-1/var/log/a.log"),
+                   "appended\n")
+        self.write(os.path.join(self.target, "node-1/var/log/b.log"),
+                   "whole\n")
+        incremental.Manifest(delta={"node-1": {
+            "/var/log/a.log": 4,
+            "/var/log/b.log": 0,
+        }}).save(os.path.join(self.target, incremental.MANIFEST_NAME))
+
+        incremental._apply(self.target, restored)
+
+        self.assertEqual(
+            "old\nappended\n",
+            self.read(os.path.join(restored, "node-1/var/log/a.log")))
+        self.assertEqual(
+            "whole\n",
+            self.read(os.path.join(restored, "node-1/var/log/b.log")))
+        self.assertFalse(os.path.exists(
+            os.path.join(restored, incremental.MANIFEST_NAME)))
+
+    def test_apply_hard_links(self):
+        restored = os.path.join(self.tmp, "restored")
+        self.write(os.path.join(self.target, "node-1/a.log"), "same\n")
+        os.makedirs(os.path.join(self.target, "node-2"))
+        os.link(os.path.join(self.target, "node-1/a.log"),
+                os.path.join(self.target, "node-2/a.log"))
+        incremental.Manifest().save(
+            os.path.join(self.target, incremental.MANIFEST_NAME))
+
+        incremental._apply(self.target, restored)
+
+        self.assertEqual(1, os.stat(
+            os.path.join(restored, "node-1/a.log")).st_nlink)
+        self.assertEqual(
+            "same\n", self.read(os.path.join(restored, "node-2/a.log")))
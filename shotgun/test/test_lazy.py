@@ -0,0 +1,51 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+from shotgun import lazy
+from shotgun.test import base
+
+
+# lists heavy modules imported at start in a fresh interpreter, the time
+# of the start is measured by shotgun.bench
+STARTUP_SCRIPT = """
+import json, sys
+import shotgun.config, shotgun.manager
+json.dump([m for m in ("fabric", "paramiko", "xmlrpclib", "yaml",
+                       "shotgun.dockerapi") if m in sys.modules],
+          sys.stdout)
+"""
+
+
+class TestLazy(base.BaseTestCase):
+
+    def test_lazy_module(self):
+        module = lazy.LazyModule("xml.dom", "minidom")
+        parse = module.minidom.parseString
+        self.assertIs(sys.modules["xml.dom.minidom"].parseString, parse)
+        module.lazy_test = 1
+        self.assertEqual(1, sys.modules["xml.dom"].lazy_test)
+        del module.lazy_test
+        self.assertFalse(hasattr(sys.modules["xml.dom"], "lazy_test"))
+
+    def test_startup(self):
+        loaded = json.loads(subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))))
+        # heavy modules are imported by drivers which use them
+        self.assertEqual([], loaded)
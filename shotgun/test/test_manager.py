@@ -13,22 +13,43 @@
 #    under the License.
 
 from collections import deque
+import multiprocessing.dummy
+import os
 import tempfile
+import threading
 
 import fabric.exceptions
 import mock
 
 from shotgun.config import Config
+from shotgun.manager import _snapshot_object
 from shotgun.manager import Manager
 from shotgun.test import base
 
 
 class TestManager(base.BaseTestCase):
 
+    def setUp(self):
+        probe = mock.patch('shotgun.manager.connections.probe',
+                           return_value=set())
+        self.mprobe = probe.start()
+        self.addCleanup(probe.stop)
+        # retries are delayed by sleeping in a fake clock
+        clock = mock.patch('shotgun.retry.time')
+        mtime = clock.start()
+        self.addCleanup(clock.stop)
+        mtime.time.return_value = 1000.0
+
+        def sleep(seconds):
+            mtime.time.return_value += seconds
+        mtime.sleep.side_effect = sleep
+
+    @mock.patch('shotgun.manager.metrics.Profile')
     @mock.patch('shotgun.manager.Driver.getDriver')
-    @mock.patch('shotgun.manager.utils.execute')
+    @mock.patch('shotgun.manager.fs.remove')
     @mock.patch('shotgun.manager.utils.compress')
-    def test_snapshot(self, mcompress, mexecute, mget):
+    def test_snapshot(self, mcompress, mremove, mget, mprofile):
+        mcompress.return_value = '/target/data.tar.xz'
         data = {
             "type": "file",
             "path": "/remote_dir/remote_file",
@@ -45,12 +66,66 @@ class TestManager(base.BaseTestCase):
         manager.snapshot()
         calls = [mock.call(data, conf), mock.call(conf.self_log_object, conf)]
         mget.assert_has_calls(calls, any_order=True)
-        mexecute.assert_called_once_with('rm -rf /target')
+        mremove.assert_called_once_with('/target')
+
+    @mock.patch('shotgun.manager.incremental')
+    @mock.patch('shotgun.manager.dedup.link_duplicates')
+    @mock.patch('shotgun.manager.metrics.Profile')
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    @mock.patch('shotgun.manager.fs.remove')
+    @mock.patch('shotgun.manager.utils.compress')
+    def test_snapshot_dedup(self, mcompress, mremove, mget, mprofile,
+                            mlink, _):
+        mcompress.return_value = '/target/data.tar.xz'
+        conf = mock.MagicMock()
+        conf.target = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, conf.target)
+        conf.objects = []
+        conf.lastdump = tempfile.mkstemp()[1]
+        conf.dedup = True
+        conf.keep_target = False
+        Manager(conf).snapshot()
+        mlink.assert_called_once_with(conf.target)
+
+        # files of the kept directory stay independent
+        mlink.reset_mock()
+        conf.keep_target = True
+        Manager(conf).snapshot()
+        self.assertFalse(mlink.called)
+        self.assertTrue(mcompress.call_args[1]["keep_target"])
+
+    @mock.patch('shotgun.manager.incremental')
+    @mock.patch('shotgun.manager.metrics.Profile')
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    @mock.patch('shotgun.manager.fs.remove')
+    @mock.patch('shotgun.manager.utils.compress')
+    def test_snapshot_budget(self, mcompress, mremove, mget, mprofile, _):
+        mcompress.return_value = '/target/data.tar.xz'
+        drv = mock.Mock(budget=None)
+        mget.return_value = drv
+        conf = mock.MagicMock()
+        conf.target = "/target/data"
+        conf.objects = [{"type": "dir", "path": "/var/log", "host": {}}]
+        conf.lastdump = tempfile.mkstemp()[1]
+        conf.concurrency = 1
+        conf.dedup = False
+        conf.deadline = None
+        conf.max_snapshot_bytes = None
+        Manager(conf).snapshot()
+        # without a limit files are copied or streamed as usual
+        self.assertIsNone(drv.budget)
 
+        conf.max_snapshot_bytes = 1024
+        Manager(conf).snapshot()
+        self.assertEqual(1024, drv.budget.take(2048))
+
+    @mock.patch('shotgun.manager.metrics.Profile')
     @mock.patch('shotgun.manager.Driver.getDriver')
-    @mock.patch('shotgun.manager.utils.execute')
+    @mock.patch('shotgun.manager.fs.remove')
     @mock.patch('shotgun.manager.utils.compress')
-    def test_snapshot_network_error(self, mcompress, mexecute, mget):
+    def test_snapshot_network_error(self, mcompress, mremove, mget,
+                                    mprofile):
+        mcompress.return_value = '/tmp/snapshot.tar.xz'
         objs = [
             {"type": "file",
              "path": "/remote_file1",
@@ -92,7 +167,7 @@ class TestManager(base.BaseTestCase):
                                mock.call(processed_obj, conf),
                                mock.call(offline_obj, conf),
                                mock.call(offline_obj, conf)], any_order=True)
-        mexecute.assert_called_once_with('rm -rf /tmp')
+        mremove.assert_called_once_with('/tmp')
 
     @mock.patch('shotgun.manager.Manager.action_single')
     def test_report(self, mock_action):
@@ -100,6 +175,8 @@ class TestManager(base.BaseTestCase):
         mock_action.side_effect = [["r1", "r2"], ["r3"]]
         conf = mock.Mock()
         conf.objects = objs
+        conf.concurrency = 1
+        conf.probe_timeout = 0
         manager = Manager(conf)
         manager.action_single = mock_action
         reports = []
@@ -112,6 +189,30 @@ class TestManager(base.BaseTestCase):
             mock.call('o2', action='report')]
         self.assertEqual(expected_calls, mock_action.call_args_list)
 
+    def test_probe_hosts(self):
+        self.mprobe.return_value = set(['remote_host1'])
+        conf = Config({
+            'dump': {
+                'fake_role1': {
+                    'hosts': [{'address': 'remote_host1'},
+                              {'address': 'remote_host2'}],
+                    'objects': [{'type': 'file', 'path': '/file1'},
+                                {'type': 'file', 'path': '/file2'}],
+                },
+                'local': {'objects': [{'type': 'file', 'path': '/local'}]},
+            },
+            'probe_timeout': 1,
+        })
+        Manager(conf).probe_hosts()
+
+        self.mprobe.assert_called_once_with(
+            set(['remote_host1', 'remote_host2']), 1)
+        objs = [(o['host'].get('address'), o['type'], o['path'])
+                for o in conf.objects]
+        self.assertEqual(1, objs.count(('remote_host1', 'offline', '/file1')))
+        self.assertEqual(3, len([o for o in objs if o[1] == 'file']))
+        self.assertEqual(4, len(objs))
+
     @mock.patch('shotgun.manager.Driver')
     def test_action_single(self, mock_driver):
         mock_driver_instance = mock.Mock()
@@ -132,3 +233,204 @@ class TestManager(base.BaseTestCase):
         mock_driver_instance.report.mock_reset()
         mock_driver_instance.snapshot.assert_called_once_with()
         self.assertFalse(mock_driver_instance.report.called)
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager.metrics.Profile')
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    @mock.patch('shotgun.manager.fs.remove')
+    @mock.patch('shotgun.manager.utils.compress')
+    def test_snapshot_parallel_network_error(self, mcompress, mremove, mget,
+                                             mprofile):
+        mcompress.return_value = '/tmp/snapshot.tar.xz'
+        objs = [
+            {"type": "file",
+             "path": "/remote_file1",
+             "host": {"address": "remote_host1"},
+             },
+            {"type": "dir",
+             "path": "/remote_dir1",
+             "host": {"address": "remote_host1"},
+             },
+            {"type": "file",
+             "path": "/remote_file1",
+             "host": {"address": "remote_host2"},
+             },
+        ]
+
+        def get_driver(obj, conf):
+            drv = mock.Mock()
+            if obj.get('host', {}).get('address') == 'remote_host1':
+                drv.snapshot.side_effect = fabric.exceptions.NetworkError
+            return drv
+
+        mget.side_effect = get_driver
+        conf = Config({'concurrency': 2})
+        conf.objs = deque(objs)
+        manager = Manager(conf)
+        manager.snapshot()
+
+        # the first object of the unreachable host is tried on every pass
+        # and then as offline one, the rest of its objects are skipped
+        processed = [c[0][0] for c in mget.call_args_list]
+        self.assertEqual(
+            [objs[0]] * 3,
+            [o for o in processed
+             if o.get('host', {}).get('address') == 'remote_host1'])
+        self.assertEqual('offline', objs[0]['type'])
+        self.assertNotIn('/remote_dir1', [o['path'] for o in processed])
+        mget.assert_any_call(objs[2], conf)
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    def test_snapshot_parallel_keeps_host_order(self, mget):
+        objs = [
+            {"type": "command", "host": {"address": "host1"}, "n": 1},
+            {"type": "command", "host": {"address": "host2"}, "n": 2},
+            {"type": "command", "host": {"address": "host1"}, "n": 3},
+            {"type": "command", "host": {"address": "host2"}, "n": 4},
+        ]
+        conf = Config({'concurrency': 4})
+        conf.objs = deque(objs)
+        Manager(conf).snapshot_parallel()
+
+        processed = [c[0][0] for c in mget.call_args_list]
+        self.assertItemsEqual(objs, processed)
+        for host in ('host1', 'host2'):
+            self.assertEqual(
+                [o for o in objs if o['host']['address'] == host],
+                [o for o in processed if o['host']['address'] == host])
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    def test_report_parallel(self, mget):
+        objs = [
+            {"type": "command", "host": {"address": "host1"}, "n": 1},
+            {"type": "command", "host": {"address": "host2"}, "n": 2},
+            {"type": "command", "host": {"address": "host1"}, "n": 3},
+        ]
+
+        def get_driver(obj, conf):
+            drv = mock.Mock()
+            if obj['host']['address'] == 'host2' and obj['type'] != 'offline':
+                drv.report.side_effect = fabric.exceptions.NetworkError
+            else:
+                drv.report.return_value = iter([(obj['type'], obj['n'])])
+            return drv
+
+        mget.side_effect = get_driver
+        conf = Config({'concurrency': 2})
+        conf.objs = deque(objs)
+        reports = list(Manager(conf).report())
+
+        self.assertItemsEqual(
+            [('command', 1), ('command', 3), ('offline', 2)], reports)
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    def test_report_parallel_host_concurrency(self, mget):
+        objs = [{"type": "command", "host": {"address": "host1"}, "n": i}
+                for i in range(6)]
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def report():
+            with lock:
+                running.append(1)
+                most_running.append(len(running))
+            threading.Event().wait(0.01)
+            with lock:
+                running.pop()
+            return iter([('host1', 'cmd', 'out')])
+
+        mget.return_value.report.side_effect = report
+        conf = Config({'concurrency': 4, 'host_concurrency': 2})
+        conf.objs = deque(objs)
+        reports = list(Manager(conf).report())
+
+        self.assertEqual(6, len(reports))
+        self.assertLessEqual(max(most_running), 2)
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager.Driver.getDriver',
+                side_effect=ValueError("bad object"))
+    def test_report_parallel_driver_failed(self, _):
+        conf = Config({'concurrency': 2})
+        conf.objs = deque([{"type": "command", "host": {"address": "h1"}}])
+        self.assertEqual(
+            [('h1', 'Driver: Driver', 'Report failed: bad object')],
+            list(Manager(conf).report()))
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager._report_object',
+                side_effect=RuntimeError("worker failed"))
+    def test_report_parallel_worker_failed(self, _):
+        conf = Config({'concurrency': 2})
+        conf.objs = deque([{"type": "command", "host": {"address": "h1"},
+                            "command": "uptime"}])
+        self.assertEqual(
+            [('h1', 'Driver: Command', 'Report failed: worker failed')],
+            list(Manager(conf).report()))
+
+    @mock.patch('shotgun.manager.multiprocessing.Pool',
+                new=multiprocessing.dummy.Pool)
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    def test_report_timeout(self, mget):
+        objs = [
+            {"type": "command", "host": {"address": "fast"}},
+            {"type": "command", "host": {"address": "slow"}},
+        ]
+
+        def get_driver(obj, conf):
+            drv = mock.Mock()
+            drv.host = obj['host']['address']
+            if drv.host == 'slow':
+                drv.report.side_effect = lambda: (
+                    threading.Event().wait(0.5) or iter([('slow', 'late')]))
+            else:
+                drv.report.return_value = iter([('fast', 'cmd', 'out')])
+            return drv
+
+        mget.side_effect = get_driver
+        conf = Config({})
+        conf.objs = deque(objs)
+        reports = list(Manager(conf).report(timeout=0.1))
+
+        self.assertItemsEqual(
+            [('fast', 'cmd', 'out'),
+             ('slow', 'Driver: Mock', 'Report timed out.')],
+            reports)
+
+    @mock.patch('shotgun.manager.Driver.getDriver')
+    def test_snapshot_object_deadline(self, mget):
+        conf = Config({'timeout': 10})
+        deadline = mock.Mock()
+        deadline.admit.return_value = None, "deadline reached"
+        records = []
+        obj = {"type": "command", "command": "ps",
+               "host": {"address": "host1"}}
+        mget.return_value.host = "host1"
+        _snapshot_object(obj, conf, records, deadline)
+
+        deadline.admit.assert_called_once_with(obj, 10)
+        self.assertFalse(mget.return_value.snapshot.called)
+        self.assertEqual("dropped", records[0]["status"])
+        self.assertEqual("deadline reached", records[0]["reason"])
+
+        admitted = dict(obj, timeout=5)
+        deadline.admit.return_value = admitted, None
+        _snapshot_object(obj, conf, records, deadline)
+        mget.assert_called_with(admitted, conf)
+        mget.return_value.snapshot.assert_called_once_with()
+        self.assertEqual("ok", records[1]["status"])
+
+        # local commands are not limited by the default timeout
+        local = {"type": "command", "command": "ps", "host": {}}
+        _snapshot_object(local, conf, records, deadline)
+        deadline.admit.assert_called_with(local, None)
@@ -0,0 +1,131 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+
+import fabric.exceptions
+import mock
+
+from shotgun import archive
+from shotgun import metrics
+from shotgun.test import base
+
+
+class TestMetrics(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def driver(self):
+        driver = mock.Mock()
+        driver.host = "node-1"
+        driver.metrics = metrics.new_counters()
+        return driver
+
+    def test_describe(self):
+        self.assertEqual("/var/log", metrics.describe(
+            {"type": "dir", "path": "/var/log"}))
+        self.assertEqual("cmd1; cmd2 | grep x", metrics.describe(
+            {"type": "command", "command": ["cmd1", "cmd2 |\n  grep x"]}))
+        self.assertEqual(80, len(metrics.describe(
+            {"type": "command", "command": "x" * 100})))
+        self.assertEqual("", metrics.describe({"type": "offline"}))
+
+    def test_counting_reader(self):
+        counters = metrics.new_counters()
+        reader = metrics.CountingReader(
+            StringIO.StringIO("0123456789"), counters, "bytes_transferred")
+        self.assertEqual("0123", reader.read(4))
+        self.assertEqual("456789", reader.read())
+        self.assertEqual(10, counters["bytes_transferred"])
+
+    def test_measure(self):
+        records = []
+        driver = self.driver()
+        with metrics.measure(records, {"type": "file", "path": "/p"},
+                             driver):
+            driver.metrics["bytes_written"] = 5
+        self.assertEqual(1, len(records))
+        self.assertEqual("ok", records[0]["status"])
+        self.assertEqual("node-1", records[0]["host"])
+        self.assertEqual("/p", records[0]["object"])
+        self.assertEqual(5, records[0]["bytes_written"])
+
+        with self.assertRaises(fabric.exceptions.NetworkError):
+            with metrics.measure(records, {"type": "file"}, driver):
+                raise fabric.exceptions.NetworkError()
+        self.assertEqual("network_error", records[1]["status"])
+
+        with metrics.measure(records, {"type": "offline"}, driver):
+            pass
+        self.assertEqual("offline", records[2]["status"])
+
+    def test_measure_compression(self):
+        target = os.path.join(self.tmp, "snapshot")
+        os.makedirs(target)
+        with open(os.path.join(target, "file"), "w") as f:
+            f.write("x" * 100)
+        archive_path = os.path.join(self.tmp, "snapshot.tar.xz")
+
+        profile = metrics.Profile()
+        with profile.measure_compression(target) as result:
+            with open(archive_path, "w") as f:
+                f.write("x" * 10)
+            result["path"] = archive_path
+
+        self.assertEqual(100, profile.compression["input_bytes"])
+        self.assertEqual(10, profile.compression["output_bytes"])
+        self.assertEqual(10.0, profile.compression["ratio"])
+
+    def test_save(self):
+        conf = mock.Mock()
+        conf.target = os.path.join(self.tmp, "snapshot")
+        conf.compression_level = "-1"
+        conf.compression = "gzip"
+        profile = metrics.Profile()
+        profile.add([{"host": "node-1", "status": "ok", "seconds": 1.0}])
+        profile.save(conf)
+
+        directory = archive.segments_dir(conf.target)
+        segment = os.path.join(directory, os.listdir(directory)[0])
+        with tarfile.open(segment) as tar:
+            data = json.load(tar.extractfile("snapshot/metrics.json"))
+        self.assertEqual(profile.objects, data["objects"])
+
+    def test_summary(self):
+        profile = metrics.Profile()
+        profile.add([
+            {"host": "node-1", "type": "file", "object": "/fast",
+             "status": "ok", "seconds": 0.5, "bytes_transferred": 10,
+             "bytes_written": 10},
+            {"host": "node-2", "type": "file", "object": "/log",
+             "status": "network_error", "seconds": 2.0},
+            {"host": "node-2", "type": "offline", "object": "",
+             "status": "offline", "seconds": 0.0},
+            {"host": "node-1", "type": "command", "object": "slow",
+             "status": "ok", "seconds": 3.0, "bytes_transferred": 20,
+             "bytes_written": 30},
+        ])
+        lines = profile.summary().splitlines()
+        self.assertIn("node-1 command: slow", lines[1])
+        self.assertIn("node-2 file: /log", lines[2])
+        self.assertIn(
+            "      3.50s node-1 (30 bytes transferred, 40 written)", lines)
+        self.assertIn("  node-2 /log: 1", lines)
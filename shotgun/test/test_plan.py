@@ -0,0 +1,164 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import copy
+import errno
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from shotgun import plan
+from shotgun.test import base
+
+
+class TestPlan(base.BaseTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache_dir = os.path.join(self.tmp, "plans")
+        self.data = {
+            "target": "/tmp/snapshot",
+            "dump": {
+                "controller": {
+                    "hosts": [{"address": "10.0.0.1"},
+                              {"address": "10.0.0.2"}],
+                    "objects": [{"type": "file", "path": "/etc/nova"},
+                                {"type": "command", "command": "uptime",
+                                 "priority": 1}],
+                },
+            },
+        }
+        self.path = self.write("config.json", self.data)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, "w") as f:
+            json.dump(data, f)
+        return path
+
+    def load(self, path):
+        parse = mock.Mock(side_effect=json.loads)
+        return plan.load(path, parse, self.cache_dir), parse
+
+    def test_load_cached(self):
+        compiled, parse = self.load(self.path)
+        self.assertEqual(1, parse.call_count)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        cached, parse = self.load(self.path)
+        self.assertFalse(parse.called)
+        self.assertEqual(compiled.data, cached.data)
+        self.assertEqual(compiled.templates, cached.templates)
+        conf = cached.config()
+        self.assertEqual("/tmp/snapshot", conf.data["target"])
+        self.assertEqual(
+            {"type": "command", "command": "uptime", "priority": 1,
+             "host": {"address": "10.0.0.1"}},
+            next(conf.objects))
+
+        # changed config gets its own plan
+        self.data["target"] = "/tmp/other"
+        self.write("config.json", self.data)
+        changed, parse = self.load(self.path)
+        self.assertEqual(1, parse.call_count)
+        self.assertEqual("/tmp/other", changed.data["target"])
+
+    def test_load_broken(self):
+        self.load(self.path)
+        cached = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(cached, "w") as f:
+            f.write("broken")
+        loaded, parse = self.load(self.path)
+        self.assertEqual(1, parse.call_count)
+        self.assertEqual(self.data, loaded.data)
+        # the plan is compiled again
+        self.assertFalse(self.load(self.path)[1].called)
+
+    def test_load_untrusted(self):
+        self.load(self.path)
+        cached = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        self.assertEqual(0o600, os.stat(cached).st_mode & 0o777)
+        self.assertEqual(0o700, os.stat(self.cache_dir).st_mode & 0o777)
+
+        os.chmod(cached, 0o660)
+        self.assertTrue(self.load(self.path)[1].called)
+        os.chmod(cached, 0o600)
+        os.chmod(self.cache_dir, 0o777)
+        self.assertTrue(self.load(self.path)[1].called)
+        os.chmod(self.cache_dir, 0o700)
+        self.assertFalse(self.load(self.path)[1].called)
+        with mock.patch('shotgun.plan.os.geteuid', return_value=12345):
+            self.assertTrue(self.load(self.path)[1].called)
+
+    def test_not_saved_into_untrusted_directory(self):
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0o777)
+        self.load(self.path)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_cache_path(self):
+        path = plan.cache_path("content", json.loads, self.cache_dir)
+        self.assertEqual(
+            path, plan.cache_path("content", json.loads, self.cache_dir))
+        self.assertNotEqual(
+            path, plan.cache_path("content", json.dumps, self.cache_dir))
+        with mock.patch('shotgun.__version__', "0.0.0"):
+            self.assertNotEqual(
+                path, plan.cache_path("content", json.loads, self.cache_dir))
+
+    def test_load_without_cache(self):
+        loaded = plan.load(self.path, json.loads, None)
+        self.assertEqual(self.data, loaded.data)
+
+    def test_prune(self):
+        for i in range(3):
+            plan.save(plan.Plan({"n": i}),
+                      os.path.join(self.cache_dir, "{0}.plan".format(i)),
+                      keep=2)
+            os.utime(os.path.join(self.cache_dir, "{0}.plan".format(i)),
+                     (i, i))
+        plan.prune(self.cache_dir, 2)
+        self.assertEqual(["1.plan", "2.plan"],
+                         sorted(os.listdir(self.cache_dir)))
+
+    @mock.patch('shotgun.plan.os.path.getmtime',
+                side_effect=OSError(errno.ENOENT, "removed"))
+    def test_prune_removed(self, _):
+        plan.save(plan.Plan({}), os.path.join(self.cache_dir, "0.plan"))
+        plan.prune(self.cache_dir, 0)
+        self.assertEqual(["0.plan"], os.listdir(self.cache_dir))
+
+    def test_objects_and_diff(self):
+        old = plan.Plan(self.data)
+        self.assertEqual([
+            ("10.0.0.1", "command", "uptime"),
+            ("10.0.0.2", "command", "uptime"),
+            ("10.0.0.1", "file", "/etc/nova"),
+            ("10.0.0.2", "file", "/etc/nova"),
+        ], list(old.objects()))
+
+        data = copy.deepcopy(self.data)
+        data["dump"]["controller"]["hosts"].pop()
+        data["dump"]["local"] = {
+            "objects": [{"type": "dir", "path": "/var/log"}]}
+        new = plan.Plan(data)
+        self.assertEqual([
+            ("-", "10.0.0.2", "command", "uptime"),
+            ("-", "10.0.0.2", "file", "/etc/nova"),
+            ("+", "localhost", "dir", "/var/log"),
+        ], plan.diff(old, new))
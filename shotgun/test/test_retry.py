@@ -0,0 +1,61 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from shotgun import retry
+from shotgun.test import base
+
+
+class TestRetry(base.BaseTestCase):
+
+    def test_backoff(self):
+        for _ in range(100):
+            self.assertTrue(0.5 <= retry.backoff(1, 1, 30) <= 1)
+            self.assertTrue(2 <= retry.backoff(3, 1, 30) <= 4)
+            self.assertTrue(15 <= retry.backoff(10, 1, 30) <= 30)
+
+    @mock.patch('shotgun.retry.random.uniform', return_value=0)
+    @mock.patch('shotgun.retry.time')
+    def test_host_retries(self, mtime, muniform):
+        mtime.time.return_value = 100.0
+        retries = retry.HostRetries(3, 2, 30)
+
+        self.assertFalse(retries.failed('host1'))
+        self.assertEqual(1, retries.delay('host1'))
+        self.assertEqual(0, retries.delay('host2'))
+        self.assertFalse(retries.failed('host1'))
+        self.assertEqual(2, retries.delay('host1'))
+        self.assertFalse(retries.is_open('host1'))
+
+        self.assertTrue(retries.failed('host1'))
+        self.assertTrue(retries.is_open('host1'))
+        self.assertEqual(0, retries.delay('host1'))
+
+    @mock.patch('shotgun.retry.random.uniform', return_value=0)
+    @mock.patch('shotgun.retry.time')
+    def test_wait(self, mtime, muniform):
+        mtime.time.return_value = 100.0
+        retries = retry.HostRetries(3, 2, 30)
+        retries.failed('host1')
+        retries.failed('host2')
+        retries.failed('host2')
+
+        retries.wait(['host1', 'host2'])
+        mtime.sleep.assert_called_once_with(1)
+
+        mtime.sleep.reset_mock()
+        retries.wait(['host2', 'host3'])
+        retries.wait([])
+        self.assertFalse(mtime.sleep.called)
@@ -0,0 +1,95 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from shotgun import scheduler
+from shotgun.test import base
+
+
+class TestScheduler(base.BaseTestCase):
+
+    def test_sort_key(self):
+        objs = [
+            {"n": 1},
+            {"n": 2, "priority": 10, "cost": 30},
+            {"n": 3, "cost": 5},
+            {"n": 4, "priority": 10},
+            {"n": 5, "priority": -1},
+        ]
+        self.assertEqual(
+            [4, 2, 1, 3, 5],
+            [o["n"] for o in sorted(objs, key=scheduler.sort_key)])
+
+    def test_unlimited(self):
+        deadline = scheduler.Deadline(None)
+        obj = {"type": "command"}
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual((obj, None), deadline.admit(obj, 10))
+
+    @mock.patch('shotgun.scheduler.time.time')
+    def test_admit(self, mtime):
+        mtime.return_value = 100
+        deadline = scheduler.Deadline(60)
+        mtime.return_value = 130.5
+
+        obj, reason = deadline.admit({"type": "command"}, 10)
+        self.assertEqual({"type": "command"}, obj)
+        self.assertIsNone(reason)
+        obj, _ = deadline.admit({"type": "command"}, None)
+        self.assertEqual({"type": "command"}, obj)
+
+        # command timeout is cut to the rest of the budget
+        obj, _ = deadline.admit({"type": "command", "timeout": 100}, None)
+        self.assertEqual(30, obj["timeout"])
+        obj, _ = deadline.admit({"type": "command"}, 100)
+        self.assertEqual(30, obj["timeout"])
+
+        obj, reason = deadline.admit({"type": "command", "cost": 40}, 10)
+        self.assertIsNone(obj)
+        self.assertEqual("estimated cost 40s exceeds remaining 30s", reason)
+
+        mtime.return_value = 160
+        obj, reason = deadline.admit({"type": "command"}, 10)
+        self.assertIsNone(obj)
+        self.assertEqual("deadline reached", reason)
+
+    def test_budget(self):
+        budget = scheduler.Budget(100)
+        self.assertEqual(60, budget.take(60))
+        self.assertEqual(40, budget.take(60))
+        self.assertEqual(0, budget.take(10))
+        self.assertEqual(10, scheduler.Budget(None).take(10))
+
+    def test_write_dropped(self):
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        records = [
+            {"host": "node-1", "type": "file", "object": "/var/log",
+             "status": "ok"},
+            {"host": "node-2", "type": "command", "object": "ps",
+             "status": "dropped", "reason": "deadline reached"},
+        ]
+        scheduler.write_dropped(target, records)
+        with open(os.path.join(target, scheduler.DROPPED_NAME)) as f:
+            self.assertEqual("node-2 command: ps: deadline reached\n",
+                             f.read())
+
+        os.remove(os.path.join(target, scheduler.DROPPED_NAME))
+        scheduler.write_dropped(target, records[:1])
+        self.assertEqual([], os.listdir(target))
@@ -14,10 +14,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import shutil
+import signal
 import StringIO
+import subprocess
+import tarfile
+import tempfile
+import time
 
 import mock
 
+from shotgun import archive
 from shotgun.test import base
 from shotgun import utils
 
@@ -44,15 +52,16 @@ class TestUtils(base.BaseTestCase):
         self.assertEqual(
             result, ['/root/file1', '/root/file2', '/root/sub/file3'])
 
+    @mock.patch('shotgun.utils.fs.remove')
     @mock.patch('shotgun.utils.execute')
-    def test_compress(self, mexecute):
+    def test_compress(self, mexecute, mremove):
+        mexecute.return_value = (0, '', '')
         target = '/path/target'
         level = '-3'
 
         utils.compress(target, level)
 
         compress_call = mexecute.call_args_list[0]
-        rm_call = mexecute.call_args_list[1]
 
         compress_env = compress_call[1]['env']
         self.assertEqual(compress_env['XZ_OPT'], level)
@@ -60,7 +69,77 @@ class TestUtils(base.BaseTestCase):
             compress_call[0][0],
             'tar cJvf /path/target.tar.xz -C /path target')
 
-        self.assertEqual(rm_call[0][0], 'rm -r /path/target')
+        mremove.assert_called_once_with('/path/target')
+
+    @mock.patch('shotgun.utils.fs.remove')
+    @mock.patch('shotgun.utils.execute')
+    def test_compress_failure_keeps_target(self, mexecute, mremove):
+        mexecute.return_value = (2, '', 'xz: unsupported option -T4')
+
+        self.assertRaises(archive.CompressionError, utils.compress,
+                          '/path/target', '-3', threads=4)
+
+        mremove.assert_called_once_with('/path/target.tar.xz')
+
+    def test_compress_stdlib_codec(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        target = os.path.join(tmp, 'target')
+        os.makedirs(os.path.join(target, 'host'))
+        with open(os.path.join(target, 'host', 'file'), 'w') as f:
+            f.write('content')
+
+        path = utils.compress(target, '-1', codec='gzip', threads=2)
+
+        self.assertEqual(path, target + '.tar.gz')
+        self.assertFalse(os.path.exists(target))
+        with tarfile.open(path, 'r:gz') as tar:
+            self.assertEqual(
+                'content', tar.extractfile('target/host/file').read())
+
+    def test_execute_stream_check(self):
+        with utils.execute_stream('echo out; exit 2') as stdout:
+            self.assertEqual('out\n', stdout.read())
+        with self.assertRaises(subprocess.CalledProcessError):
+            with utils.execute_stream('echo out; exit 2',
+                                      check=True) as stdout:
+                stdout.read()
+
+    def test_execute_timeout(self):
+        started = time.time()
+        code, stdout, _ = utils.execute(
+            'echo started; sleep 5 | cat; echo finished', timeout=0.2)
+        self.assertLess(time.time() - started, 4)
+        self.assertEqual('started\n', stdout)
+        self.assertEqual(-signal.SIGKILL, code)
+
+    def test_batch_script(self):
+        commands = [
+            'echo out; echo err >&2; exit 3',
+            'printf "no newline"',
+            'for i in 1 2; do\n  echo "$i \'quoted\'"\ndone',
+        ]
+        script = utils.batch_script(commands, 'BOUNDARY')
+        _, stdout, _ = utils.execute(script)
+
+        result = utils.parse_batch_output(stdout, 'BOUNDARY')
+
+        self.assertEqual(result, {
+            0: {'stdout': 'out\n', 'stderr': 'err\n', 'rc': '3'},
+            1: {'stdout': 'no newline', 'stderr': '', 'rc': '0'},
+            2: {'stdout': "1 'quoted'\n2 'quoted'\n", 'stderr': '',
+                'rc': '0'},
+        })
+
+    def test_parse_batch_output_interrupted(self):
+        output = '\nB 0 stdout\nout\nB 0 stderr\n\nB 0 rc\n0\nB 1 stdout\npart'
+
+        result = utils.parse_batch_output(output, 'B')
+
+        self.assertEqual(result, {
+            0: {'stdout': 'out', 'stderr': '', 'rc': '0'},
+            1: {'stdout': 'part'},
+        })
 
 
 class TestCCStringIO(base.BaseTestCase):
@@ -104,6 +183,18 @@ class TestCCStringIO(base.BaseTestCase):
         self.assertEqual(ccstring.getvalue(), buffer)
         self.assertEqual(writer.getvalue(), '')
 
+    def test_max_size(self):
+        writer = StringIO.StringIO()
+        ccstring = utils.CCStringIO(writers=writer, max_size=5)
+        ccstring.write('abc')
+        self.assertFalse(ccstring.truncated)
+        ccstring.write('defg')
+        ccstring.write('hij')
+
+        self.assertEqual(ccstring.getvalue(), 'abcde')
+        self.assertTrue(ccstring.truncated)
+        self.assertEqual(writer.getvalue(), 'abcdefghij')
+
     def test_non_ascii_output_with_unicode(self):
         ccstring = utils.CCStringIO()
         ccstring.write('привет')
@@ -12,13 +12,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import copy
 import logging
 import os
+import pipes
 import re
+import shutil
+import signal
 import socket
 from StringIO import StringIO
 import subprocess
+import threading
+
+from shotgun import archive
+from shotgun import fs
 
 
 logger = logging.getLogger(__name__)
@@ -58,25 +66,109 @@ def remove(full_dst_path, excludes):
         execute("shopt -s globstar; rm -rf {0}".format(path))
 
 
-def compress(target, level, keep_target=False):
+def compress(target, level, keep_target=False, codec="xz", threads=1):
     """Runs compression of provided directory
 
     :param target: directory to compress
     :param level: level of compression
     :param keep_target: bool, if True target directory wont be removed
+    :param codec: name of compression backend, see archive.CODECS
+    :param threads: number of compression threads, 0 means all CPUs
+    :returns: path to the archive
+    :raises: archive.CompressionError, subprocess.CalledProcessError if
+             the archive can't be made, the target is kept then
     """
-    env = copy.deepcopy(os.environ)
-    env['XZ_OPT'] = level
-    execute("tar cJvf {0}.tar.xz -C {1} {2}"
-            "".format(target,
-                      os.path.dirname(target),
-                      os.path.basename(target)),
-            env=env)
+    compressor = archive.get_codec(codec, level, threads)
+    path = "{0}.tar.{1}".format(target, compressor.extension)
+    directory = os.path.dirname(target)
+    name = os.path.basename(target)
+    try:
+        _tar(compressor, path, directory, name)
+    except (archive.CompressionError, subprocess.CalledProcessError) as e:
+        # the dump can't be collected again, so it outlives a broken
+        # archive
+        logger.error("Failed to compress %s, it's kept: %s", target, e)
+        fs.remove(path)
+        raise
     if not keep_target:
-        execute("rm -r {0}".format(target))
+        fs.remove(target)
+    return path
+
+
+def _tar(compressor, path, directory, name):
+    tar_command = compressor.tar_command(path, directory, name)
+    if tar_command:
+        command, variables = tar_command
+        env = copy.deepcopy(os.environ)
+        env.update(variables)
+        exit_code, _, stderr = execute(command, env=env)
+        if exit_code:
+            raise archive.CompressionError(
+                "Command {0} failed with code {1}: {2}".format(
+                    command, exit_code, stderr.strip()))
+    else:
+        with open(path, "wb") as f:
+            writer = compressor.writer(f)
+            with execute_stream(
+                    "tar cf - -C {0} {1}".format(directory, name),
+                    check=True) as stdout:
+                shutil.copyfileobj(stdout, writer, 1024 * 1024)
+            writer.close()
+
+
+def batch_script(commands, boundary, shell='bash'):
+    """Makes shell script which runs several commands at once
+
+    Output and return code of each command are captured separately and
+    printed between lines started with the boundary, so they can be split
+    back with parse_batch_output().
+
+    :param commands: list of shell commands
+    :param boundary: unique string which doesn't occur in the output
+    :param shell: shell which runs every command
+    :returns: str with shell script
+    """
+    lines = ['d=$(mktemp -d)']
+    for i, command in enumerate(commands):
+        marker = '{0} {1}'.format(boundary, i)
+        lines.extend([
+            '{0} -c {1} >"$d/out" 2>"$d/err" </dev/null; rc=$?'.format(
+                shell, pipes.quote(command)),
+            "printf '\\n%s\\n' '{0} stdout'; cat \"$d/out\"".format(marker),
+            "printf '\\n%s\\n' '{0} stderr'; cat \"$d/err\"".format(marker),
+            "printf '\\n%s\\n%s' '{0} rc' \"$rc\"".format(marker),
+        ])
+    lines.extend([
+        "printf '\\n%s\\n' '{0} end end'".format(boundary),
+        'rm -rf "$d"',
+    ])
+    return '\n'.join(lines)
+
+
+def parse_batch_output(output, boundary):
+    """Splits output of batch_script() by commands
 
+    :param output: str with output of the script
+    :param boundary: boundary given to batch_script()
+    :returns: dict {command index: {'stdout': .., 'stderr': .., 'rc': ..}}
+    """
+    parts = re.split(
+        r'\r?\n{0} (\d+|end) (\w+)\r?\n'.format(re.escape(boundary)),
+        output)
+    results = {}
+    for index, field, content in zip(parts[1::3], parts[2::3], parts[3::3]):
+        if index != 'end':
+            results.setdefault(int(index), {})[field] = content
+    return results
+
+
+def execute(command, env=None, timeout=None):
+    """Runs local command
 
-def execute(command, env=None):
+    :param timeout: seconds after which the command is killed along
+                    with all processes it started
+    :returns: tuple (return code, stdout, stderr)
+    """
     logger.debug("Trying to execute command: %s", command)
 
     env = env or os.environ
@@ -84,11 +176,89 @@ def execute(command, env=None):
 
     process = subprocess.Popen(
         command, env=env, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE, shell=True)
-    stdout, stderr = process.communicate()
+        stderr=subprocess.PIPE, shell=True,
+        # own process group lets the timer kill the whole pipeline
+        preexec_fn=os.setsid if timeout else None)
+    with _killed_after(timeout, process, command):
+        stdout, stderr = process.communicate()
     return (process.poll(), stdout, stderr)
 
 
+@contextlib.contextmanager
+def _killed_after(timeout, process, command):
+    """Kills process group of the process if it runs longer than timeout"""
+    if not timeout:
+        yield
+        return
+    timer = threading.Timer(timeout, _kill_group, (process, command))
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+
+
+def _kill_group(process, command):
+    logger.error("Command timed out, killing it: %s", command)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # already finished
+        pass
+
+
+@contextlib.contextmanager
+def execute_stream(command, env=None, check=False):
+    """Runs command yielding its stdout as a file object
+
+    Output isn't collected in memory, it should be read by the caller
+    while the command is running. Stderr is discarded.
+
+    :param check: if True, subprocess.CalledProcessError is raised when
+                  the command fails
+    """
+    logger.debug("Trying to execute command with streaming: %s", command)
+
+    env = env or os.environ
+    env["PATH"] = "/bin:/usr/bin:/sbin:/usr/sbin"
+
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(
+            command, env=env, stdout=subprocess.PIPE,
+            stderr=devnull, shell=True)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.wait()
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def execute_to_file(command, fileobj, env=None, timeout=None, stderr=None):
+    """Runs command writing its stdout and stderr into a file
+
+    Output goes to the file directly, so it's never kept in memory.
+
+    :param timeout: seconds after which the command is killed, see
+                    execute()
+    :param stderr: file to write stderr into instead of fileobj
+    :returns: return code of the command
+    """
+    logger.debug("Trying to execute command into file: %s", command)
+
+    env = env or os.environ
+    env["PATH"] = "/bin:/usr/bin:/sbin:/usr/sbin"
+
+    fileobj.flush()
+    process = subprocess.Popen(
+        command, env=env, stdout=fileobj,
+        stderr=stderr or subprocess.STDOUT, shell=True,
+        preexec_fn=os.setsid if timeout else None)
+    with _killed_after(timeout, process, command):
+        return process.wait()
+
+
 class CCStringIO(StringIO):
     """A "carbon copy" StringIO.
 
@@ -97,12 +267,16 @@ class CCStringIO(StringIO):
     Taken from fabric.tests.mock_streams.CarbonCopy
     """
 
-    def __init__(self, buffer='', writers=None):
+    def __init__(self, buffer='', writers=None, max_size=None):
         """CCStringIO initializator
 
         If ``writers`` is given and is a file-like object or an
         iterable of same, it/they will be written to whenever this
         StringIO instance is written to.
+
+        If ``max_size`` is given, the instance keeps no more than
+        ``max_size`` bytes, the rest is only passed to writers and
+        ``truncated`` is set.
         """
         StringIO.__init__(self, buffer)
         if writers is None:
@@ -110,6 +284,8 @@ class CCStringIO(StringIO):
         elif hasattr(writers, 'write'):
             writers = [writers]
         self.writers = writers
+        self.max_size = max_size
+        self.truncated = False
 
     def write(self, s):
         # unfortunately, fabric writes into StringIO both so-called
@@ -123,6 +299,11 @@ class CCStringIO(StringIO):
         if isinstance(s, unicode):
             s = s.encode('utf-8')
 
-        StringIO.write(self, s)
         for writer in self.writers:
             writer.write(s)
+        if self.max_size is not None:
+            room = max(self.max_size - self.len, 0)
+            if len(s) > room:
+                s = s[:room]
+                self.truncated = True
+        StringIO.write(self, s)